@@ -13,235 +13,1013 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
-__all__ = ["AutonomiaClient"]
+__all__ = ["AutonomiaClient", "AutonomiaGateway"]
 
 import socket
 import select
 import time
 import threading
-import ssl
 import fcntl
 import struct
 import array
 import sys
 import os
-import json
+import errno
+import Queue
+import heapq
+import types
+import collections
 
-# From http-parser (0.8.3)
-# pip install http-parser
-from http_parser.parser import HttpParser
-import streamer
+from chunked import ChunkDecoder
+import jsoncodec
+
+# imported on first use, to keep the import of the module fast on small boards:
+# ssl by the first SSL connection, random by the first reconnection, spool, capture, metrics and streamer
+# by set_spool(), set_capture(), enable_metrics() and the video methods
+ssl = None
 
 #------------------ TODO: move to autonomia.io
 AUTONOMIA_SERVER='cometa.autonomia.io'
 
-def message_handler(msg, msg_len):
+# the MAC address found by get_mac()
+_mac = None
+
+def get_mac():
+  """
+  Get the device MAC address, looked up once on the first call. Linux host.
+  All the network interfaces are enumerated: eth0 and wlan0 first, then the others in name order.
+  """
+  global _mac
+  if _mac is None:
+    if 'linux' in sys.platform:
+      _mac = linux_mac()
+    if _mac is None:
+      from uuid import getnode
+      _mac = getnode()
+  return _mac
+
+# name prefixes of the virtual network interfaces, their MAC address is random or changes
+VIRTUAL_INTERFACES = ('lo', 'docker', 'br-', 'veth', 'virbr', 'vnet', 'vmnet', 'vboxnet', 'tun', 'tap', 'dummy', 'bond', 'ifb')
+
+def linux_mac():
+  """
+  Return the MAC address of the first network interface with one, or None: eth0 or wlan0, then
+  the interfaces of a hardware device, then the others, skipping the bridges and the virtual interfaces.
+  """
+  try:
+    names = os.listdir('/sys/class/net')
+  except OSError:
+    # no sysfs, use the interfaces with statistics
+    try:
+      with open('/proc/net/dev') as f:
+        names = [line.split(':')[0].strip() for line in f.readlines()[2:]]
+    except IOError:
+      names = []
+  names = [name for name in names if not name.startswith(VIRTUAL_INTERFACES) and
+           not os.path.exists('/sys/class/net/%s/bridge' % name)]
+  preferred = ['eth0', 'wlan0']
+  hardware = sorted(name for name in names if name not in preferred and os.path.exists('/sys/class/net/%s/device' % name))
+  names = [name for name in preferred if name in names] + hardware + \
+          sorted(name for name in names if name not in preferred and name not in hardware)
+
+  s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  try:
+    for ifname in names:
+      try:
+        # SIOCGIFHWADDR
+        info = fcntl.ioctl(s.fileno(), 0x8927, struct.pack('256s', ifname[:15]))
+      except IOError:
+        continue
+      mac = info[18:24]
+      # skip the loopback and the interfaces without a hardware address
+      if mac != '\0' * 6:
+        return ''.join(['%02X' % ord(char) for char in mac])
+  finally:
+    s.close()
+  return None
+
+# interval in seconds between sends of the spooled messages
+DRAIN_INTERVAL = 0.1
+
+# interval in seconds between checks of the server liveness
+PEER_CHECK_INTERVAL = 1.0
+
+# payloads up to this size are copied into one string with the chunk header, larger ones are sent from a view
+COPY_THRESHOLD = 4096
+# maximum bytes passed to one socket send
+SEND_SLICE = 65536
+
+# JSON-RPC reply of an encoded result and id
+RESULT_REPLY = '{"jsonrpc":"2.0","result":%s,"id":%s}'
+# types of a valid JSON-RPC request id
+RPC_ID_TYPES = (basestring, int, long, float, types.NoneType)
+# methods of the streamed results handled by the client: cancel a stream and acknowledge its partial results
+STREAM_METHODS = ('rpc.cancel', 'rpc.ack')
+
+# priority lanes of the outbound scheduler, the lower first
+PRIORITY_CONTROL = 0
+PRIORITY_HEARTBEAT = 1
+PRIORITY_TELEMETRY = 2
+# Linux socket option limiting the bytes not yet sent in the socket buffer, missing from the socket module
+TCP_NOTSENT_LOWAT = 25
+
+def byte_view(data):
+  """
+  Return the bytes of a message without copying them: a str, a memoryview of bytes, or a buffer
+  over a bytearray, mmap, array or NumPy array. A unicode string is encoded in UTF-8.
+  """
+  if isinstance(data, (str, buffer)):
+    return data
+  if isinstance(data, unicode):
+    return data.encode('utf-8')
+  if isinstance(data, memoryview):
+    if data.itemsize == 1 and data.ndim == 1:
+      return data
+    return data.tobytes()
+  return buffer(data)
+
+def slice_view(data, start, end):
+  """
+  Return the bytes start to end of a byte view without copying them.
+  """
+  if isinstance(data, memoryview):
+    return data[start:end]
+  return buffer(data, start, end - start)
+
+def view_bytes(data):
+  """
+  Return a copy of a byte view as a str.
+  """
+  if isinstance(data, str):
+    return data
+  if isinstance(data, memoryview):
+    return data.tobytes()
+  return str(data)
+
+def chunk_parts(payload, marker=''):
+  """
+  Return the parts of the HTTP chunk of a message: one string for a small payload, otherwise
+  the chunk header, the payload and the chunk trailer, so that the payload is sent without copying it.
+  """
+  size = len(marker) + len(payload)
+  if size <= COPY_THRESHOLD:
+    return ("%x\r\n%s%s\r\n" % (size, marker, view_bytes(payload)),)
+  return ("%x\r\n%s" % (size, marker), payload, "\r\n")
+
+# Linux struct tcp_info up to tcpi_rttvar: 8 bytes of state, then 32-bit fields
+TCP_INFO = struct.Struct('=8B17I')
+
+def tcp_info(sock):
+  """
+  Return the TCP round-trip time and the time since the last acknowledgment received, in seconds,
+  or None if the kernel does not report them.
+  """
+  if not hasattr(socket, 'TCP_INFO'):
+    return None
+  try:
+    info = TCP_INFO.unpack(sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, TCP_INFO.size))
+  except (socket.error, struct.error):
+    return None
+  # tcpi_rtt in microseconds, tcpi_last_ack_recv in milliseconds
+  return info[8 + 15] / 1e6, info[8 + 12] / 1e3
+
+def message_handler(msg, msg_len, rpc_methods=None, metrics=None):
   """
   The generic JSON-RPC message handler for Autonomia receive callback.
   Invoked every time the Autonomia object receives a JSON-RPC message for this device.
   It returns the JSON-RPC result object to send back to the application that sent the request.
-  The rpc_methods tuple contains the mapping of names into functions.
+  The rpc_methods dictionary contains the mapping of names into functions.
+  A JSON-RPC batch (array of requests) is answered with an array of replies.
+  The calls are recorded in the optional metrics object.
+  """
+  req, error = parse_rpc_msg(msg)
+  if error:
+    return error
+  return dispatch_rpc(req, rpc_methods, metrics)
+
+def parse_rpc_msg(msg):
+  """
+  Parse a JSON-RPC request or batch and validate the single request.
+  Returns the request object and None, or None and the JSON-RPC error reply to send back.
   """
   try:
-    req = json.loads(msg)
+    req = jsoncodec.loads(msg)
   except Exception as e:
     # the message is not a json object
-    # print("Received JSON-RPC invalid message (parse error): %s" % msg)
-    return JSONError.JSON_RPC_PARSE_ERROR
+    return None, JSONError.JSON_RPC_PARSE_ERROR
+
+  if isinstance(req, list):
+    # the requests in a batch are validated one by one in dispatch_rpc()
+    if len(req) == 0:
+      return None, JSONError.JSON_RPC_INVALID_REQUEST
+    return req, None
 
-  # check the message is a proper JSON-RPC message
-  ret,id = check_rpc_msg(req)
+  error = rpc_request_error(req)
+  if error:
+    return None, error
+  return req, None
+
+def rpc_request_error(req):
+  """
+  Check the request is a proper JSON-RPC message.
+  Returns the JSON-RPC error reply to send back or None for a valid request.
+  """
+  ret, id = check_rpc_msg(req)
   if not ret:
-    if id and isanumber(id):
-      return JSONError.JSON_RPC_INVALID_PARAMS_FMT_NUM % id
-    if id and isinstance(id, str):
-      return JSONError.JSON_RPC_INVALID_PARAMS_FMT_STR % id
-    else:
-      return JSONError.JSON_RPC_PARSE_ERROR
+    # the id is echoed only if it is a valid one
+    return rpc_error(JSONError.INVALID_REQUEST, id if valid_rpc_id(id) else None)
+  return None
 
-  # print("JSON-RPC: %s" % msg)
+def dispatch_rpc(req, rpc_methods, metrics=None, stream=None, cache=None):
+  """
+  Call the registered methods for a validated JSON-RPC request or batch and return the JSON-RPC reply.
+  stream, cache: see call_rpc(), the results of a batch are never streamed
+  """
+  if not isinstance(req, list):
+    return call_rpc(req, rpc_methods, metrics, stream, cache)
 
-  method = req['method']
-  func = None
-  # check if the method is in the registered list
-  for m in AutonomiaClient._rpc_methods:
-    if m['name'] == method:
-        func = m['function']
-        break
+  replies = []
+  for r in req:
+    error = rpc_request_error(r)
+    replies.append(error if error else call_rpc(r, rpc_methods, metrics, None, cache))
+  return '[' + ','.join(replies) + ']'
 
+def call_rpc(req, rpc_methods, metrics=None, stream=None, cache=None):
+  """
+  Call the registered method for a validated JSON-RPC request and return the JSON-RPC reply.
+  A method returning a generator streams its results: stream(req, generator, start) sends them and
+  returns None, or the error reply if the stream cannot start. Without stream the results of the generator
+  are sent as one list.
+  With an RPCCache the result of a cached method is returned while it is fresh, without calling the method.
+  """
+  id = req['id']
+  # look up the method in the registry
+  func = rpc_methods.get(req['method']) if rpc_methods else None
   if func == None:
-    return JSONError.JSON_RPC_INVALID_REQUEST
+    if metrics:
+      metrics.count('rpc_not_found')
+    return rpc_error(JSONError.METHOD_NOT_FOUND, id)
+
+  reply, token = cached_rpc(req, cache, metrics)
+  if reply:
+    return reply
 
   # call the method
+  start = time.time()
   try:
     result = func(req['params'])
+    if isinstance(result, types.GeneratorType) and stream is None:
+      result = list(result)
+  except Exception as e:
+    print e
+    if metrics:
+      metrics.rpc_call(req['method'], time.time() - start, True)
+    return rpc_error(JSONError.INTERNAL_ERROR, id)
+  if cache:
+    # the call may change what the cached methods return
+    cache.called(req['method'])
+  if isinstance(result, types.GeneratorType):
+    # the stream records the call in the metrics when it ends
+    return stream(req, result, start)
+  if metrics:
+    metrics.rpc_call(req['method'], time.time() - start)
+  try:
+    encoded = jsoncodec.dumps(result)
+  except Exception as e:
+    # the result is not serializable
+    print e
+    return rpc_error(JSONError.INTERNAL_ERROR, id)
+  if token:
+    cache.store(token, encoded)
+  return RESULT_REPLY % (encoded, encode_id(id))
+
+def cached_rpc(req, cache, metrics=None, miss=True):
+  """
+  Look up the result of a request in the cache. Returns the reply and None on a hit, None and the token
+  to store the result on a miss, None and None if the method is not cached.
+  miss: count the misses -- False for a lookup followed by call_rpc()
+  """
+  if not cache:
+    return None, None
+  start = time.time()
+  encoded, token = cache.lookup(req['method'], req['params'], miss)
+  if encoded is None:
+    if metrics and token and miss:
+      metrics.count('rpc_cache_misses')
+    return None, token
+  if metrics:
+    metrics.count('rpc_cache_hits')
+    metrics.rpc_call(req['method'], time.time() - start)
+  return RESULT_REPLY % (encoded, encode_id(req['id'])), None
+
+def rpc_result(result, id):
+  """
+  Return the JSON-RPC reply of a result, encoded around the result without building the reply object.
+  """
+  try:
+    return RESULT_REPLY % (jsoncodec.dumps(result), encode_id(id))
   except Exception as e:
+    # the result is not serializable
     print e
-    return JSONError.JSON_RPC_INTERNAL_ERROR_FMT_STR % str(id)
+    return rpc_error(JSONError.INTERNAL_ERROR, id)
 
-  # build the response object
-  reply = {}
-  reply['jsonrpc'] = "2.0"
-  reply['result'] = result
-  reply['id'] = req['id']
+def params_key(params):
+  """
+  Return a hashable key of the params of a call, equal for equal params whatever the order of the members.
+  The booleans are kept apart from the numbers 1 and 0.
+  """
+  if isinstance(params, dict):
+    return (dict, tuple(sorted((k, params_key(v)) for k, v in params.iteritems())))
+  if isinstance(params, list):
+    return (list, tuple(params_key(v) for v in params))
+  if params is True or params is False:
+    return (bool, params)
+  return params
+
+def rpc_partial(item, seq, id):
+  """
+  Return the JSON-RPC partial reply of a streamed result item: {"jsonrpc":"2.0","partial":item,"seq":seq,"id":id}.
+  """
+  return '{"jsonrpc":"2.0","partial":%s,"seq":%d,"id":%s}' % (jsoncodec.dumps(item), seq, encode_id(id))
+
+def rpc_error(code, id=None):
+  """
+  Return the JSON-RPC error reply of a JSONError code.
+  """
+  return '%s%s}' % (JSONError.ERROR_PREFIX[code], encode_id(id))
 
-  return json.dumps(reply)
+def encode_id(id):
+  """
+  Return the JSON of a request id, without the codec for the usual integer ids.
+  """
+  if type(id) is int:
+    return str(id)
+  return jsoncodec.dumps(id)
+
+def valid_rpc_id(id):
+  """
+  Return True for a valid JSON-RPC request id: a string, a number or null. A boolean is an int, not an id.
+  """
+  return isinstance(id, RPC_ID_TYPES) and not isinstance(id, bool)
 
 def check_rpc_msg(req):
-    ret = False
-    id = None
-    k = req.keys()
-    # check presence of required id attribute
-    if 'id' in k:
-        id = req['id']
-    else:
-        return ret, id
-    # check object length
-    if (len(k) != 4):
-        return ret, id
-    # check presence of required attributes
-    if (not 'jsonrpc' in k) or (not 'method' in k) or (not 'params' in k):
-        return ret, id
-    # check for version
-    if req['jsonrpc'] != "2.0":
-        return ret, id
-    # valid request
-    return True,id
-
-def isanumber(x):
+  """
+  Validate a JSON-RPC request in one pass over its members: an object with exactly the
+  jsonrpc "2.0", method, params and id members, a string method and a string, number or null id.
+  Returns True or False and the request id, None if it is missing.
+  """
+  if not isinstance(req, dict):
+    return False, None
+  id = req.get('id')
+  if len(req) != 4 or 'id' not in req or 'params' not in req or req.get('jsonrpc') != "2.0" or \
+     not isinstance(req.get('method'), basestring) or not valid_rpc_id(id):
+    return False, id
+  # valid request
+  return True, id
+
+class RPCWorkerPool(object):
+  """
+  A bounded pool of worker threads running the RPC methods off the I/O thread.
+  Methods exported:
+    RPCWorkerPool(size=4, max_queue=64, method_limits=None) -- Object constructor
+    submit(method, job) -- Queue a job for a method, returns False when the queue is full
+    stats() -- Queue depth and activity counters
+  """
+
+  def __init__(self, size=4, max_queue=64, method_limits=None):
+    """
+    size: number of worker threads
+    max_queue: maximum number of jobs waiting to run
+    method_limits: dictionary of method name to the maximum number of concurrent calls
+    """
+    self.size = size
+    self.max_queue = max_queue
+    self._limits = dict(method_limits or {})
+    self._lock = threading.Lock()
+    self._jobs = Queue.Queue()
+    self._running = {}    # method name -> jobs running or handed to the workers
+    self._waiting = {}    # method name -> jobs held back by the method limit
+    self._queued = 0
+    self._active = 0
+    self._high_water = 0
+    self._rejected = 0
+    self._completed = 0
+
+    for i in range(size):
+      t = threading.Thread(target=self._worker)
+      t.daemon = True
+      t.start()
+    return
+
+  def submit(self, method, job):
+    """
+    Queue a job for the method. The job is a callable with no arguments.
+    Returns False if the queue is full and the job has been rejected.
+    """
+    with self._lock:
+      if self._queued >= self.max_queue:
+        self._rejected += 1
+        return False
+      self._queued += 1
+      self._high_water = max(self._high_water, self._queued)
+
+      limit = self._limits.get(method)
+      if limit and self._running.get(method, 0) >= limit:
+        self._waiting.setdefault(method, collections.deque()).append(job)
+        return True
+      self._running[method] = self._running.get(method, 0) + 1
+      self._jobs.put((method, job))
+    return True
+
+  def stats(self):
+    """
+    Return a dictionary with the queue depth and activity counters.
+    """
+    with self._lock:
+      return {'workers': self.size, 'max_queue': self.max_queue, 'queued': self._queued, 'active': self._active,
+              'high_water': self._high_water, 'rejected': self._rejected, 'completed': self._completed}
+
+  def _worker(self):
+    """
+    The worker thread.
+    """
+    while True:
+      method, job = self._jobs.get()
+      with self._lock:
+        self._queued -= 1
+        self._active += 1
+      try:
+        job()
+      except Exception, e:
+        print e
+
+      with self._lock:
+        self._active -= 1
+        self._completed += 1
+        waiting = self._waiting.get(method)
+        if waiting:
+          # hand the method slot to the next held back call
+          self._jobs.put((method, waiting.popleft()))
+        else:
+          self._running[method] -= 1
+
+class RPCCache(object):
+  """
+  Cache of the results of read-only RPC methods, keyed by method and canonical params, with a time to live
+  per method and least recently used eviction. The results are stored encoded: a hit is not encoded again.
+  A method can invalidate the results of other methods when it is called, i.e. set_config of get_config.
+  Methods exported:
+    RPCCache(max_entries=256) -- Object constructor
+    configure(method, ttl, invalidates=()) -- Cache the results of a method, or stop caching them
+    lookup(method, params, miss=True) -- The encoded result of a call, or None and the token to store it
+    store(token, encoded) -- Store the encoded result of a call
+    called(method) -- Invalidate the results of the methods invalidated by a method
+    invalidate(method=None, params=None) -- Drop results
+    stats() -- Hit, miss and eviction counters
+  """
+
+  def __init__(self, max_entries=256):
+    """
+    max_entries: maximum number of cached results, the least recently used are evicted
+    """
+    self.max_entries = max_entries
+    self._ttl = {}            # method -> seconds a result is fresh
+    self._invalidates = {}    # method -> methods whose results a call invalidates
+    self._entries = collections.OrderedDict()   # (method, params) -> (encoded result, expiry time), the oldest used first
+    # incremented by the invalidations, of all the methods and per method:
+    # the results of the calls started before an invalidation are not stored
+    self._generation = 0
+    self._generations = {}    # method -> generation
+    self._lock = threading.Lock()
+    self._methods = {}        # method -> [hits, misses]
+    self._evictions = 0
+    self._expired = 0
+    self._invalidations = 0
+
+  def configure(self, method, ttl, invalidates=()):
+    """
+    Cache the results of a method for ttl seconds -- None or 0 to stop caching them.
+    invalidates: the names of the methods whose results are dropped when the method is called
+    """
+    with self._lock:
+      if ttl:
+        self._ttl[method] = ttl
+        self._methods.setdefault(method, [0, 0])
+      else:
+        self._ttl.pop(method, None)
+      if invalidates:
+        self._invalidates[method] = tuple(invalidates)
+      else:
+        self._invalidates.pop(method, None)
+    if not ttl:
+      self.invalidate(method)
+    return
+
+  def lookup(self, method, params, miss=True):
+    """
+    Return the fresh encoded result of a call and None, or None and the token to store the result of the call.
+    The token is None if the method is not cached or the params cannot be a key.
+    miss: count a miss
+    """
+    if method not in self._ttl:
+      return None, None
     try:
-        int(x)
-    except ValueError:
-        try:
-            float(x)
-        except ValueError:
-            return False
+      key = (method, params_key(params))
+    except RuntimeError:
+      # too deeply nested
+      return None, None
+    with self._lock:
+      counters = self._methods.get(method)
+      entry = self._entries.pop(key, None)
+      if entry is not None:
+        if entry[1] > time.time():
+          # the most recently used is the last
+          self._entries[key] = entry
+          counters[0] += 1
+          return entry[0], None
+        self._expired += 1
+      if miss and counters:
+        counters[1] += 1
+      return None, (key, self._generation, self._generations.get(method, 0))
+
+  def store(self, token, encoded):
+    """
+    Store the encoded result of a call with the token of its lookup.
+    """
+    key, generation, method_generation = token
+    with self._lock:
+      ttl = self._ttl.get(key[0])
+      if not ttl or generation != self._generation or method_generation != self._generations.get(key[0], 0):
+        # invalidated during the call
+        return
+      self._entries.pop(key, None)
+      self._entries[key] = (encoded, time.time() + ttl)
+      while len(self._entries) > self.max_entries:
+        self._entries.popitem(False)
+        self._evictions += 1
+    return
+
+  def called(self, method):
+    """
+    Drop the results of the methods invalidated by a call of method.
+    """
+    for name in self._invalidates.get(method, ()):
+      self.invalidate(name)
+    return
+
+  def invalidate(self, method=None, params=None):
+    """
+    Drop the results of a call, of all the calls of a method if params is None, of all methods if method is None.
+    """
+    with self._lock:
+      self._invalidations += 1
+      if method is None:
+        self._generation += 1
+        self._entries.clear()
+        return
+      self._generations[method] = self._generations.get(method, 0) + 1
+      if params is not None:
+        self._entries.pop((method, params_key(params)), None)
+      else:
+        for key in [key for key in self._entries if key[0] == method]:
+          del self._entries[key]
+    return
+
+  def stats(self):
+    """
+    Return a dictionary with the number of entries, the counters and the hits and misses per method.
+    """
+    with self._lock:
+      methods = dict((method, {'hits': c[0], 'misses': c[1]}) for method, c in self._methods.items())
+      return {'entries': len(self._entries), 'max_entries': self.max_entries,
+              'hits': sum(c[0] for c in self._methods.values()), 'misses': sum(c[1] for c in self._methods.values()),
+              'expired': self._expired, 'evictions': self._evictions, 'invalidations': self._invalidations,
+              'methods': methods}
+
+class RPCStream(object):
+  """
+  A streaming RPC call: the generator of the method and the flow control state.
+  The partial result seq is sent when at most window partial results are not acknowledged.
+  """
+
+  def __init__(self, id, method, generator, start):
+    self.id = id
+    self.method = method
+    self.generator = generator
+    self.start = start
+    self.acked = -1
+    self.cancelled = False
+    self._cond = threading.Condition(threading.Lock())
+
+  def ack(self, seq):
+    """
+    Record the acknowledgment of the partial results up to seq.
+    """
+    with self._cond:
+      self.acked = max(self.acked, seq)
+      self._cond.notify()
+
+  def cancel(self):
+    with self._cond:
+      self.cancelled = True
+      self._cond.notify()
+
+  def wait(self, seq, window, timeout):
+    """
+    Wait until the partial result seq can be sent, with no window forever. Returns False if the stream
+    is cancelled, or if it is cancelled because no acknowledgment has arrived for timeout seconds.
+    """
+    end = time.time() + timeout
+    with self._cond:
+      while window and seq - self.acked > window and not self.cancelled:
+        left = end - time.time()
+        if left <= 0:
+          self.cancelled = True
+          break
+        self._cond.wait(left)
+      return not self.cancelled
+
+class SendBuffer(object):
+  """
+  The outbound scheduler: a bounded queue of outbound messages in priority lanes, coalesced into one
+  socket write per batch. A background thread writes the telemetry every interval or as soon as max_bytes
+  are queued, the RPC replies and the heartbeats as soon as they are queued. Every batch takes the replies
+  first, then the heartbeats, then the telemetry, so a telemetry burst delays a reply by one batch at most.
+  A message with a topic replaces the unsent message of the same topic, a message with a deadline
+  is dropped if it is not sent in time.
+  Methods exported:
+    SendBuffer(write, interval=0.02, max_bytes=16384, max_queue_bytes=262144) -- Object constructor
+    put(chunk, priority=PRIORITY_TELEMETRY, topic=None, deadline=None) -- Queue an encoded chunk, returns False when the buffer is full
+    flush() -- Write the queued chunks
+    close() -- Flush and stop the flusher thread
+    tune(sock) -- Set the socket options of the connection
+    stats() -- Queue level and counters
+  """
+
+  def __init__(self, write, interval=0.02, max_bytes=16384, max_queue_bytes=262144):
+    """
+    write: function writing strings or byte views to the connection, raises an exception on error
+    interval: maximum delay in seconds of a queued telemetry message
+    max_bytes: queued bytes that trigger a flush before the interval expires, and maximum size of a batch
+    max_queue_bytes: maximum number of queued bytes, telemetry messages over the limit are rejected
+    """
+    self.interval = interval
+    self.max_bytes = max_bytes
+    self.max_queue_bytes = max_queue_bytes
+    self._write = write
+    self._cond = threading.Condition(threading.Lock())
+    self._flush_lock = threading.Lock()   # keeps the batches in order
+    self._lanes = [collections.deque() for i in range(PRIORITY_TELEMETRY + 1)]
+    self._topics = {}                     # topic -> queued entry [parts, size, expiry time, topic]
+    self._bytes = 0
+    self._urgent = False
+    self._closed = False
+    self._high_water = 0
+    self._rejected = 0
+    self._replaced = 0
+    self._expired = 0
+    self._flushes = 0
+    self._failed = 0
+
+    t = threading.Thread(target=self._run)
+    t.daemon = True
+    t.start()
+    return
+
+  def put(self, chunk, priority=PRIORITY_TELEMETRY, topic=None, deadline=None):
+    """
+    Queue an encoded chunk, a string or a tuple of chunk parts.
+    Returns False if the buffer is full and the chunk has been rejected: replies and heartbeats are never rejected.
+    priority: PRIORITY_CONTROL, PRIORITY_HEARTBEAT or PRIORITY_TELEMETRY
+    topic: replace the queued chunk of the same topic, the latest value wins
+    deadline: seconds after which the chunk is dropped if it has not been sent
+    """
+    parts = chunk if isinstance(chunk, tuple) else (chunk,)
+    size = sum(len(part) for part in parts)
+    expires = time.time() + deadline if deadline is not None else None
+    with self._cond:
+      entry = self._topics.get(topic) if topic is not None else None
+      if entry is not None:
+        # the stale sample is not sent, the new one takes its place in the queue
+        self._bytes += size - entry[1]
+        entry[0], entry[1], entry[2] = parts, size, expires
+        self._replaced += 1
+        return True
+      if priority == PRIORITY_TELEMETRY and self._bytes + size > self.max_queue_bytes:
+        self._rejected += 1
+        return False
+      entry = [parts, size, expires, topic]
+      self._lanes[priority].append(entry)
+      if topic is not None:
+        self._topics[topic] = entry
+      self._bytes += size
+      self._high_water = max(self._high_water, self._bytes)
+      if priority != PRIORITY_TELEMETRY:
+        self._urgent = True
+        self._cond.notify()
+      elif self._bytes >= self.max_bytes:
+        self._cond.notify()
+    if priority != PRIORITY_TELEMETRY and self._flush_lock.acquire(False):
+      # no batch is being written: write now rather than waking up the flusher thread
+      try:
+        self._flush()
+      finally:
+        self._flush_lock.release()
     return True
 
+  def flush(self):
+    """
+    Write the queued chunks, in batches of up to max_bytes in priority order.
+    Returns False if a write failed and the chunks of the batch have been dropped.
+    """
+    with self._flush_lock:
+      return self._flush()
+
+  def close(self):
+    """
+    Flush the queued chunks and stop the flusher thread.
+    """
+    with self._cond:
+      self._closed = True
+      self._cond.notify()
+    return
+
+  def tune(self, sock):
+    """
+    Set the socket options of the connection: no Nagle delay, the batches are already coalesced, and at most
+    max_bytes not yet sent in the socket buffer, so the telemetry backlog stays in the lanes where the replies
+    can overtake it.
+    """
+    try:
+      sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      if sys.platform.startswith('linux'):
+        sock.setsockopt(socket.IPPROTO_TCP, TCP_NOTSENT_LOWAT, self.max_bytes)
+    except socket.error, e:
+      pass
+    return
+
+  def stats(self):
+    """
+    Return a dictionary with the queue level and counters.
+    """
+    with self._cond:
+      return {'queued_bytes': self._bytes, 'queued': sum(len(lane) for lane in self._lanes),
+              'queued_replies': len(self._lanes[PRIORITY_CONTROL]), 'max_queue_bytes': self.max_queue_bytes,
+              'high_water': self._high_water, 'rejected': self._rejected, 'replaced': self._replaced,
+              'expired': self._expired, 'flushes': self._flushes, 'failed': self._failed}
+
+  def _flush(self):
+    """
+    Write the batches until the queue is empty. Called with the flush lock held.
+    """
+    ok = True
+    while True:
+      with self._cond:
+        batch = self._batch()
+      if not batch:
+        return ok
+      try:
+        self._write(*coalesce(batch))
+        self._flushes += 1
+      except Exception, e:
+        self._failed += len(batch)
+        ok = False
+
+  def _batch(self):
+    """
+    Take the next batch off the lanes, highest priority first, dropping the expired chunks.
+    Returns the list of the chunk parts. Called with the lock held.
+    """
+    batch = []
+    size = 0
+    now = time.time()
+    for lane in self._lanes:
+      while lane and (size < self.max_bytes or not batch):
+        parts, n, expires, topic = lane.popleft()
+        self._bytes -= n
+        if topic is not None:
+          del self._topics[topic]
+        if expires is not None and now > expires:
+          self._expired += 1
+          continue
+        batch.append(parts)
+        size += n
+    self._urgent = bool(self._lanes[PRIORITY_CONTROL] or self._lanes[PRIORITY_HEARTBEAT])
+    return batch
+
+  def _run(self):
+    """
+    The flusher thread.
+    """
+    while True:
+      with self._cond:
+        if self._bytes < self.max_bytes and not self._urgent and not self._closed:
+          self._cond.wait(self.interval)
+        closed = self._closed
+      self.flush()
+      if closed:
+        return
+
+def coalesce(batch):
+  """
+  Return the parts to write for a batch of chunks: the consecutive small strings joined into one,
+  the large parts as they are.
+  """
+  out = []
+  small = []
+  for parts in batch:
+    for part in parts:
+      if isinstance(part, str) and len(part) <= COPY_THRESHOLD:
+        small.append(part)
+        continue
+      if small:
+        out.append(''.join(small))
+        small = []
+      out.append(part)
+  if small:
+    out.append(''.join(small))
+  return out
+
 class AutonomiaClient(object):
   """
   Connect a device to the Autonomia infrastructure.
   Methods exported:
-    AutonomiaClient(application_key, logger, use_ssl=True) -- Object constructor
-    attach(rpc_methods, device_id=get_mac(), device_info="Automomia-Vehicle") -- Attach the device to the Autonomia cloud server
-    send_data(msg) -- Send a data event message upstream to the Autonomia cloud server
+    AutonomiaClient(application_key, logger, use_ssl=True, server=None, port=None) -- Object constructor
+    attach(rpc_methods, device_id=None, device_info="Automomia-Vehicle", threaded=True) -- Attach the device to the Autonomia cloud server
+    register_method(name, function, cache=None, invalidates=None) -- Add or replace an RPC method
+    unregister_method(name) -- Remove an RPC method
+    invalidate_cache(method=None, params=None) -- Drop cached RPC results
+    cache_stats() -- Hits and misses of the RPC result cache
+    poll(timeout=None) -- Run one iteration of the device I/O loop (when attached with threaded=False)
+    set_worker_pool(size=4, max_queue=64, method_limits=None) -- Run the RPC methods in a pool of worker threads
+    set_send_buffering(interval=0.02, max_bytes=16384, max_queue_bytes=262144) -- Schedule the outbound messages in priority lanes
+    flush() -- Write the buffered send_data messages
+    send_buffer_stats() -- Queue level of the send buffer
+    set_spool(path, size=1048576, drain_rate=50) -- Save the messages that cannot be sent and send them later
+    spool_stats() -- Queued and dropped messages in the spool
+    set_capture(path, max_bytes=67108864) -- Record the raw traffic to replay it offline
+    capture_stats() -- Records written to the capture file
+    set_compression(threshold=64, dictionary='', level=6) -- Compress the data messages and the RPC replies
+    compression_stats() -- Compression ratio and counters
+    enable_metrics(port=None, report_interval=None, report_cb=None, host='127.0.0.1') -- Collect RPC, traffic and connection metrics
+    metrics() -- Snapshot of the metrics
+    worker_pool_stats() -- Queue depth and activity of the worker pool
+    fileno() -- File descriptor of the server connection
+    send_data(msg, topic=None, deadline=None) -- Send a data event message upstream to the Autonomia cloud server
     start_video(timestamp=False) -- Start video streaming to Autonomia cloud
     stop_video() -- Stop video streaming
   """
 
   errors = {0:'ok', 1:'timeout', 2:'network error', 3:'protocol error', 4:'authorization error', 5:'wrong parameters', 9:'internal error'} 
-  _rpc_methods = None
-  
-  def __init__(self, application_key, logger, use_ssl=True):
+
+  def __init__(self, application_key, logger, use_ssl=True, server=None, port=None):
     """
     The Autonomia instance constructor.
 
-    server: the Autonomia server FQDN
-    port: the Autonomia server port
-    application_id: the Autonomia application ID
+    application_key: the Autonomia application key
+    logger: function logging a message string
+    use_ssl: connect with SSL
+    server: the Autonomia server FQDN -- default AUTONOMIA_SERVER
+    port: the Autonomia server port -- default 443 with SSL and 80 without
     """
     self.error = 9
     self.debug = False
     self.device_id = ""
     self.log = logger
 
-    self._server = AUTONOMIA_SERVER
-    self._port =  443 if use_ssl else 80
+    self._server = server or AUTONOMIA_SERVER
+    self._port = port or (443 if use_ssl else 80)
     self._app_key = application_key
     self._use_ssl = use_ssl
     self._message_cb = message_handler # default message handlerNone
+    self._rpc_methods = {}
+    self._pool = None
+    self._send_buffer = None
+    self._spool = None
+    self._spool_topics = collections.OrderedDict()  # topic -> latest message not sent, kept with the spool
+    self._spool_topics_lock = threading.Lock()      # send_data and the drain run in different threads
+    self._capture = None
+    self._cache = None
+    self._metrics = None
+    self._compressor = None
+    self._drain_rate = 50
+    self._next_drain = 0
+    self._streams = {}          # request id -> RPCStream
+    self._streams_lock = threading.Lock()
+
+    # size of a socket read, the receive buffer grows to hold the largest message
+    self.recv_size = 16384
+    # maximum time in seconds to wait for a full socket to accept more data
+    self.write_timeout = 10
+    # maximum time in seconds to connect and attach to the server
+    self.connect_timeout = 10
+    # reconnection delay in seconds, doubled at every failed attempt up to the maximum,
+    # and reduced by a random fraction up to reconnect_jitter
+    self.reconnect_delay = 0.5
+    self.reconnect_max_delay = 30
+    self.reconnect_jitter = 0.5
+    # time in seconds the server address is cached
+    self.dns_ttl = 300
+    # number of reconnections and duration in seconds of the last one
+    self.reconnects = 0
+    self.last_reconnect_time = None
+    # called with the file descriptor of the new connection after a reconnection, i.e. to register it in
+    # the select loop of an application calling poll(): fileno() changes at every reconnection
+    self.reconnect_cb = None
+    # heartbeat interval in seconds -- None for the interval in the server attach reply.
+    # The heartbeat is sent only when nothing else has been sent for the interval
+    self.heartbeat_interval = None
+    # seconds without data or TCP acknowledgments from the server after which the connection is
+    # closed and the reconnection starts -- None for 2.5 heartbeat intervals, 0 to never close.
+    # Where the kernel does not report the acknowledgments only an explicit value is applied
+    self.dead_peer_timeout = None
+    # round-trip time in seconds to the server measured by TCP, None if not available
+    self.rtt = None
+    # maximum number of RPC results in the cache of the methods registered with a cache time to live
+    self.cache_entries = 256
+    # partial results of a streaming RPC method sent ahead of the acknowledgments of the caller (rpc.ack),
+    # 0 to send them as fast as the connection takes them, and seconds to wait for an acknowledgment
+    self.stream_window = 0
+    self.stream_timeout = 30
+    # maximum number of streams running at once, each in its own thread: the calls over the limit are
+    # answered with a server busy error. The method_limits of the worker pool do not cover the streams.
+    self.max_streams = 8
 
     self._platform = ""
-    self._hparser = None
+    self._decoder = None
+    self._dispatch_pending = False
     self._sock = None #socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     self._heartbeat_rate = 60
+    self._next_heartbeat = 0
+    self._next_check = 0
+    self._last_received = 0
     self._trecv = None
-    self._thbeat = None
     self._hb_lock = threading.Lock()
     self._reconnecting = False
+    self._disconnected_at = 0
+    self._retry_at = 0
+    self._attempts = 0
+    self._attach_state = None       # reconnection in progress: connecting, handshake or attaching
+    self._attach_deadline = 0
+    self._attach_want = select.POLLOUT  # socket event the reconnection waits for
+    self._attach_output = ''        # unsent part of the attach request
+    self._dns_cache = None
+    self._ssl_context = None
+    # gateway sessions queue the writes in the output buffer, up to max_output bytes
+    self._gateway = None
+    self._output = None
+    self.max_output = 65536
     return
 
-  def get_mac():
-    """
-    Get the device MAC address. Linux host.
-    """
-    if 'linux' not in sys.platform:
-      from uuid import getnode
-      return getnode()
-    # proper MAC on Linux
-    # try Ethrnet first
-    try:
-      ifname = 'eth0'
-      s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-      info = fcntl.ioctl(s.fileno(), 0x8927, struct.pack('256s', ifname[:15]))
-    except Exception, e:
-      # try WiFi
-      ifname = 'wlan0'
-      s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-      info = fcntl.ioctl(s.fileno(), 0x8927, struct.pack('256s', ifname[:15]))
-
-    return ''.join(['%02X' % ord(char) for char in info[18:24]])
+  get_mac = staticmethod(get_mac)
 
-  def attach(self, rpc_methods, device_id=get_mac(), device_info="ROV"):
+  def attach(self, rpc_methods, device_id=None, device_info="ROV", threaded=True):
     """
     Attach the specified device to the Autonomia cloud server. 
     Authentication is done using only the application_id (one-way authentication).
 
-    rpc_methods: tuple with RPC method callbacks
+    rpc_methods: tuple with RPC method callbacks, i.e. ({'name':'video_start', 'function':_video_start},) -- None to keep the registered methods.
+      The optional 'cache' and 'invalidates' keys are the arguments of register_method()
     device_id: the device unique identifier -- default is device's MAC address
     device_info: a description of the platform or the device (used only as a comment)
+    threaded: start the I/O thread -- if False the application drives the client calling poll()
     """
+    if device_id is None:
+      device_id = get_mac()
     self.device_id = device_id
     self._platform = device_info
-    self._hparser = HttpParser()
-    AutonomiaClient._rpc_methods = rpc_methods
-    print '-----------in attach'
-    print AutonomiaClient._rpc_methods
+    self._decoder = ChunkDecoder(2 * self.recv_size)
+    if rpc_methods is not None:
+      self._rpc_methods = dict((m['name'], m['function']) for m in rpc_methods)
+      for m in rpc_methods:
+        if m.get('cache') or m.get('invalidates'):
+          self._rpc_cache().configure(m['name'], m.get('cache'), m.get('invalidates'))
 
-    tsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    if self._use_ssl:
-      self._sock = ssl.wrap_socket(tsock, ssl_version=ssl.PROTOCOL_SSLv23,  ciphers="AES256-GCM-SHA384")
-    else:
-      self._sock = tsock
     try:
-      self._sock.connect((self._server, self._port))
-      sendBuf="POST /v1/applications/%s/devices/%s HTTP/1.1\r\nHost: api.autonomia.io\r\nContent-Length:%d\r\n\r\n%s" % (self._app_key,device_id,len(device_info),device_info)
-      self._sock.send(sendBuf)
+      sock = self._connect()
+      request = self._attach_request()
+      # the replies of the workers are refused until the attach reply, see _write
+      with self._hb_lock:
+        self._sock = sock
+        if self._capture:
+          self._capture.connect()
+          self._capture.outbound(request)
+        self._sock.send(request)
       recvBuf = ""
       while True:
-        data = self._sock.recv(1024)
-        if not data:
+        if self._recv() == 0:
           break
 
-        dataLen = len(data)
-        nparsed = self._hparser.execute(data, dataLen)
-        assert nparsed == dataLen
-
-        if self._hparser.is_headers_complete():
-          if self.debug:
-            print "connection for device %s headers received" % (device_id)
-            print self._hparser.get_headers()
+        # the first chunk is the attach reply, the following messages stay in the buffer
+        recvBuf = self._decoder.next_message()
+        if self._decoder.headers is not None and self.debug:
+          print "connection for device %s headers received" % (device_id)
+          print self._decoder.status, self._decoder.headers
 
-        if self._hparser.is_partial_body():
-          recvBuf = self._hparser.recv_body()
-          if self.debug:
-            print "connection for device %s body received" % (device_id)
-            print recvBuf         
-          #TODO: check for error in connecting, i.e. 403 already connected
-
-          # reading the attach complete message from the server  
-          # i.e. {"msg":"200 OK","heartbeat":60,"timestamp":1441382935}
-          if len(recvBuf) < 16 or recvBuf[1:12] != '"msg":"200"':
-            self.error = 5
-            print "Error in string from server; %s" % recvBuf
+        if recvBuf is not None:
+          if not self._attach_reply(recvBuf):
             return recvBuf
 
-          # reset error
-          self.error = 0
-
-          # set the socket non blocking
-          self._sock.setblocking(0) 
-
           # do not (re)start the threads during a reconnection
           if self._reconnecting:
             self._reconnecting = False
@@ -249,183 +1027,1670 @@ class AutonomiaClient(object):
 
           if self.debug:
             print "connection for device %s completed" % (device_id)
-                      # start the hearbeat thread
-          self._thbeat = threading.Thread(target=self._heartbeat)
-          self._thbeat.daemon = True
-          self._thbeat.start()
-            
-          # start the receive thread
-          #time.sleep(2)
+
+          if not threaded:
+            return recvBuf
+
+          # start the I/O thread, it also sends the heartbeats
           self._trecv = threading.Thread(target=self._receive)
           self._trecv.daemon = True # force to exit on SIGINT
           self._trecv.start()
           return recvBuf
     except Exception, e:
       print e
-      self.error = 2
-      return
+    # connection closed or failed before the attach reply
+    self.error = 2
+    if self._sock:
+      self._sock.close()
+    return
 
-  def send_data(self, msg):
+  def _attach_request(self):
     """
-    Send a data event message upstream to the Autonomia cloud server.
-    The Autonomia server propagates the message to all open devices Websockets. 
+    Return the attach HTTP request.
     """
-    sendBuf = "%x\r\n%c%s\r\n" % (len(msg) + 1,'\07',msg)
-    if self._reconnecting:
-      if self.debug:
-        print "Error in Autonomia.send_data(): device is reconnecting."
-      return -1
+    return "POST /v1/applications/%s/devices/%s HTTP/1.1\r\nHost: api.autonomia.io\r\nContent-Length:%d\r\n\r\n%s" % (self._app_key,self.device_id,len(self._platform),self._platform)
+
+  def _attach_reply(self, recvBuf):
+    """
+    Check the attach reply of the server and make the connection ready for the I/O loop.
+    Returns False and closes the connection if the attach has been refused.
+    """
+    if self.debug:
+      print "connection for device %s body received" % (self.device_id)
+      print recvBuf         
+    #TODO: check for error in connecting, i.e. 403 already connected
+
+    # reading the attach complete message from the server  
+    # i.e. {"msg":"200 OK","heartbeat":60,"timestamp":1441382935}
+    if len(recvBuf) < 16 or recvBuf[1:12] != '"msg":"200"':
+      self.error = 5
+      print "Error in string from server; %s" % recvBuf
+      self._sock.close()
+      return False
+
+    # reset error
+    self.error = 0
+
+    # the heartbeat interval returned by the server
+    try:
+      interval = jsoncodec.loads(recvBuf).get('heartbeat')
+    except (ValueError, AttributeError):
+      interval = None
+    if not isinstance(interval, (int, long, float)) or interval <= 0:
+      interval = 60
+    self._heartbeat_rate = self.heartbeat_interval or interval
+
+    # set the socket non blocking
+    self._sock.setblocking(0) 
+    now = time.time()
+    self._next_heartbeat = now + self._heartbeat_rate
+    self._next_check = now + PEER_CHECK_INTERVAL
+    self._last_received = now
+    # messages received together with the attach reply
+    self._dispatch_pending = True
+    return True
+
+  def _connect(self):
+    """
+    Open the connection to the Autonomia server using the cached server address.
+    The SSL context is created once and reused by the reconnections.
+    """
+    global ssl
+    family, socktype, proto, canonname, address = self._resolve()
+    tsock = socket.socket(family, socktype, proto)
+    tsock.settimeout(self.connect_timeout)
+    if self._send_buffer:
+      self._send_buffer.tune(tsock)
+    if self._use_ssl:
+      if self._ssl_context is None:
+        import ssl
+        self._ssl_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        self._ssl_context.set_ciphers("AES256-GCM-SHA384")
+      sock = self._ssl_context.wrap_socket(tsock)
+    else:
+      sock = tsock
     try:
-      self._hb_lock.acquire()
-      self._sock.send(sendBuf)
-      self._hb_lock.release()     
+      sock.connect(address)
     except Exception, e:
-      if self.debug:
-        print "Error in Autonomia.send_data(): socket write failed."
-      return -1
-    return 0
+      sock.close()
+      # the server may have moved
+      self._dns_cache = None
+      raise
+    return sock
 
-  def bind_cb(self, message_cb):
+  def _connect_nonblocking(self):
     """
-    Binds the specified user callback to the Autonomia instance.
+    Start a non-blocking connection to the Autonomia server: the socket becomes writable when connected,
+    SO_ERROR tells if the connection failed. The SSL context is created once, the handshake is left to
+    _handshake(). Raises socket.error if the connection cannot be started.
     """
-    self._message_cb = message_cb
-    return
+    global ssl
+    family, socktype, proto, canonname, address = self._resolve()
+    if self._use_ssl and self._ssl_context is None:
+      import ssl
+      self._ssl_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+      self._ssl_context.set_ciphers("AES256-GCM-SHA384")
+    sock = socket.socket(family, socktype, proto)
+    if self._send_buffer:
+      self._send_buffer.tune(sock)
+    sock.setblocking(0)
+    err = sock.connect_ex(address)
+    if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+      sock.close()
+      # the server may have moved
+      self._dns_cache = None
+      raise socket.error(err, os.strerror(err))
+    return sock
 
-  def perror(self):
+  def _handshake(self):
     """
-    Return a string for the current error.
+    Continue the SSL handshake of a non-blocking connection. Returns None when completed,
+    else the event to wait for, select.POLLIN or select.POLLOUT. Raises socket.error on error.
     """
-    return AutonomiaClient.errors[self.error]
+    try:
+      self._sock.do_handshake()
+    except ssl.SSLError, e:
+      if e.errno == ssl.SSL_ERROR_WANT_READ:
+        return select.POLLIN
+      if e.errno == ssl.SSL_ERROR_WANT_WRITE:
+        return select.POLLOUT
+      raise
+    return None
 
-  def _heartbeat(self):
+  def _resolve(self):
     """
-    The heartbeat thread.
-    The hearbeat message is a chunk of length 3 with the MSG_HEARBEAT byte and closed with CRLF.
-    This thread detects a server disconnection and attempts to reconnect to the Autonomia server.
+    Return the server address, resolved at most every dns_ttl seconds.
+    When the name cannot be resolved the last known address is used.
     """
-    if self.debug:
-      print "Hearbeat thread started.\r"
-        
-    while True:
-      time.sleep(self._heartbeat_rate)
-      if self._reconnecting:
-        print "--- heartbeat while reconnecting"
-        continue  
-      sendBuf = "1\r\n%c\r\n" % '\06'
-      self.log("sending heartbeat")
+    now = time.time()
+    if self._dns_cache and now < self._dns_cache[0]:
+      return self._dns_cache[1]
+    try:
+      address = socket.getaddrinfo(self._server, self._port, 0, socket.SOCK_STREAM)[0]
+    except socket.gaierror, e:
+      if self._dns_cache:
+        return self._dns_cache[1]
+      raise
+    self._dns_cache = (now + self.dns_ttl, address)
+    return address
+
+  def send_data(self, msg, topic=None, deadline=None):
+    """
+    Send a data event message upstream to the Autonomia cloud server.
+    The Autonomia server propagates the message to all open devices Websockets. 
+    The message is a string or a buffer object: bytearray, memoryview, mmap, array or NumPy array.
+    A large message is sent from the buffer without copies, in slices of at most SEND_SLICE bytes.
+    With the send buffer the message is queued as a copy, so the caller can reuse its buffer on return.
+    Returns 0 on success, -1 on error and -2 if the message is rejected because the send buffer is full.
+    With a spool, a message that cannot be sent is saved to be sent later and 1 is returned:
+    of the messages of a topic only the latest is saved, a message with a deadline is not saved.
+    topic and deadline apply with the send buffer, see set_send_buffering:
+    topic: a queued message of the same topic not yet sent is replaced by this one, i.e. 'gps'
+    deadline: seconds after which the message is dropped if it has not been sent
+    """
+    msg = byte_view(msg)
+    if self._reconnecting:
+      if self.debug:
+        print "Error in Autonomia.send_data(): device is reconnecting."
+      return self._spool_message(msg, -1, topic, deadline)
+    ret = self._send_data_chunk(msg, topic, deadline)
+    if ret != 0:
+      if self._metrics:
+        self._metrics.count('send_data_failures')
+      return self._spool_message(msg, ret, topic, deadline)
+    return 0
+
+  def _send_data_chunk(self, msg, topic=None, deadline=None):
+    """
+    Send or buffer a data message. Returns 0 on success, -1 on error and -2 if the send buffer is full.
+    """
+    parts = self._chunk(msg, '\07')
+    if self._send_buffer:
+      if len(parts) > 1:
+        # the buffer of the caller may be reused once send_data returns: queue a copy of the payload
+        parts = (parts[0], view_bytes(parts[1]), parts[2])
+      if not self._send_buffer.put(parts, PRIORITY_TELEMETRY, topic, deadline):
+        if self.debug:
+          print "Error in Autonomia.send_data(): send buffer full."
+        return -2
+    else:
       try:
-        self._hb_lock.acquire()
-        self._sock.send(sendBuf)
-        self._hb_lock.release()
+        self._write(*parts)
       except Exception, e:
-        print "--- error sending heartbeat"
+        if getattr(e, 'errno', None) == errno.ENOBUFS:
+          # gateway session output buffer full
+          return -2
+        if self.debug:
+          print "Error in Autonomia.send_data(): socket write failed."
+        return -1
+    if self._metrics:
+      self._metrics.count('data_sent')
+    return 0
+
+  def _chunk(self, payload, marker=''):
+    """
+    Return the chunk parts of a message, compressed when compression is enabled and the message gets shorter.
+    """
+    compressor = self._compressor
+    if compressor is not None and len(payload) + len(marker) >= compressor.threshold:
+      # zlib does not read memoryviews
+      compressed = compressor.compress(payload.tobytes() if isinstance(payload, memoryview) else payload, marker)
+      if compressed is not None:
+        return chunk_parts(compressed)
+    return chunk_parts(payload, marker)
+
+  def _spool_message(self, msg, error, topic=None, deadline=None):
+    """
+    Save a message that cannot be sent in the spool. Returns 1 if saved or the error.
+    A message with a deadline would be stale when the spool is drained and is not saved,
+    a message with a topic replaces the saved message of the topic, the latest value wins.
+    """
+    if self._spool is None or deadline is not None:
+      return error
+    if topic is not None:
+      msg = view_bytes(msg)
+      with self._spool_topics_lock:
+        self._spool_topics.pop(topic, None)
+        self._spool_topics[topic] = msg
+    elif not self._spool.put(view_bytes(msg)):
+      # larger than the spool
+      return error
+    return 1
+
+  def set_spool(self, path, size=1048576, drain_rate=50):
+    """
+    Save in a persistent ring buffer the send_data messages that cannot be sent, during a reconnection
+    or when the send buffer is full. The saved messages are sent after the device is attached again,
+    at most drain_rate messages per second. When the spool is full the oldest messages are dropped.
+
+    path: spool file name -- None to stop using the spool
+    size: size of the spool in bytes
+    drain_rate: maximum number of saved messages sent per second
+    """
+    if self._spool is not None:
+      self._spool.close()
+    with self._spool_topics_lock:
+      self._spool_topics.clear()
+    if path:
+      from spool import MessageSpool
+      self._spool = MessageSpool(path, size)
+    else:
+      self._spool = None
+    self._drain_rate = drain_rate
+    self._next_drain = time.time()
+    return
+
+  def set_capture(self, path, max_bytes=67108864):
+    """
+    Record the raw traffic of the connection in a capture file: the data received as read from the socket
+    and the data written, with monotonic timestamps. The capture starts with the next connection or
+    reconnection, replay it with benchmarks/replay.py. The capture stops when the file reaches max_bytes.
+
+    path: capture file name -- None to stop the capture
+    max_bytes: maximum size of the capture file
+    """
+    if self._capture is not None:
+      self._capture.close()
+    if path:
+      from capture import CaptureWriter
+      self._capture = CaptureWriter(path, max_bytes)
+    else:
+      self._capture = None
+    return
+
+  def capture_stats(self):
+    """
+    Return the records written and dropped and the size of the capture file, or None if not capturing.
+    """
+    if not self._capture:
+      return None
+    return self._capture.stats()
+
+  def set_compression(self, threshold=64, dictionary='', level=6):
+    """
+    Compress with deflate the data messages and the RPC replies of at least threshold bytes.
+    Every message is compressed on its own, starting from the preset dictionary shared with the receiver,
+    and is marked by a leading MSG_COMPRESSED byte. A message that does not get shorter is sent raw.
+
+    threshold: minimum size in bytes of a compressed message -- None to stop compressing
+    dictionary: content frequent in the messages, i.e. compression.sample_dictionary(messages)
+    level: zlib compression level, 1 (fastest) to 9 (smallest)
+    """
+    if threshold is None:
+      self._compressor = None
+      return
+    from compression import MessageCompressor
+    self._compressor = MessageCompressor(dictionary, level, threshold)
+    return
+
+  def compression_stats(self):
+    """
+    Return the compression counters and ratio, or None if compression is not enabled.
+    """
+    if self._compressor is None:
+      return None
+    return self._compressor.stats()
+
+  def enable_metrics(self, port=None, report_interval=None, report_cb=None, host='127.0.0.1'):
+    """
+    Collect the RPC calls, traffic and connection metrics. Without metrics the SDK does no accounting.
+
+    port: serve the metrics in the Prometheus text format at http://host:port/metrics
+    host: address the metrics are served on -- '' for all the interfaces of the device
+    report_interval: call report_cb with the metrics snapshot every report_interval seconds
+    report_cb: function receiving the metrics snapshot dictionary
+    """
+    if not self._metrics:
+      from metrics import Metrics
+      self._metrics = Metrics()
+    if port:
+      self._metrics.serve(port, host)
+    if report_interval and report_cb:
+      self._metrics.report(report_interval, report_cb)
+    return
+
+  def metrics(self):
+    """
+    Return a snapshot of the metrics, or None if not enabled. The dictionary contains:
+    the traffic counters, send_data failures, reconnections and their duration, the seconds since
+    the last data received from the server, and for every RPC method the calls, errors and latency histogram.
+    """
+    if not self._metrics:
+      return None
+    return self._metrics.snapshot()
+
+  def spool_stats(self):
+    """
+    Return the number of queued and dropped messages in the spool and of the topics with a saved message,
+    or None if not in use.
+    """
+    if self._spool is None:
+      return None
+    stats = self._spool.stats()
+    with self._spool_topics_lock:
+      stats['topics'] = len(self._spool_topics)
+    return stats
+
+  def register_method(self, name, function, cache=None, invalidates=None):
+    """
+    Add or replace an RPC method. It can be called at any time, also after attach().
+
+    cache: seconds the results of a read-only method are reused for the calls with the same params
+    invalidates: names of the methods whose cached results are dropped when this method is called
+    """
+    if cache or invalidates or self._cache:
+      self._rpc_cache().configure(name, cache, invalidates)
+    methods = dict(self._rpc_methods)
+    methods[name] = function
+    # replace the registry as a whole, the I/O thread and the workers only read it
+    self._rpc_methods = methods
+    return
+
+  def unregister_method(self, name):
+    """
+    Remove an RPC method. Returns False if the method is not registered.
+    """
+    if name not in self._rpc_methods:
+      return False
+    methods = dict(self._rpc_methods)
+    del methods[name]
+    self._rpc_methods = methods
+    if self._cache:
+      self._cache.configure(name, None)
+    return True
+
+  def invalidate_cache(self, method=None, params=None):
+    """
+    Drop the cached results of a call, of all the calls of a method if params is None,
+    of all the methods if method is None. To call when the device state read by the methods changes.
+    """
+    if self._cache:
+      self._cache.invalidate(method, params)
+    return
+
+  def cache_stats(self):
+    """
+    Return the entries and the hit, miss and eviction counters of the RPC result cache, or None if not in use.
+    """
+    if not self._cache:
+      return None
+    return self._cache.stats()
+
+  def _rpc_cache(self):
+    """
+    Return the RPC result cache, created at the first method with a cache.
+    """
+    if self._cache is None:
+      self._cache = RPCCache(self.cache_entries)
+    return self._cache
+
+  def bind_cb(self, message_cb):
+    """
+    Binds the specified user callback to the Autonomia instance.
+    """
+    self._message_cb = message_cb
+    return
+
+  def set_send_buffering(self, interval=0.02, max_bytes=16384, max_queue_bytes=262144):
+    """
+    Queue the outbound messages in priority lanes and write them together: the RPC replies first,
+    then the heartbeats, then the send_data messages, once every interval or when max_bytes are queued.
+    The replies and the heartbeats are written at once, ahead of the queued telemetry.
+    When max_queue_bytes are queued send_data rejects the messages and returns -2.
+    The topic and deadline of send_data bound the queued telemetry: latest value per topic and maximum age.
+
+    interval: maximum delay in seconds of a message -- 0 to write every message immediately
+    max_bytes: queued bytes that trigger a write before the interval expires, and maximum bytes per write
+    max_queue_bytes: maximum number of queued bytes
+    """
+    if self._send_buffer:
+      self._send_buffer.close()
+    self._send_buffer = SendBuffer(self._write, interval, max_bytes, max_queue_bytes) if interval > 0 else None
+    if self._send_buffer and self._sock:
+      self._send_buffer.tune(self._sock)
+    return
+
+  def flush(self):
+    """
+    Write the buffered send_data messages. Returns 0 on success and -1 on error.
+    """
+    if self._send_buffer and not self._send_buffer.flush():
+      return -1
+    return 0
+
+  def send_buffer_stats(self):
+    """
+    Return the queue level and counters of the send buffer, or None if not in use.
+    """
+    if not self._send_buffer:
+      return None
+    return self._send_buffer.stats()
+
+  def set_worker_pool(self, size=4, max_queue=64, method_limits=None):
+    """
+    Run the RPC methods in a bounded pool of worker threads instead of the I/O thread.
+    The replies are sent as the methods complete and matched to the requests by the JSON-RPC id.
+    A request received when max_queue requests are waiting is answered with a server busy error.
+
+    size: number of worker threads -- 0 to run the methods in the I/O thread
+    max_queue: maximum number of requests waiting for a worker
+    method_limits: dictionary of method name to the maximum number of concurrent calls, i.e. {'camera_config': 1}
+    """
+    self._pool = RPCWorkerPool(size, max_queue, method_limits) if size > 0 else None
+    return
+
+  def worker_pool_stats(self):
+    """
+    Return the queue depth and activity counters of the worker pool, or None if not in use.
+    """
+    if not self._pool:
+      return None
+    return self._pool.stats()
+
+  def perror(self):
+    """
+    Return a string for the current error.
+    """
+    return AutonomiaClient.errors[self.error]
+
+  def fileno(self):
+    """
+    Return the file descriptor of the server connection, for use in an application select loop.
+    The descriptor changes at every reconnection, see reconnect_cb.
+    """
+    return self._sock.fileno()
+
+  def poll(self, timeout=None):
+    """
+    Run one iteration of the device I/O loop.
+    Waits for server traffic for at most timeout seconds or until the next heartbeat is due,
+    dispatches a received RPC message and sends the heartbeat when due.
+    With attach(..., threaded=False) the application calls poll() from its own loop,
+    so that the SDK and the application share one thread.
+    A reconnection does not block: every poll() advances the connection, the SSL handshake and the attach
+    for at most timeout seconds. The first attach() blocks, up to connect_timeout for every step, and a write
+    to a full socket, a reply or send_data without the send buffer, blocks up to write_timeout.
+    """
+    if self._reconnecting:
+      self._retry_attach(timeout)
+      return
+
+    now = time.time()
+    wait = self._keepalive(now) - now
+    if self._reconnecting:
+      return
+    if self._spool is not None and self._spooled() and not self._reconnecting:
+      if now >= self._next_drain:
+        self._drain_spool()
+        self._next_drain = now + DRAIN_INTERVAL
+      wait = min(wait, self._next_drain - now)
+    if timeout is not None and timeout < wait:
+      wait = timeout
+    # data already decrypted and buffered in the SSL layer does not make the socket readable
+    if self._dispatch_pending or (self._use_ssl and self._sock.pending()):
+      wait = 0
+    ready_to_read, ready_to_write, in_error = select.select([self._sock.fileno()],[],[self._sock.fileno()], max(wait, 0))
+
+    if in_error:
+      # handle errors as disconnections and try to reconnect to the server
+      print "Network error in receive loop (error). Reconnecting..."
+      self._disconnect()
+      return
+
+    if ready_to_read or (self._use_ssl and self._sock.pending()):
+      self._read()
+    elif self._dispatch_pending:
+      self._dispatch_messages()
+    return
+
+  def run_forever(self):
+    """
+    Run the device I/O loop until the process exits.
+    """
+    while True:
+      self.poll()
+
+  def _keepalive(self, now):
+    """
+    Send the heartbeat if nothing has been sent for the heartbeat interval, measure the round-trip time
+    and close the connection when the server has been silent for dead_peer_timeout.
+    Returns the time of the next keepalive action.
+    """
+    if now >= self._next_heartbeat:
+      self._heartbeat()
+      # a successful write has already moved the next heartbeat
+      self._next_heartbeat = max(self._next_heartbeat, now + self._heartbeat_rate)
+
+    if now >= self._next_check:
+      self._next_check = now + PEER_CHECK_INTERVAL
+      info = tcp_info(self._sock)
+      silence = now - self._last_received
+      timeout = self.dead_peer_timeout
+      if info:
+        self.rtt, since_ack = info
+        silence = min(silence, since_ack)
+        if timeout is None:
+          timeout = 2.5 * self._heartbeat_rate
+        if self._metrics:
+          self._metrics.gauge('rtt_seconds', self.rtt)
+      if timeout and silence > timeout:
+        print "Network error in receive loop (server silent for %.1f s). Reconnecting..." % silence
+        if self._metrics:
+          self._metrics.count('dead_peers')
+        self._disconnect()
+    return min(self._next_heartbeat, self._next_check)
+
+  def _heartbeat(self):
+    """
+    Send the heartbeat message.
+    The hearbeat message is a chunk of length 3 with the MSG_HEARBEAT byte and closed with CRLF.
+    """
+    if self._reconnecting:
+      print "--- heartbeat while reconnecting"
+      return
+    sendBuf = "1\r\n%c\r\n" % '\06'
+    self.log("sending heartbeat")
+    try:
+      if self._send_buffer:
+        self._send_buffer.put(sendBuf, PRIORITY_HEARTBEAT)
+      else:
+        self._write(sendBuf)
+      if self._metrics:
+        self._metrics.count('heartbeats_sent')
+    except Exception, e:
+      print "--- error sending heartbeat"
+
+  def _spooled(self):
+    """
+    Return the number of messages saved in the spool and of the topics with a saved message.
+    """
+    with self._spool_topics_lock:
+      return len(self._spool) + len(self._spool_topics)
+
+  def _drain_spool(self):
+    """
+    Send the messages saved in the spool, at most drain_rate per second: the latest messages
+    of the topics first, with their topic, then the spooled messages in order.
+    """
+    for i in range(max(1, int(self._drain_rate * DRAIN_INTERVAL))):
+      with self._spool_topics_lock:
+        saved = next(self._spool_topics.iteritems()) if self._spool_topics else None
+      if saved:
+        topic, msg = saved
+        if self._send_data_chunk(msg, topic) != 0:
+          break
+        with self._spool_topics_lock:
+          # unless send_data has saved a newer message of the topic meanwhile
+          if self._spool_topics.get(topic) is msg:
+            del self._spool_topics[topic]
+        continue
+      head = self._spool.head()
+      if head is None:
+        break
+      position, msg = head
+      if self._send_data_chunk(msg) != 0:
+        # retry at the next interval
+        break
+      # unless put() has evicted the message meanwhile
+      self._spool.pop(position)
+    return
+
+  def _disconnect(self):
+    """
+    Close the server connection after a network error and schedule the reconnection.
+    """
+    try:
+      self._sock.close()
+    except Exception, e:
+      print "--- exception in close socket."
+    now = time.time()
+    self._reconnecting = True
+    self._disconnected_at = now
+    self._attempts = 0
+    self._retry_at = now + self._backoff_delay()
+    return
+
+  def _backoff_delay(self):
+    """
+    Return the delay before the next attach attempt, exponential in the failed attempts with random jitter.
+    """
+    import random
+    delay = min(self.reconnect_max_delay, self.reconnect_delay * (2 ** self._attempts))
+    return delay * (1 - self.reconnect_jitter * random.random())
+
+  def _retry_attach(self, timeout):
+    """
+    Attach again to the Autonomia server when the reconnection delay has expired, without blocking
+    for more than timeout seconds: the connection, the SSL handshake and the attach are the steps
+    of a non-blocking reconnection, as for the sessions of AutonomiaGateway.
+    """
+    if self._attach_state is None:
+      now = time.time()
+      if now < self._retry_at:
+        wait = self._retry_at - now
+        time.sleep(wait if timeout is None else min(wait, timeout))
+        return
+      try:
+        sock = self._connect_nonblocking()
+      except socket.error, e:
+        self._attach_failed(e)
         return
+      with self._hb_lock:
+        self._sock = sock
+      self._decoder = ChunkDecoder(2 * self.recv_size)
+      self._attach_state = 'connecting'
+      self._attach_want = select.POLLOUT
+      self._attach_deadline = now + self.connect_timeout
+
+    wait = self._attach_deadline - time.time()
+    if wait <= 0:
+      self._attach_failed("timeout")
+      return
+    if timeout is not None:
+      wait = min(wait, timeout)
+    # data already decrypted and buffered in the SSL layer does not make the socket readable
+    if not (self._use_ssl and self._attach_state == 'attaching' and self._sock.pending()):
+      fd = self._sock.fileno()
+      reading = self._attach_want == select.POLLIN
+      ready_to_read, ready_to_write, in_error = select.select([fd] if reading else [], [] if reading else [fd], [fd], wait)
+      if not (ready_to_read or ready_to_write or in_error):
+        return
+    try:
+      self._attach_step()
+    except (socket.error, ValueError), e:
+      self._attach_failed(e)
+    return
+
+  def _attach_step(self):
+    """
+    Advance the reconnection after a socket event. Raises socket.error or ValueError on failure.
+    """
+    if self._attach_state == 'connecting':
+      err = self._sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+      if err:
+        self._dns_cache = None
+        raise socket.error(err, os.strerror(err))
+      if not self._use_ssl:
+        self._send_attach_request()
+        return
+      with self._hb_lock:
+        self._sock = self._ssl_context.wrap_socket(self._sock, do_handshake_on_connect=False)
+      self._attach_state = 'handshake'
+    if self._attach_state == 'handshake':
+      want = self._handshake()
+      if want:
+        self._attach_want = want
+        return
+      self._send_attach_request()
+      return
+    if self._attach_output:
+      self._send_attach_output()
+      return
+
+    try:
+      n = self._recv()
+    except socket.error, e:
+      if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK) or \
+         (self._use_ssl and isinstance(e, ssl.SSLError) and e.errno == ssl.SSL_ERROR_WANT_READ):
+        return
+      raise
+    if n == 0:
+      raise socket.error(errno.ECONNRESET, "connection closed")
+    reply = self._decoder.next_message()
+    if reply is None:
+      return
+    self._attach_state = None
+    if not self._attach_reply(reply):
+      # refused, the connection is closed
+      self._attach_failed("attach refused", True)
+      return
+    self._reconnecting = False
+    self.reconnects += 1
+    self.last_reconnect_time = time.time() - self._disconnected_at
+    if self._metrics:
+      self._metrics.reconnected(self.last_reconnect_time)
+    print "Device attached to Autonomia in %.3f s." % self.last_reconnect_time, reply
+    if self.reconnect_cb:
+      self.reconnect_cb(self._sock.fileno())
+    return
+
+  def _send_attach_request(self):
+    """
+    Start sending the attach request of the reconnection.
+    """
+    request = self._attach_request()
+    if self._capture:
+      self._capture.connect()
+      self._capture.outbound(request)
+    self._attach_state = 'attaching'
+    self._attach_output = request
+    self._send_attach_output()
+    return
+
+  def _send_attach_output(self):
+    """
+    Send what the socket accepts of the attach request, then wait for the attach reply.
+    """
+    try:
+      n = self._sock.send(self._attach_output)
+    except socket.error, e:
+      if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK) and \
+         not (self._use_ssl and isinstance(e, ssl.SSLError) and e.errno == ssl.SSL_ERROR_WANT_WRITE):
+        raise
+      n = 0
+    self._attach_output = self._attach_output[n:]
+    self._attach_want = select.POLLOUT if self._attach_output else select.POLLIN
+    return
+
+  def _attach_failed(self, reason, refused=False):
+    """
+    A reconnection attempt failed: close the connection and schedule the next attempt with the backoff delay.
+    """
+    if self.debug:
+      print "Error in attaching device %s: %s" % (self.device_id, reason)
+    if self._attach_state is not None:
+      self._attach_state = None
+      self._attach_output = ''
+      try:
+        self._sock.close()
+      except Exception, e:
+        pass
+    if not refused:
+      # the attach reply has set the error of a refusal
+      self.error = 2
+    self._attempts += 1
+    delay = self._backoff_delay()
+    self._retry_at = time.time() + delay
+    print "Error in attaching to Autonomia. %s, retrying in %.1f s" % (self.perror(), delay)
+    return
 
   def _receive(self):
     """
-    The receive and user callback dispatch loop thread.
+    The I/O thread: runs the receive, user callback dispatch and heartbeat loop.
     """
     if self.debug:
       print "Receive thread started.\r"
-    while True:
-      ready_to_read, ready_to_write, in_error = select.select([self._sock.fileno()],[],[self._sock.fileno()], 15)
+    self.run_forever()
 
-      # check for timeout
-      if not (ready_to_read or ready_to_write or in_error):
-        continue
+  def _read(self):
+    """
+    Read from the server connection and dispatch the received messages to the user callback.
+    """
+    try:
+      n = self._recv()
+    except socket.error, e:
+      # ssl read may return no data, ssl.SSLError is a socket.error
+      if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK) or \
+         (self._use_ssl and isinstance(e, ssl.SSLError) and e.errno == ssl.SSL_ERROR_WANT_READ):
+        return
+      print e
+      n = 0
 
-      for i in in_error:
-        # handle errors as disconnections and try to reconnect to the server
-        print "Network error in receive loop (error). Reconnecting..."
-        self._sock.close()
-        # self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._reconnecting = True
-        ret = self.attach(self.rpc_methods, self.device_id, self._platform)
-        if self.error != 0:
-          print "Error in attaching to Autonomia.", self.perror()
-          time.sleep(15)
-          continue
-        else:
-          print "Device attached to Autonomia.", ret
-        continue
+    if n == 0:
+      # handle errors as disconnections and try to reconnect to the server
+      print "Network error in receive loop (no data). Reconnecting..."
+      self._disconnect()
+      return
 
-      data = None
-      for i in ready_to_read:
-        try:
-          data = self._sock.recv(1024)
-        except Exception, e:
-          print e
-          pass
+    self._last_received = time.time()
+    if self._metrics:
+      self._metrics.received(n)
+    if self.debug:
+      print "** received: %d bytes" % n
+    self._dispatch_messages()
+    return
 
-      if not data:
-        if self._use_ssl:
-          # ssl read may return no data
-          continue
-          
-        # handle errors as disconnections and try to reconnect to the server
-        print "Network error in receive loop (no data). Reconnecting..."
+  def _recv(self):
+    """
+    Receive from the server connection into the decoder buffer. Returns the number of bytes received.
+    """
+    n = self._decoder.recv_into(self._sock, self.recv_size)
+    if n and self._capture:
+      self._capture.inbound(self._decoder.tail(n))
+    return n
+
+  def _dispatch_messages(self):
+    """
+    Dispatch every complete message in the receive buffer to the user callback.
+    """
+    self._dispatch_pending = False
+    try:
+      for to_send in self._decoder.messages():
+        self._dispatch(to_send)
+    except ValueError, e:
+      # not a chunked message stream
+      print "Protocol error in receive loop (%s). Reconnecting..." % e
+      self._disconnect()
+    return
+
+  def _dispatch(self, to_send):
+    """
+    Invoke the user callback for a message and send back the reply.
+    """
+    # the payload contains a HTTP chunk
+    if self._metrics:
+      self._metrics.count('messages_received')
+    if self._pool and self._message_cb:
+      self._dispatch_to_pool(to_send)
+      return
+    if self._message_cb:
+      # invoke the user callback
+      reply = self._call_message_cb(to_send)
+    else:
+      reply = ""
+    if self.debug:
+      print "After callback."
+      print "Returning result."
+    self._send_reply(reply)
+    return
+
+  def _call_message_cb(self, msg):
+    """
+    Invoke the message callback, the default handler dispatches to the registered RPC methods.
+    """
+    if self._message_cb is message_handler:
+      req, error = parse_rpc_msg(msg)
+      if error:
+        return error
+      if isinstance(req, dict) and req['method'] in STREAM_METHODS:
+        return self._stream_control(req)
+      return dispatch_rpc(req, self._rpc_methods, self._metrics, self._start_stream, self._cache)
+    return self._message_cb(msg, len(msg))
+
+  def _dispatch_to_pool(self, msg):
+    """
+    Queue the RPC message to the worker pool. The worker sends the reply.
+    """
+    if self._message_cb is message_handler:
+      # validate in the I/O thread to apply the per-method limits
+      req, error = parse_rpc_msg(msg)
+      if error:
+        self._send_reply(error)
+        return
+      # a batch is run as one job, outside of the per-method limits
+      method = req.get('method') if isinstance(req, dict) else None
+      if method in STREAM_METHODS:
+        # not queued behind the calls occupying the workers
+        self._send_reply(self._stream_control(req))
+        return
+      if method and self._cache:
+        # a cached result is sent at once, without a worker
+        reply, token = cached_rpc(req, self._cache, self._metrics, False)
+        if reply:
+          self._send_reply(reply)
+          return
+      rpc_methods = self._rpc_methods
+      cache = self._cache
+      job = lambda: self._send_reply(dispatch_rpc(req, rpc_methods, self._metrics, self._start_stream, cache))
+    else:
+      req = None
+      method = None
+      job = lambda: self._send_reply(self._message_cb(msg, len(msg)))
+
+    if not self._pool.submit(method, job):
+      if self.debug:
+        print "RPC worker pool full: %s" % self._pool.stats()
+      id = req.get('id') if isinstance(req, dict) else None
+      self._send_reply(rpc_error(JSONError.SERVER_BUSY, id))
+    return
+
+  def _send_reply(self, reply):
+    """
+    Send a reply message to the Autonomia server, ahead of the queued telemetry with the send buffer.
+    A None reply is not sent: the results of the call are streamed.
+    """
+    if reply is None:
+      return
+    try:
+      parts = self._chunk(byte_view(reply))
+      if self._send_buffer:
+        self._send_buffer.put(parts, PRIORITY_CONTROL)
+      else:
+        self._write(*parts)
+      if self._metrics:
+        self._metrics.count('replies_sent')
+    except Exception, e:
+      print "--- error sending reply"
+    return
+
+  def _start_stream(self, req, generator, start):
+    """
+    Stream the results of a generator method in a new thread, also with the worker pool: a stream waiting
+    for the uplink or for the acknowledgments would hold a worker for its whole life.
+    Returns None, or the server busy error reply if max_streams streams are running.
+    """
+    stream = RPCStream(req['id'], req['method'], generator, start)
+    with self._streams_lock:
+      old = self._streams.get(stream.id)
+      busy = old is None and len(self._streams) >= self.max_streams
+      if not busy:
+        self._streams[stream.id] = stream
+    if busy:
+      generator.close()
+      if self._metrics:
+        self._metrics.rpc_call(stream.method, time.time() - start, True)
+      return rpc_error(JSONError.SERVER_BUSY, stream.id)
+    if old:
+      # a new call with the same id replaces the stream
+      old.cancel()
+    t = threading.Thread(target=self._run_stream, args=(stream,))
+    t.daemon = True
+    t.start()
+    return
+
+  def _run_stream(self, stream):
+    """
+    Send the results of the generator as partial replies, then the end of the stream: the reply with
+    the number of partial results, or the error if the generator raised or the stream was cancelled.
+    """
+    seq = 0
+    error = None
+    sent = True
+    try:
+      for item in stream.generator:
+        if not stream.wait(seq, self.stream_window, self.stream_timeout):
+          break
+        sent = self._send_stream(stream, rpc_partial(item, seq, stream.id))
+        if not sent:
+          # cancelled while waiting for the uplink, or the connection is lost
+          break
+        seq += 1
+    except Exception, e:
+      print e
+      error = JSONError.INTERNAL_ERROR
+    finally:
+      # run the finally blocks of the generator: close its files and processes
+      stream.generator.close()
+      with self._streams_lock:
+        if self._streams.get(stream.id) is stream:
+          del self._streams[stream.id]
+    if self._metrics:
+      self._metrics.rpc_call(stream.method, time.time() - stream.start, error is not None)
+    if sent is False:
+      # the connection is lost, and the caller with it
+      return
+    if error is None and stream.cancelled:
+      error = JSONError.REQUEST_CANCELLED
+    self._send_stream(stream, rpc_error(error, stream.id) if error else rpc_result({'items': seq}, stream.id), True)
+    return
+
+  def _send_stream(self, stream, msg, end=False):
+    """
+    Send a message of a stream in the telemetry lane, after the queued messages of the stream, waiting
+    while the send buffer or the gateway output buffer is full. Returns True if the message is sent,
+    None if the stream is cancelled before a partial result is sent and False if the connection is lost.
+    The end of a cancelled stream does not wait for the send buffer: it goes in the replies lane.
+    """
+    parts = self._chunk(msg)
+    while end or not stream.cancelled:
+      if self._reconnecting:
+        return False
+      try:
+        if not self._send_buffer:
+          self._write(*parts)
+          return True
+        if self._send_buffer.put(parts):
+          return True
+        if end and stream.cancelled:
+          # the caller has given up on the stream: the partial results still queued may follow the end
+          return self._send_buffer.put(parts, PRIORITY_CONTROL)
+      except Exception, e:
+        if getattr(e, 'errno', None) != errno.ENOBUFS:
+          return False
+      # flow control: the uplink is not keeping up
+      time.sleep(0.005)
+    return None
+
+  def _stream_control(self, req):
+    """
+    Run a stream control method: rpc.cancel {"id":id} and rpc.ack {"id":id, "seq":seq}.
+    Returns the reply, with False if there is no stream with the id.
+    """
+    params = req['params'] if isinstance(req['params'], dict) else {}
+    id = params.get('id')
+    with self._streams_lock:
+      stream = self._streams.get(id) if valid_rpc_id(id) else None
+    if req['method'] == 'rpc.cancel':
+      if stream:
+        stream.cancel()
+      return rpc_result({'cancelled': stream is not None}, req['id'])
+    seq = params.get('seq')
+    if stream and isinstance(seq, (int, long)):
+      stream.ack(seq)
+    return rpc_result({'acked': stream is not None}, req['id'])
+
+  def _write(self, *parts):
+    """
+    Write the parts, strings or byte views, in order to the non-blocking server connection, waiting
+    for the socket to drain on partial writes. The parts are not joined: every part is sent from a view
+    in slices of at most SEND_SLICE bytes. Raises an exception on error or if the socket is not writable
+    for write_timeout, and socket.error ENOTCONN while the device is reconnecting: the connection is not
+    attached, a reply of a worker would be sent in the middle of the attach request.
+    """
+    if self._output is not None:
+      self._queue_output(parts)
+      return
+    size = 0
+    with self._hb_lock:
+      if self._reconnecting:
+        raise socket.error(errno.ENOTCONN, "device is reconnecting")
+      if self._capture:
+        self._capture.outbound(''.join(view_bytes(part) for part in parts))
+      sock = self._sock
+      for part in parts:
+        start, end = 0, len(part)
+        while start < end:
+          try:
+            n = sock.send(slice_view(part, start, min(end, start + SEND_SLICE)))
+          except socket.error, e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK) and \
+               not (self._use_ssl and isinstance(e, ssl.SSLError) and e.errno == ssl.SSL_ERROR_WANT_WRITE):
+              raise
+            n = 0
+          if n == 0:
+            ready_to_read, ready_to_write, in_error = select.select([], [sock], [], self.write_timeout)
+            if not ready_to_write:
+              raise socket.timeout("write timeout")
+            continue
+          start += n
+        size += end
+      # the data sent proves the connection is alive
+      self._next_heartbeat = time.time() + self._heartbeat_rate
+    if self._metrics:
+      self._metrics.count('bytes_sent', size)
+    return
+
+  def _queue_output(self, parts):
+    """
+    Gateway session write: append the parts to the output buffer and send what the socket accepts.
+    Raises socket.error ENOBUFS if the output buffer is full.
+    """
+    size = sum(len(part) for part in parts)
+    with self._hb_lock:
+      if self._reconnecting:
+        raise socket.error(errno.ENOTCONN, "device is reconnecting")
+      if self._output and len(self._output) + size > self.max_output:
+        raise socket.error(errno.ENOBUFS, "output buffer full")
+      if self._capture:
+        self._capture.outbound(''.join(view_bytes(part) for part in parts))
+      for part in parts:
+        self._output += part
+      self._send_output()
+      pending = len(self._output)
+      self._next_heartbeat = time.time() + self._heartbeat_rate
+    if self._metrics:
+      self._metrics.count('bytes_sent', size)
+    if pending:
+      self._gateway._output_pending(self)
+    return
+
+  def _send_output(self):
+    """
+    Send the output buffer without blocking. Called with _hb_lock held.
+    """
+    while self._output:
+      try:
+        n = self._sock.send(buffer(self._output, 0, SEND_SLICE))
+      except socket.error, e:
+        if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK) or \
+           (self._use_ssl and isinstance(e, ssl.SSLError) and e.errno == ssl.SSL_ERROR_WANT_WRITE):
+          return
+        raise
+      if n == 0:
+        return
+      del self._output[:n]
+    return
+
+  def video_start(self, timestamp=False, adaptive=False, tap=None, caps_file=None):
+    import streamer
+    return streamer.video_start(self.device_id, self._app_key, timestamp, adaptive, tap=tap, caps_file=caps_file)
+
+  def video_stop(self):
+    import streamer
+    return streamer.video_stop()
+
+  def video_status(self):
+    import streamer
+    return streamer.video_status()
+
+class GatewaySession(object):
+  """
+  The state of a device session of AutonomiaGateway.
+  """
+
+  def __init__(self, client):
+    self.client = client
+    self.state = None
+    self.generation = 0     # invalidates the timers of the previous state
+    self.fd = None
+    self.deadline = 0       # end of the connection and attach attempt
+    self.events = 0         # events the fd is registered for
+    self.want = 0           # events the SSL handshake waits for
+    self.attached = False   # attached at least once, the next attach is a reconnection
+
+class AutonomiaGateway(object):
+  """
+  Host many device sessions on one thread and one poll loop, i.e. on a gateway or to simulate a fleet.
+  Every session is an AutonomiaClient with its own RPC methods. The sessions attach and reconnect
+  without blocking the loop, the heartbeats and reconnections are timers in one queue,
+  and the receive and send buffers of every session are bounded.
+  Methods exported:
+    AutonomiaGateway(application_key, logger, use_ssl=True, server=None, port=None) -- Object constructor
+    add(device_id, rpc_methods, device_info="ROV") -- Add a device session, returns its AutonomiaClient
+    remove(device_id) -- Close and remove a device session
+    session(device_id) -- The AutonomiaClient of a device
+    poll(timeout=None) -- Run one iteration of the event loop
+    run_forever() -- Run the event loop until close()
+    close() -- Close all the sessions and stop run_forever()
+    stats() -- Number of sessions in every state
+  """
+
+  def __init__(self, application_key, logger, use_ssl=True, server=None, port=None):
+    """
+    application_key: the Autonomia application key
+    logger: function logging a message string
+    use_ssl: connect with SSL
+    server: the Autonomia server FQDN -- default AUTONOMIA_SERVER
+    port: the Autonomia server port -- default 443 with SSL and 80 without
+    """
+    self.log = logger
+    self._app_key = application_key
+    self._use_ssl = use_ssl
+    self._server = server
+    self._port = port
+
+    # per session: size of a socket read, maximum size of a received message and of the unsent data
+    self.recv_size = 4096
+    self.max_message = 65536
+    self.max_output = 65536
+    # maximum time in seconds to connect and attach a session
+    self.connect_timeout = 10
+
+    self._sessions = {}     # device id -> GatewaySession
+    self._clients = {}      # AutonomiaClient -> GatewaySession
+    self._fds = {}          # file descriptor -> GatewaySession
+    self._timers = []       # heap of (time, sequence, session, generation, kind)
+    self._sequence = 0
+    self._ready = set()     # sessions with received messages to dispatch
+    self._pending = set()   # sessions with output queued by other threads
+    self._lock = threading.Lock()
+    self._loop_thread = None
+    self._running = False
+    self._closed = False
+    self._dns_cache = None
+    self._ssl_context = None
+    self._poller = select.poll()
+    # wakes up the loop when another thread queues output
+    self._wakeup_r, self._wakeup_w = os.pipe()
+    fcntl.fcntl(self._wakeup_r, fcntl.F_SETFL, os.O_NONBLOCK)
+    fcntl.fcntl(self._wakeup_w, fcntl.F_SETFL, os.O_NONBLOCK)
+    self._poller.register(self._wakeup_r, select.POLLIN)
+    return
+
+  def add(self, device_id, rpc_methods, device_info="ROV"):
+    """
+    Add a device session and start attaching it. Returns the AutonomiaClient of the session,
+    its send_data() returns -1, or 1 with a spool, until the session is attached.
+
+    device_id: the device unique identifier
+    rpc_methods: tuple with RPC method callbacks, i.e. ({'name':'video_start', 'function':_video_start},)
+    device_info: a description of the platform or the device (used only as a comment)
+    """
+    if device_id in self._sessions:
+      raise ValueError("device %s already added" % device_id)
+    client = AutonomiaClient(self._app_key, self.log, self._use_ssl, self._server, self._port)
+    client.device_id = device_id
+    client._platform = device_info
+    client.recv_size = self.recv_size
+    client.max_output = self.max_output
+    client._gateway = self
+    if rpc_methods is not None:
+      client._rpc_methods = dict((m['name'], m['function']) for m in rpc_methods)
+    # not attached yet: no heartbeats, send_data fails or spools
+    client._reconnecting = True
+    session = GatewaySession(client)
+    self._sessions[device_id] = session
+    self._clients[client] = session
+    self._connect(session)
+    return client
+
+  def remove(self, device_id):
+    """
+    Close and remove a device session.
+    """
+    session = self._sessions.pop(device_id)
+    del self._clients[session.client]
+    self._close(session)
+    self._set_state(session, 'removed')
+    return
+
+  def session(self, device_id):
+    """
+    Return the AutonomiaClient of a device session.
+    """
+    return self._sessions[device_id].client
+
+  def stats(self):
+    """
+    Return a dictionary with the number of sessions in every state:
+    connecting, handshake, attaching, attached and waiting to reconnect.
+    """
+    counts = dict((state, 0) for state in ('connecting', 'handshake', 'attaching', 'attached', 'waiting'))
+    for session in self._sessions.values():
+      counts[session.state] += 1
+    counts['sessions'] = len(self._sessions)
+    return counts
+
+  def run_forever(self):
+    """
+    Run the gateway event loop until close() is called.
+    """
+    self._running = True
+    while not self._closed:
+      self.poll()
+    self._running = False
+    for device_id in self._sessions.keys():
+      self.remove(device_id)
+    return
+
+  def close(self):
+    """
+    Close all the sessions. When called from another thread, run_forever() closes them and returns.
+    """
+    self._closed = True
+    if self._running and threading.current_thread() is not self._loop_thread:
+      self._wakeup()
+      return
+    for device_id in self._sessions.keys():
+      self.remove(device_id)
+    return
+
+  def poll(self, timeout=None):
+    """
+    Run one iteration of the event loop: run the due timers, wait for the socket events
+    for at most timeout seconds or until the next timer, and process the events.
+    """
+    self._loop_thread = threading.current_thread()
+    now = time.time()
+    self._run_timers(now)
+
+    with self._lock:
+      pending, self._pending = self._pending, set()
+    for session in pending:
+      self._watch(session)
+
+    wait = timeout
+    if self._timers:
+      due = max(self._timers[0][0] - time.time(), 0)
+      wait = due if wait is None else min(wait, due)
+    if self._ready:
+      wait = 0
+    events = self._poller.poll(None if wait is None else wait * 1000)
+
+    for fd, event in events:
+      if fd == self._wakeup_r:
         try:
-          self._sock.close()
-        except Exception, e:
-          print "--- exception in close socket."
+          os.read(self._wakeup_r, 4096)
+        except OSError:
           pass
-        
-        # self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._reconnecting = True
-        ret = self.attach(self.rpc_methods, self.device_id, self._platform)
-        if self.error != 0:
-          print "Error in attaching to Autonomia.", self.perror()
-          time.sleep(15) 
-          continue
-        else:
-          print "Device attached to Autonomia.", ret       
         continue
+      session = self._fds.get(fd)
+      if session is not None:
+        self._event(session, event)
 
-      if self.debug:
-        print "** received: %s (%d)" % (data, len(data))      
-      self._hparser.execute(data, len(data))
-      if self._hparser.is_partial_body():
-        to_send = self._hparser.recv_body()
-        # the payload contains a HTTP chunk
-        if self._message_cb:
-          # invoke the user callback 
-          reply = self._message_cb(to_send, len(to_send))
-        else:
-          reply = ""
-        if self.debug:
-          print "After callback."
+    ready, self._ready = self._ready, set()
+    for session in ready:
+      if session.state == 'attached':
+        self._receive(session, False)
+    return
+
+  def _event(self, session, event):
+    """
+    Process the socket events of a session.
+    """
+    client = session.client
+    state = session.state
+    if state == 'connecting':
+      err = client._sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+      if err:
+        self._fail(session, os.strerror(err))
+      elif self._use_ssl:
+        client._sock = self._ssl_context.wrap_socket(client._sock, do_handshake_on_connect=False)
+        self._set_state(session, 'handshake', session.deadline)
+        self._handshake(session)
       else:
-        continue
+        self._send_request(session)
+    elif state == 'handshake':
+      self._handshake(session)
+    elif state == 'attaching':
+      if event & select.POLLOUT:
+        self._flush(session)
+      if event & (select.POLLIN | select.POLLERR | select.POLLHUP) and session.state == 'attaching':
+        self._attach_reply(session)
+    elif state == 'attached':
+      if event & select.POLLOUT:
+        self._flush(session)
+      if event & (select.POLLIN | select.POLLERR | select.POLLHUP) and session.state == 'attached':
+        self._receive(session, True)
+    return
 
-      if self.debug:
-        print "Returning result."
-      sendBuf = "%x\r\n%s\r\n" % (len(reply),reply)
+  def _connect(self, session):
+    """
+    Start the non-blocking connection of a session to the server.
+    """
+    client = session.client
+    # the sessions share the server address and the SSL context
+    client._dns_cache = client._dns_cache or self._dns_cache
+    client._ssl_context = client._ssl_context or self._ssl_context
+    try:
+      sock = client._connect_nonblocking()
+    except socket.error, e:
+      self._dns_cache = client._dns_cache
+      self._fail(session, e)
+      return
+    self._dns_cache = client._dns_cache
+    self._ssl_context = client._ssl_context
+    client._sock = sock
+    client._decoder = ChunkDecoder(2 * self.recv_size, max_message=self.max_message)
+    client._output = bytearray()
+    session.fd = sock.fileno()
+    session.events = 0
+    session.deadline = time.time() + self.connect_timeout
+    self._fds[session.fd] = session
+    self._set_state(session, 'connecting', session.deadline)
+    self._watch(session)
+    return
+
+  def _handshake(self, session):
+    """
+    Continue the SSL handshake of a session.
+    """
+    try:
+      want = session.client._handshake()
+    except socket.error, e:
+      self._fail(session, e)
+      return
+    if want:
+      session.want = want
+      self._watch(session)
+      return
+    self._send_request(session)
+    return
+
+  def _send_request(self, session):
+    """
+    Send the attach request of a session.
+    """
+    client = session.client
+    request = client._attach_request()
+    if client._capture:
+      client._capture.connect()
+      client._capture.outbound(request)
+    with client._hb_lock:
+      client._output += request
+    self._set_state(session, 'attaching', session.deadline)
+    self._flush(session)
+    return
+
+  def _attach_reply(self, session):
+    """
+    Read the attach reply of a session.
+    """
+    client = session.client
+    try:
+      n = client._recv()
+      if n == 0:
+        self._fail(session, "connection closed")
+        return
+      reply = client._decoder.next_message()
+    except socket.error, e:
+      if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK) or \
+         (self._use_ssl and isinstance(e, ssl.SSLError) and e.errno == ssl.SSL_ERROR_WANT_READ):
+        return
+      self._fail(session, e)
+      return
+    except ValueError, e:
+      self._fail(session, e)
+      return
+    if reply is None:
+      return
+    if not client._attach_reply(reply):
+      # the attach reply closed the connection
+      self._unregister(session)
+      client._sock = None
+      self._retry(session)
+      return
+
+    now = time.time()
+    client._reconnecting = False
+    client._attempts = 0
+    if session.attached:
+      client.reconnects += 1
+      client.last_reconnect_time = now - client._disconnected_at
+      if client._metrics:
+        client._metrics.reconnected(client.last_reconnect_time)
+    session.attached = True
+    self._set_state(session, 'attached')
+    self._add_timer(client._next_heartbeat, session, 'heartbeat')
+    if client._spool is not None:
+      self._add_timer(now, session, 'drain')
+    # messages received together with the attach reply
+    self._ready.add(session)
+    self._watch(session)
+    return
+
+  def _receive(self, session, readable):
+    """
+    Read and dispatch the messages of an attached session.
+    """
+    client = session.client
+    if readable or (self._use_ssl and client._sock.pending()):
+      client._read()
+    elif client._dispatch_pending:
+      client._dispatch_messages()
+    if client._reconnecting:
+      self._lost(session)
+      return
+    if client._dispatch_pending or (self._use_ssl and client._sock.pending()):
+      self._ready.add(session)
+    self._watch(session)
+    return
+
+  def _flush(self, session):
+    """
+    Send the output buffer of a session.
+    """
+    client = session.client
+    try:
+      with client._hb_lock:
+        client._send_output()
+    except socket.error, e:
+      if session.state == 'attached':
+        print "Network error in gateway session %s (%s). Reconnecting..." % (client.device_id, e)
+        client._disconnect()
+        self._lost(session)
+      else:
+        self._fail(session, e)
+      return
+    self._watch(session)
+    return
+
+  def _lost(self, session):
+    """
+    The client closed the connection of an attached session and scheduled the reconnection.
+    """
+    self._unregister(session)
+    self._set_state(session, 'waiting')
+    self._add_timer(session.client._retry_at, session, 'retry')
+    return
+
+  def _fail(self, session, reason):
+    """
+    A connection or attach attempt failed: schedule the next one with the client backoff delay.
+    """
+    client = session.client
+    if client.debug:
+      print "Error in attaching device %s: %s" % (client.device_id, reason)
+    self._close(session)
+    client.error = 2
+    self._retry(session)
+    return
+
+  def _retry(self, session):
+    """
+    Schedule the next attach attempt of a session.
+    """
+    client = session.client
+    client._attempts += 1
+    self._set_state(session, 'waiting')
+    self._add_timer(time.time() + client._backoff_delay(), session, 'retry')
+    return
+
+  def _close(self, session):
+    """
+    Close the connection of a session.
+    """
+    client = session.client
+    self._unregister(session)
+    if client._sock is not None:
       try:
-        self._hb_lock.acquire()
-        self._sock.send(sendBuf)
-        self._hb_lock.release()
+        client._sock.close()
       except Exception, e:
-        print "--- error sending reply"
         pass
-      msg = ""     
+      client._sock = None
+    client._reconnecting = True
+    return
 
-  def video_start(self, timestamp=False):
-    return streamer.video_start(self.device_id, self._app_key, timestamp)
+  def _unregister(self, session):
+    """
+    Stop polling the socket of a session.
+    """
+    if session.fd is not None:
+      if session.events:
+        self._poller.unregister(session.fd)
+      del self._fds[session.fd]
+      session.fd = None
+      session.events = 0
+    return
 
-  def video_stop(self):
-    return streamer.video_stop()
+  def _watch(self, session):
+    """
+    Register the socket of a session for the events of its state.
+    """
+    if session.fd is None:
+      return
+    client = session.client
+    if session.state == 'connecting':
+      events = select.POLLOUT
+    elif session.state == 'handshake':
+      events = session.want
+    else:
+      events = select.POLLIN
+      if client._output:
+        events |= select.POLLOUT
+    if events != session.events:
+      if session.events:
+        self._poller.modify(session.fd, events)
+      else:
+        self._poller.register(session.fd, events)
+      session.events = events
+    return
+
+  def _output_pending(self, client):
+    """
+    Called by a session write that left data in the output buffer.
+    """
+    session = self._clients.get(client)
+    if session is None:
+      return
+    if threading.current_thread() is self._loop_thread:
+      self._watch(session)
+      return
+    with self._lock:
+      self._pending.add(session)
+    self._wakeup()
+    return
+
+  def _wakeup(self):
+    """
+    Wake up the loop waiting in poll().
+    """
+    try:
+      os.write(self._wakeup_w, 'x')
+    except OSError:
+      pass
+    return
+
+  def _set_state(self, session, state, deadline=None):
+    """
+    Change the state of a session, cancelling the timers of the previous state.
+    The session fails if it is still in the state at the deadline.
+    """
+    session.state = state
+    session.generation += 1
+    if deadline:
+      self._add_timer(deadline, session, 'timeout')
+    return
+
+  def _add_timer(self, when, session, kind):
+    self._sequence += 1
+    heapq.heappush(self._timers, (when, self._sequence, session, session.generation, kind))
+    return
+
+  def _run_timers(self, now):
+    """
+    Run the due timers: keepalives, spool drains, attach timeouts and reconnections.
+    """
+    while self._timers and self._timers[0][0] <= now:
+      when, sequence, session, generation, kind = heapq.heappop(self._timers)
+      if generation != session.generation:
+        continue
+      client = session.client
+      if kind == 'heartbeat':
+        due = client._keepalive(now)
+        if client._reconnecting:
+          self._lost(session)
+          continue
+        self._add_timer(due, session, 'heartbeat')
+        self._watch(session)
+      elif kind == 'drain':
+        if client._spooled():
+          client._drain_spool()
+          self._watch(session)
+        self._add_timer(now + (DRAIN_INTERVAL if client._spooled() else 1), session, 'drain')
+      elif kind == 'timeout':
+        client.error = 1
+        self._fail(session, "timeout")
+      elif kind == 'retry':
+        self._connect(session)
+    return
 
 class JSONError:
-  # JSON-RPC errors
+  # JSON-RPC error codes
   #
-  JSON_RPC_PARSE_ERROR = '{"jsonrpc": "2.0","error":{"code":-32700,"message":"Parse error"},"id": null}'
-  JSON_RPC_INVALID_REQUEST = '{"jsonrpc": "2.0","error":{"code":-32600,"message":"Invalid Request"},"id":null}'
+  PARSE_ERROR = -32700
+  INVALID_REQUEST = -32600
+  METHOD_NOT_FOUND = -32601
+  INVALID_PARAMS = -32602
+  INTERNAL_ERROR = -32603
+  SERVER_BUSY = -32000
+  REQUEST_CANCELLED = -32800
 
-  JSON_RPC_METHOD_NOTFOUND_FMT_STR = '{"jsonrpc":"2.0","error":{"code": -32601,"message":"Method not found"},"id": %s}'
-  JSON_RPC_METHOD_NOTFOUND_FMT_NUM = '{"jsonrpc":"2.0","error":{"code": -32601,"message":"Method not found"},"id": %d}'
-  JSON_RPC_INVALID_PARAMS_FMT_STR = '{"jsonrpc":"2.0","error":{"code": -32602,"message":"Method not found"},"id": %s}'
-  JSON_RPC_INVALID_PARAMS_FMT_NUM = '{"jsonrpc":"2.0","error":{"code": -32602,"message":"Method not found"},"id": %d}'
-  JSON_RPC_INTERNAL_ERROR_FMT_STR = '{"jsonrpc":"2.0","error":{"code": -32603,"message":"Method not found"},"id": %s}'
-  JSON_RPC_INTERNAL_ERROR_FMT_NUM = '{"jsonrpc":"2.0","error":{"code": -32602,"message":"Method not found"},"id": %d}'
+  MESSAGES = {PARSE_ERROR: "Parse error", INVALID_REQUEST: "Invalid Request", METHOD_NOT_FOUND: "Method not found",
+              INVALID_PARAMS: "Invalid params", INTERNAL_ERROR: "Internal error", SERVER_BUSY: "Server busy",
+              REQUEST_CANCELLED: "Request cancelled"}
+  # error replies up to the id, completed by rpc_error()
+  ERROR_PREFIX = dict((code, '{"jsonrpc":"2.0","error":{"code":%d,"message":"%s"},"id":' % (code, message))
+                      for code, message in MESSAGES.items())
+
+  # JSON-RPC errors
+  #
+  JSON_RPC_PARSE_ERROR = '{"jsonrpc":"2.0","error":{"code":-32700,"message":"Parse error"},"id":null}'
+  JSON_RPC_INVALID_REQUEST = '{"jsonrpc":"2.0","error":{"code":-32600,"message":"Invalid Request"},"id":null}'
 
+  JSON_RPC_METHOD_NOTFOUND_FMT_STR = '{"jsonrpc":"2.0","error":{"code":-32601,"message":"Method not found"},"id":%s}'
+  JSON_RPC_METHOD_NOTFOUND_FMT_NUM = '{"jsonrpc":"2.0","error":{"code":-32601,"message":"Method not found"},"id":%d}'
+  JSON_RPC_INVALID_PARAMS_FMT_STR = '{"jsonrpc":"2.0","error":{"code":-32602,"message":"Invalid params"},"id":%s}'
+  JSON_RPC_INVALID_PARAMS_FMT_NUM = '{"jsonrpc":"2.0","error":{"code":-32602,"message":"Invalid params"},"id":%d}'
+  JSON_RPC_INTERNAL_ERROR_FMT_STR = '{"jsonrpc":"2.0","error":{"code":-32603,"message":"Internal error"},"id":%s}'
+  JSON_RPC_INTERNAL_ERROR_FMT_NUM = '{"jsonrpc":"2.0","error":{"code":-32603,"message":"Internal error"},"id":%d}'
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""
+  Benchmark of the message compression: compression ratio and CPU cost on representative telemetry.
+
+  Usage: python benchmarks/bench_compression.py [messages]
+
+  Telemetry messages and RPC replies are compressed with and without a preset dictionary,
+  at different zlib levels and thresholds. Reported per configuration: the ratio of the bytes
+  sent with and without compression, including the chunk headers, and the CPU time per message
+  to compress and to decompress.
+"""
+import os
+import sys
+import time
+import json
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from compression import MessageCompressor, MessageDecompressor, sample_dictionary
+
+def telemetry(count, seed=1):
+  """
+  Return telemetry messages of a rover: fast drive samples, slower GPS and IMU, and battery reports.
+  """
+  rnd = random.Random(seed)
+  msgs = []
+  for i in range(count):
+    kind = i % 10
+    if kind < 6:
+      msg = {'t': 1441382935.0 + i * 0.05, 'speed': round(rnd.uniform(0, 30), 1), 'steering': rnd.randint(0, 180),
+             'throttle': rnd.randint(90, 120), 'seq': i}
+    elif kind < 9:
+      msg = {'t': 1441382935.0 + i * 0.05, 'gps': {'lat': round(37.4419 + rnd.random() / 100, 6),
+             'lon': round(-122.1430 + rnd.random() / 100, 6), 'alt': round(rnd.uniform(10, 12), 1), 'fix': 3, 'sats': rnd.randint(6, 12)},
+             'imu': {'ax': round(rnd.gauss(0, 0.2), 3), 'ay': round(rnd.gauss(0, 0.2), 3), 'az': round(rnd.gauss(9.8, 0.1), 3),
+                     'heading': round(rnd.uniform(0, 360), 1)}, 'seq': i}
+    else:
+      msg = {'t': 1441382935.0 + i * 0.05, 'battery': {'voltage': round(rnd.uniform(7.2, 8.4), 2),
+             'current': round(rnd.uniform(0.5, 4), 2), 'temperature': round(rnd.uniform(25, 40), 1)}, 'status': 'driving', 'seq': i}
+    msgs.append('\x07' + json.dumps(msg, separators=(',', ':')))
+  return msgs
+
+def replies(count, seed=2):
+  rnd = random.Random(seed)
+  return [json.dumps({'jsonrpc': '2.0', 'result': {'status': 'ok', 'speed': round(rnd.uniform(0, 30), 1),
+                      'mode': 'autonomous'}, 'id': i}) for i in range(count)]
+
+def wire(size):
+  """
+  Bytes of a chunk with a payload of size bytes.
+  """
+  return len('%x' % size) + size + 4
+
+def bench(msgs, dictionary, level, threshold):
+  compressor = MessageCompressor(dictionary, level, threshold)
+  decompressor = MessageDecompressor(dictionary)
+  start = time.clock()
+  out = [compressor.compress(m) or m for m in msgs]
+  compress = time.clock() - start
+  start = time.clock()
+  decoded = [decompressor.decode(m) for m in out]
+  decompress = time.clock() - start
+  assert decoded == msgs
+  raw = sum(wire(len(m)) for m in msgs)
+  sent = sum(wire(len(m)) for m in out)
+  return float(raw) / sent, compress / len(msgs) * 1e6, decompress / len(msgs) * 1e6, sent
+
+def main():
+  count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+  for name, msgs, samples in (('telemetry', telemetry(count), telemetry(200, seed=99)),
+                              ('RPC replies', replies(count), replies(50, seed=99))):
+    dictionary = sample_dictionary(samples)
+    raw = sum(wire(len(m)) for m in msgs)
+    print "%s: %d messages, %.1f bytes per message" % (name, len(msgs), float(raw) / len(msgs))
+    print "  %-12s %5s %9s %7s %14s %14s %12s" % ('dictionary', 'level', 'threshold', 'ratio', 'compress us', 'decompress us', 'bytes/msg')
+    for dict_name, d in (('none', ''), ('%d bytes' % len(dictionary), dictionary)):
+      for level in (1, 6, 9):
+        for threshold in (32, 64, 128):
+          ratio, c, dc, sent = bench(msgs, d, level, threshold)
+          print "  %-12s %5d %9d %7.2f %14.1f %14.1f %12.1f" % (dict_name, level, threshold, ratio, c, dc, float(sent) / len(msgs))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+"""
+  End-to-end benchmarks of the device SDK against the local stand-in server.
+
+  Usage: python benchmarks/bench_e2e.py [--tls] [--rpc-count 1000] [--rpc-rate 100] [--messages 20000]
+
+  The server runs in a separate process, so the CPU time reported is the time
+  used by the SDK in this process: RPC round-trip latency percentiles, send_data
+  throughput with and without send buffering, RPC latency under a telemetry
+  flood with and without the send buffer priority lanes, and reconnection time.
+"""
+import os
+import sys
+import time
+import argparse
+import threading
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from autonomialib import AutonomiaClient
+from localserver import LocalServer
+
+TELEMETRY = '{"speed":12.5,"steering":92,"throttle":104,"lat":37.4419,"lon":-122.1430,"heading":271.5,"seq":%d}'
+
+def serve(conn, tls):
+  """
+  Run the local server and execute the commands received on the pipe.
+  """
+  server = LocalServer(tls=tls)
+  conn.send(server.start())
+  while True:
+    name, args = conn.recv()
+    conn.send(getattr(server, name)(*args))
+    if name == 'stop':
+      return
+
+class ServerProcess(object):
+  """
+  The local server running in a child process, its methods are called through a pipe.
+  """
+
+  def __init__(self, tls):
+    self._conn, child = multiprocessing.Pipe()
+    self._process = multiprocessing.Process(target=serve, args=(child, tls))
+    self._process.daemon = True
+    self._process.start()
+    self.port = self._conn.recv()
+
+  def __getattr__(self, name):
+    def call(*args):
+      self._conn.send((name, args))
+      return self._conn.recv()
+    return call
+
+def cpu_time():
+  t = os.times()
+  return t[0] + t[1]
+
+def percentile(values, p):
+  values = sorted(values)
+  return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+def bench_rpc(client, server, rate, count):
+  cpu = cpu_time()
+  rtt = server.inject_rpc(rate, count, 'echo', {'value': 1})
+  cpu = cpu_time() - cpu
+  done = [t * 1000 for t in rtt if t is not None]
+  print "RPC round trip: %d requests at %d/s, %d replies" % (count, rate, len(done))
+  if done:
+    print "  p50 %.2f ms  p90 %.2f ms  p99 %.2f ms  max %.2f ms" % (percentile(done, 50), percentile(done, 90), percentile(done, 99), max(done))
+  print "  CPU %.1f us per request" % (cpu / count * 1e6)
+
+def bench_rpc_load(client, server, rate, count, buffered):
+  """
+  RPC round trip while another thread sends telemetry as fast as the connection takes it.
+  """
+  client.set_send_buffering(0.02 if buffered else 0)
+  base = server.stats()['data_messages']
+  stop = []
+  sent = [0]
+  def flood():
+    while not stop:
+      if client.send_data(TELEMETRY % sent[0]) == -2:
+        time.sleep(0.001)
+      else:
+        sent[0] += 1
+  t = threading.Thread(target=flood)
+  t.start()
+  rtt = server.inject_rpc(rate, count, 'echo', {'value': 1})
+  stop.append(True)
+  t.join()
+  client.flush()
+  client.set_send_buffering(0)
+  # let the server drain the backlog before the next benchmark
+  start = time.time()
+  while server.stats()['data_messages'] - base < sent[0] and time.time() - start < 60:
+    time.sleep(0.01)
+  done = [t * 1000 for t in rtt if t is not None]
+  print "RPC round trip under telemetry load, %s: %d requests, %d replies" % (
+        'send buffer' if buffered else 'unbuffered', count, len(done))
+  if done:
+    print "  p50 %.2f ms  p90 %.2f ms  p99 %.2f ms  max %.2f ms" % (percentile(done, 50), percentile(done, 90), percentile(done, 99), max(done))
+
+def bench_send(client, server, count, buffered):
+  client.set_send_buffering(0.02 if buffered else 0)
+  base = server.stats()['data_messages']
+  cpu = cpu_time()
+  start = time.time()
+  for i in range(count):
+    while client.send_data(TELEMETRY % i) == -2:
+      # send buffer full
+      time.sleep(0.001)
+  client.flush()
+  while server.stats()['data_messages'] - base < count and time.time() - start < 60:
+    time.sleep(0.01)
+  elapsed = time.time() - start
+  cpu = cpu_time() - cpu
+  received = server.stats()['data_messages'] - base
+  print "send_data %s: %d messages received in %.2f s, %.0f msg/s, CPU %.1f us per message" % (
+        'buffered' if buffered else 'unbuffered', received, elapsed, received / elapsed, cpu / count * 1e6)
+  client.set_send_buffering(0)
+
+def bench_reconnect(client, server, count):
+  times = []
+  for i in range(count):
+    reconnects = client.reconnects
+    dropped = server.drop()
+    while client.reconnects == reconnects and time.time() - dropped < 60:
+      time.sleep(0.001)
+    times.append(time.time() - dropped)
+  print "Reconnect: %d reconnections, from server drop to attached: min %.3f s  mean %.3f s  max %.3f s" % (
+        count, min(times), sum(times) / len(times), max(times))
+
+def main():
+  parser = argparse.ArgumentParser(description='End-to-end benchmarks of the device SDK.')
+  parser.add_argument('--tls', action='store_true', help='connect with TLS')
+  parser.add_argument('--rpc-count', type=int, default=1000)
+  parser.add_argument('--rpc-rate', type=int, default=100)
+  parser.add_argument('--messages', type=int, default=20000)
+  parser.add_argument('--reconnects', type=int, default=5)
+  args = parser.parse_args()
+
+  server = ServerProcess(args.tls)
+  client = AutonomiaClient('BENCHMARK', lambda msg: None, use_ssl=args.tls, server='127.0.0.1', port=server.port)
+  client.attach(({'name': 'echo', 'function': lambda params: params},), 'BENCH0001', 'benchmark')
+  if client.error != 0 or not server.wait_attached():
+    print "Cannot attach to the local server:", client.perror()
+    return
+
+  print "Local server on port %d%s" % (server.port, ' (TLS)' if args.tls else '')
+  bench_rpc(client, server, args.rpc_rate, args.rpc_count)
+  bench_rpc_load(client, server, args.rpc_rate, args.rpc_count, False)
+  bench_rpc_load(client, server, args.rpc_rate, args.rpc_count, True)
+  bench_send(client, server, args.messages, False)
+  bench_send(client, server, args.messages, True)
+  bench_reconnect(client, server, args.reconnects)
+  server.stop()
+
+if __name__ == '__main__':
+  main()
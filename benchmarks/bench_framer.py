@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""
+  Benchmark of the receive path framing: ChunkDecoder against the http-parser HttpParser.
+
+  Usage: python benchmarks/bench_framer.py [messages]
+
+  A stream of JSON-RPC request chunks is fed in reads of different sizes. The
+  HttpParser path reproduces the previous receive loop, one recv_body() per read.
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from chunked import ChunkDecoder
+
+try:
+  from http_parser.parser import HttpParser
+except ImportError:
+  HttpParser = None
+
+HEADERS = 'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n'
+RPC = '{"jsonrpc":"2.0","method":"steering","params":{"value":%d,"speed":12.5},"id":%d}'
+
+def build_stream(count):
+  chunks = []
+  for i in range(count):
+    msg = RPC % (i % 180, i)
+    chunks.append('%x\r\n%s\r\n' % (len(msg), msg))
+  return HEADERS + ''.join(chunks)
+
+def reads(stream, size):
+  return [stream[i:i + size] for i in range(0, len(stream), size)]
+
+def bench_decoder(data):
+  decoder = ChunkDecoder()
+  count = 0
+  start = time.time()
+  for d in data:
+    decoder.feed(d)
+    for msg in decoder.messages():
+      count += 1
+  return count, time.time() - start
+
+def bench_http_parser(data):
+  parser = HttpParser()
+  count = 0
+  start = time.time()
+  for d in data:
+    parser.execute(d, len(d))
+    if parser.is_partial_body():
+      # the previous receive loop dispatched one body per read
+      parser.recv_body()
+      count += 1
+  return count, time.time() - start
+
+def main():
+  count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+  stream = build_stream(count)
+  print "%d messages, %d bytes" % (count, len(stream))
+  print "%-12s %10s %12s %12s %10s" % ('framer', 'read size', 'dispatched', 'msg/s', 'MB/s')
+  for size in (1024, 16384, 65536):
+    data = reads(stream, size)
+    paths = [('ChunkDecoder', bench_decoder)]
+    if HttpParser:
+      paths.append(('HttpParser', bench_http_parser))
+    for name, bench in paths:
+      n, elapsed = bench(data)
+      print "%-12s %10d %12d %12.0f %10.1f" % (name, size, n, count / elapsed, len(stream) / elapsed / 1e6)
+  if not HttpParser:
+    print "http-parser not installed, HttpParser path skipped"
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""
+  Load test of the gateway mode: many device sessions on one AutonomiaGateway against the local stand-in server.
+
+  Usage: python benchmarks/bench_gateway.py [--devices 1000] [--tls] [--duration 10] [--rpc-rate 500] [--data-rate 1]
+
+  The server runs in a separate process. The devices are attached, then RPC requests are
+  spread over all the devices and every device sends telemetry. Reported: attach time,
+  memory per device, RPC round-trip percentiles and CPU time per device.
+"""
+import os
+import sys
+import time
+import argparse
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from autonomialib import AutonomiaGateway
+from bench_e2e import ServerProcess, TELEMETRY, cpu_time, percentile
+
+def rss():
+  """
+  Return the resident memory of the process in bytes.
+  """
+  with open('/proc/self/status') as f:
+    for line in f:
+      if line.startswith('VmRSS:'):
+        return int(line.split()[1]) * 1024
+  return 0
+
+def main():
+  parser = argparse.ArgumentParser(description='Load test of the gateway mode.')
+  parser.add_argument('--devices', type=int, default=1000)
+  parser.add_argument('--tls', action='store_true', help='connect with TLS')
+  parser.add_argument('--duration', type=float, default=10, help='seconds of RPC and telemetry load')
+  parser.add_argument('--rpc-rate', type=int, default=500, help='RPC requests per second over all the devices')
+  parser.add_argument('--data-rate', type=float, default=1, help='telemetry messages per second per device')
+  args = parser.parse_args()
+
+  server = ServerProcess(args.tls)
+  gateway = AutonomiaGateway('BENCHMARK', lambda msg: None, use_ssl=args.tls, server='127.0.0.1', port=server.port)
+  loop = threading.Thread(target=gateway.run_forever)
+  loop.daemon = True
+  methods = ({'name': 'echo', 'function': lambda params: params},)
+
+  base = rss()
+  start = time.time()
+  cpu = cpu_time()
+  for i in range(args.devices):
+    gateway.add('GW%06d' % i, methods, 'gateway benchmark')
+  loop.start()
+  server.wait_attached(args.devices, 120)
+  # the server sends the attach reply before the session reads it
+  while gateway.stats()['attached'] < args.devices and time.time() - start < 120:
+    time.sleep(0.01)
+  if gateway.stats()['attached'] < args.devices:
+    print "Only %d of %d devices attached: %s" % (gateway.stats()['attached'], args.devices, gateway.stats())
+    return
+  attached = time.time() - start
+  cpu = cpu_time() - cpu
+  memory = rss() - base
+  print "%d devices attached%s in %.2f s, CPU %.2f ms per attach" % (args.devices, ' (TLS)' if args.tls else '', attached, cpu / args.devices * 1000)
+  print "Memory: %.1f MB, %.1f KB per device" % (memory / 1e6, memory / 1024.0 / args.devices)
+
+  # telemetry from every device in a thread, RPC requests from the server
+  clients = [gateway.session('GW%06d' % i) for i in range(args.devices)]
+  sent = [0, 0]
+  def telemetry():
+    end = time.time() + args.duration
+    interval = 1.0 / args.data_rate
+    while time.time() < end:
+      tick = time.time()
+      for client in clients:
+        if client.send_data(TELEMETRY % sent[0]) == 0:
+          sent[0] += 1
+        else:
+          sent[1] += 1
+      time.sleep(max(0, interval - (time.time() - tick)))
+  sender = threading.Thread(target=telemetry)
+  received = server.stats()['data_messages']
+  cpu = cpu_time()
+  start = time.time()
+  sender.start()
+  rtt = server.inject_rpc(args.rpc_rate, int(args.rpc_rate * args.duration), 'echo', {'value': 1}, '*')
+  sender.join()
+  elapsed = time.time() - start
+  cpu = cpu_time() - cpu
+
+  done = [t * 1000 for t in rtt if t is not None]
+  print "RPC round trip: %d requests at %d/s over %d devices, %d replies" % (len(rtt), args.rpc_rate, args.devices, len(done))
+  if done:
+    print "  p50 %.2f ms  p90 %.2f ms  p99 %.2f ms  max %.2f ms" % (percentile(done, 50), percentile(done, 90), percentile(done, 99), max(done))
+  time.sleep(0.5)
+  print "Telemetry: %d messages sent, %d rejected, %d received" % (sent[0], sent[1], server.stats()['data_messages'] - received)
+  print "CPU under load: %.1f%% of a core, %.1f us per device per second" % (cpu / elapsed * 100, cpu / elapsed / args.devices * 1e6)
+  print "Gateway sessions: %s" % gateway.stats()
+  gateway.close()
+  loop.join(5)
+  server.stop()
+
+if __name__ == '__main__':
+  main()
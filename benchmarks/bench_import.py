@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+"""
+  Benchmark of the SDK startup: import of autonomialib, construction of the client and MAC address lookup.
+
+  Usage: python benchmarks/bench_import.py [runs]
+
+  Every run is a fresh interpreter, so the times include the imports of the standard
+  library modules used by the SDK. The modules imported at startup are listed.
+"""
+import os
+import sys
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+STARTUP = r'''
+import sys, time
+sys.path.insert(0, %r)
+before = set(sys.modules)
+start = time.time()
+import autonomialib
+imported = time.time()
+client = autonomialib.AutonomiaClient('BENCHMARK', lambda msg: None)
+constructed = time.time()
+autonomialib.get_mac()
+mac = time.time()
+modules = sorted(m for m in set(sys.modules) - before if sys.modules[m] is not None and '.' not in m)
+print imported - start, constructed - imported, mac - constructed, ' '.join(modules)
+'''
+
+def main():
+  runs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+  samples = []
+  for i in range(runs):
+    out = subprocess.check_output([sys.executable, '-c', STARTUP % ROOT]).split(None, 3)
+    samples.append([float(t) * 1000 for t in out[:3]])
+    modules = out[3].strip() if len(out) > 3 else ''
+  print "%d runs, median times" % runs
+  for i, name in enumerate(('import autonomialib', 'AutonomiaClient()', 'get_mac()')):
+    values = sorted(s[i] for s in samples)
+    print "  %-20s %8.2f ms" % (name, values[len(values) / 2])
+  print "modules imported: %s" % modules
+
+if __name__ == '__main__':
+  main()
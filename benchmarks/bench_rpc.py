@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""
+  Micro-benchmark of the JSON-RPC message path: parse, dispatch and encode per message.
+
+  Usage: python benchmarks/bench_rpc.py [messages]
+
+  Representative requests, a status poll, a drive command and a batch, go through
+  parse_rpc_msg() (JSON decode and validation), dispatch_rpc() (method call and reply
+  encoding) and the whole message_handler(), with every JSON codec installed, and the
+  dispatch of the status poll answered by the RPC result cache.
+  Reported: the CPU time per message of every stage.
+"""
+import os
+import sys
+import time
+import json
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import jsoncodec
+from autonomialib import message_handler, parse_rpc_msg, dispatch_rpc, RPCCache
+
+STATUS = {'mode': 'autonomous', 'speed': 12.5, 'steering': 92, 'throttle': 104, 'battery': 7.9,
+          'gps': {'lat': 37.441902, 'lon': -122.143018, 'fix': 3, 'sats': 9}, 'video': 'streaming'}
+
+METHODS = {
+  'status': lambda params: STATUS,
+  'drive': lambda params: {'ok': True},
+  'camera': lambda params: {'width': 1280, 'height': 720, 'fps': 30, 'url': 'rtmp://stream.autonomia.io/live/1234'},
+}
+
+def requests():
+  status = json.dumps({'jsonrpc': '2.0', 'method': 'status', 'params': {}, 'id': 1})
+  drive = json.dumps({'jsonrpc': '2.0', 'method': 'drive', 'params': {'steering': 92, 'throttle': 104}, 'id': 'c-7'})
+  batch = json.dumps([{'jsonrpc': '2.0', 'method': name, 'params': {}, 'id': i} for i, name in enumerate(METHODS)])
+  return [('status', status), ('drive', drive), ('batch', batch)]
+
+def per_message(func, args, count):
+  start = time.clock()
+  for i in xrange(count):
+    func(*args)
+  return (time.clock() - start) / count * 1e6
+
+def main():
+  count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+  print "%-7s %-7s %12s %12s %12s" % ('codec', 'request', 'parse us', 'dispatch us', 'handler us')
+  for codec in jsoncodec.CODECS:
+    try:
+      jsoncodec.use(codec)
+    except ImportError:
+      continue
+    for name, msg in requests():
+      req, error = parse_rpc_msg(msg)
+      assert error is None
+      print "%-7s %-7s %12.2f %12.2f %12.2f" % (codec, name, per_message(parse_rpc_msg, (msg,), count),
+            per_message(dispatch_rpc, (req, METHODS), count), per_message(message_handler, (msg, len(msg), METHODS), count))
+    cache = RPCCache()
+    cache.configure('status', 60)
+    req, error = parse_rpc_msg(requests()[0][1])
+    print "%-7s %-7s %12s %12.2f" % (codec, 'cached', '', per_message(dispatch_rpc, (req, METHODS, None, None, cache), count))
+
+if __name__ == '__main__':
+  main()
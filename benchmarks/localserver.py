@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+"""
+  Local stand-in for the Autonomia server, to test and benchmark the device SDK without the cloud.
+
+  Usage: python benchmarks/localserver.py [--port 8080] [--tls] [--rpc-rate 10] [--method echo]
+
+  The server accepts the device attach POST, answers with the chunked attach reply and
+  records the device heartbeats, data messages and RPC replies. RPC requests can be
+  injected at a set rate and the round-trip time of every reply is recorded.
+"""
+import os
+import sys
+import ssl
+import time
+import json
+import shutil
+import socket
+import tempfile
+import argparse
+import threading
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from chunked import ChunkDecoder
+from compression import MessageDecompressor, MSG_COMPRESSED
+
+MSG_HEARTBEAT = '\x06'
+MSG_DATA = '\x07'
+
+def self_signed_cert(directory):
+  """
+  Create a self-signed certificate for localhost with openssl. Returns the certificate and key file names.
+  """
+  certfile = os.path.join(directory, 'cert.pem')
+  keyfile = os.path.join(directory, 'key.pem')
+  with open(os.devnull, 'w') as FNULL:
+    subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                           '-subj', '/CN=localhost', '-keyout', keyfile, '-out', certfile], stdout=FNULL, stderr=FNULL)
+  return certfile, keyfile
+
+class Session(object):
+  """
+  A device connection.
+  """
+
+  def __init__(self, server, sock, address):
+    self.server = server
+    self.sock = sock
+    self.address = address
+    self.device_id = None
+    self.app_key = None
+    self.attached_at = None
+    self.heartbeats = 0
+    self.data_messages = 0
+    self.data_bytes = 0
+    self.replies = 0
+    self.compressed = 0
+    self.wire_bytes = 0
+    self._lock = threading.Lock()
+
+  def send(self, msg):
+    """
+    Send a message to the device as a chunk.
+    """
+    with self._lock:
+      self.sock.sendall('%x\r\n%s\r\n' % (len(msg), msg))
+
+  def close(self):
+    try:
+      self.sock.shutdown(socket.SHUT_RDWR)
+    except socket.error:
+      pass
+    self.sock.close()
+
+  def run(self):
+    """
+    Read the attach request, send the attach reply and receive the device messages.
+    """
+    data = ''
+    try:
+      while '\r\n\r\n' not in data:
+        d = self.sock.recv(4096)
+        if not d:
+          return
+        data += d
+      head, _, body = data.partition('\r\n\r\n')
+      lines = head.split('\r\n')
+      # POST /v1/applications/<application key>/devices/<device id> HTTP/1.1
+      path = lines[0].split()[1].split('/')
+      self.app_key, self.device_id = path[3], path[5]
+      length = 0
+      for line in lines[1:]:
+        name, _, value = line.partition(':')
+        if name.strip().lower() == 'content-length':
+          length = int(value)
+      while len(body) < length:
+        d = self.sock.recv(4096)
+        if not d:
+          return
+        body += d
+
+      reply = '{"msg":"200","heartbeat":%d,"timestamp":%d}' % (self.server.heartbeat, time.time())
+      self.sock.sendall('HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n%x\r\n%s\r\n' % (len(reply), reply))
+      self.attached_at = time.time()
+      self.server._attached(self)
+
+      decoder = ChunkDecoder(headers=False)
+      decoder.feed(body[length:])
+      while True:
+        for msg in decoder.messages():
+          self._received(msg)
+        if decoder.recv_into(self.sock) == 0:
+          break
+    except (socket.error, ssl.SSLError, ValueError), e:
+      pass
+    finally:
+      self.server._detached(self)
+      self.sock.close()
+
+  def _received(self, msg):
+    """
+    Record a message from the device.
+    """
+    self.wire_bytes += len(msg)
+    if msg[:1] == MSG_COMPRESSED:
+      self.compressed += 1
+      msg = self.server.decompressor.decode(msg)
+    if msg == MSG_HEARTBEAT:
+      self.heartbeats += 1
+    elif msg[:1] == MSG_DATA:
+      self.data_messages += 1
+      self.data_bytes += len(msg) - 1
+    else:
+      self.replies += 1
+      self.server._reply(self, msg)
+
+class LocalServer(object):
+  """
+  Local stand-in for the Autonomia server.
+  Methods exported:
+    LocalServer(host='127.0.0.1', port=0, tls=False, heartbeat=60, dictionary='') -- Object constructor
+    start() -- Start accepting device connections, returns the port
+    stop() -- Close the server and the device connections
+    wait_attached(count=1, timeout=10) -- Wait for a number of attached devices
+    send_rpc(method, params, device_id=None) -- Send a JSON-RPC request, returns the request id
+    inject_rpc(rate, count, method='echo', params=None, device_id=None) -- Send requests at a rate and return the round-trip times
+    drop(device_id=None) -- Close device connections, returns the time of the disconnection
+    stats() -- Counters of the received messages
+  """
+
+  def __init__(self, host='127.0.0.1', port=0, tls=False, heartbeat=60, certfile=None, keyfile=None, dictionary=''):
+    """
+    host, port: listening address -- port 0 for any free port
+    tls: accept TLS connections, with a self-signed certificate if certfile is not given
+    heartbeat: heartbeat interval in seconds returned in the attach reply
+    dictionary: preset dictionary of the compressed messages
+    """
+    self.host = host
+    self.port = port
+    self.tls = tls
+    self.heartbeat = heartbeat
+    self.certfile = certfile
+    self.keyfile = keyfile
+    self.decompressor = MessageDecompressor(dictionary)
+    self.sessions = {}     # device id -> Session
+    self.attaches = 0
+    self.attach_times = []
+    self._tmpdir = None
+    self._sock = None
+    self._next_id = 0
+    self._pending = {}     # request id -> time sent
+    self._rtt = {}         # request id -> round-trip time
+    self._cond = threading.Condition()
+
+  def start(self):
+    """
+    Start accepting device connections. Returns the listening port.
+    """
+    if self.tls and not self.certfile:
+      self._tmpdir = tempfile.mkdtemp()
+      self.certfile, self.keyfile = self_signed_cert(self._tmpdir)
+    self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self._sock.bind((self.host, self.port))
+    self._sock.listen(128)
+    self.port = self._sock.getsockname()[1]
+    t = threading.Thread(target=self._accept)
+    t.daemon = True
+    t.start()
+    return self.port
+
+  def stop(self):
+    """
+    Close the server and the device connections.
+    """
+    self._sock.close()
+    self.drop()
+    if self._tmpdir:
+      shutil.rmtree(self._tmpdir, ignore_errors=True)
+
+  def wait_attached(self, count=1, timeout=10):
+    """
+    Wait until count devices are attached. Returns False on timeout.
+    """
+    end = time.time() + timeout
+    with self._cond:
+      while len(self.sessions) < count:
+        left = end - time.time()
+        if left <= 0:
+          return False
+        self._cond.wait(left)
+    return True
+
+  def send_rpc(self, method, params=None, device_id=None):
+    """
+    Send a JSON-RPC request to a device, to the first attached device if device_id is None.
+    Returns the request id.
+    """
+    with self._cond:
+      session = self.sessions[device_id] if device_id else self.sessions.values()[0]
+      self._next_id += 1
+      id = self._next_id
+      self._pending[id] = time.time()
+    session.send(json.dumps({'jsonrpc': '2.0', 'method': method, 'params': params if params is not None else {}, 'id': id}))
+    return id
+
+  def inject_rpc(self, rate, count, method='echo', params=None, device_id=None, timeout=10):
+    """
+    Send count requests at rate requests per second and wait for the replies.
+    With device_id '*' the requests are sent in turn to all the attached devices.
+    Returns the list of round-trip times in seconds, None for a missing reply.
+    """
+    ids = []
+    devices = [device_id]
+    if device_id == '*':
+      with self._cond:
+        devices = self.sessions.keys()
+    start = time.time()
+    for i in range(count):
+      delay = start + float(i) / rate - time.time()
+      if delay > 0:
+        time.sleep(delay)
+      try:
+        ids.append(self.send_rpc(method, params, devices[i % len(devices)]))
+      except (KeyError, socket.error):
+        # the device is not attached
+        ids.append(None)
+    end = time.time() + timeout
+    with self._cond:
+      while any(id in self._pending for id in ids) and time.time() < end:
+        self._cond.wait(end - time.time())
+      for id in ids:
+        self._pending.pop(id, None)
+      return [self._rtt.pop(id, None) for id in ids]
+
+  def drop(self, device_id=None):
+    """
+    Close the connection of a device, of all the devices if device_id is None.
+    Returns the time of the disconnection.
+    """
+    with self._cond:
+      sessions = [self.sessions[device_id]] if device_id else self.sessions.values()
+    now = time.time()
+    for session in sessions:
+      session.close()
+    return now
+
+  def stats(self):
+    """
+    Return the counters of the attaches and of the messages received from the devices.
+    """
+    with self._cond:
+      sessions = self.sessions.values()
+      return {'attached': len(sessions), 'attaches': self.attaches,
+              'heartbeats': sum(s.heartbeats for s in sessions),
+              'data_messages': sum(s.data_messages for s in sessions),
+              'data_bytes': sum(s.data_bytes for s in sessions),
+              'replies': sum(s.replies for s in sessions),
+              'compressed': sum(s.compressed for s in sessions),
+              'wire_bytes': sum(s.wire_bytes for s in sessions)}
+
+  def _accept(self):
+    while True:
+      try:
+        sock, address = self._sock.accept()
+      except socket.error:
+        return
+      if self.tls:
+        try:
+          sock = ssl.wrap_socket(sock, server_side=True, certfile=self.certfile, keyfile=self.keyfile)
+        except (socket.error, ssl.SSLError), e:
+          sock.close()
+          continue
+      session = Session(self, sock, address)
+      t = threading.Thread(target=session.run)
+      t.daemon = True
+      t.start()
+
+  def _attached(self, session):
+    with self._cond:
+      old = self.sessions.get(session.device_id)
+      self.sessions[session.device_id] = session
+      self.attaches += 1
+      self.attach_times.append(session.attached_at)
+      self._cond.notify_all()
+    if old:
+      old.close()
+
+  def _detached(self, session):
+    with self._cond:
+      if self.sessions.get(session.device_id) is session:
+        del self.sessions[session.device_id]
+
+  def _reply(self, session, msg):
+    now = time.time()
+    try:
+      replies = json.loads(msg)
+    except ValueError:
+      return
+    if not isinstance(replies, list):
+      replies = [replies]
+    with self._cond:
+      for reply in replies:
+        id = reply.get('id') if isinstance(reply, dict) else None
+        sent = self._pending.pop(id, None)
+        if sent is not None:
+          self._rtt[id] = now - sent
+      self._cond.notify_all()
+
+def main():
+  parser = argparse.ArgumentParser(description='Local stand-in for the Autonomia server.')
+  parser.add_argument('--host', default='127.0.0.1')
+  parser.add_argument('--port', type=int, default=8080)
+  parser.add_argument('--tls', action='store_true', help='accept TLS connections with a self-signed certificate')
+  parser.add_argument('--heartbeat', type=int, default=60, help='heartbeat interval returned to the devices')
+  parser.add_argument('--rpc-rate', type=float, default=0, help='RPC requests per second sent to the first device')
+  parser.add_argument('--method', default='echo', help='RPC method to call')
+  args = parser.parse_args()
+
+  server = LocalServer(args.host, args.port, args.tls, args.heartbeat)
+  print "Listening on %s:%d%s" % (args.host, server.start(), ' (TLS)' if args.tls else '')
+  try:
+    while True:
+      if args.rpc_rate and server.sessions:
+        rtt = server.inject_rpc(args.rpc_rate, max(1, int(args.rpc_rate)), args.method)
+        done = [t for t in rtt if t is not None]
+        print "%d/%d replies, max round trip %.1f ms" % (len(done), len(rtt), max(done) * 1000 if done else 0)
+      else:
+        time.sleep(1)
+      print server.stats()
+  except KeyboardInterrupt:
+    server.stop()
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+"""
+  Replay a traffic capture through the receive pipeline of the device SDK, offline.
+
+  Usage: python benchmarks/replay.py capture [--speed 0] [--methods module] [--codec json] [--repeat 1]
+
+  The data received in the capture, recorded with AutonomiaClient.set_capture(), is fed
+  to the ChunkDecoder in the reads of the capture, and every RPC request goes through
+  parse_rpc_msg() and dispatch_rpc(), as in the client. The RPC methods echo their params,
+  or are the methods of --methods module, a module with a rpc_methods tuple as given to attach().
+  With --speed 1 the reads are replayed at the times of the capture, 2 twice as fast,
+  0 as fast as possible. Reported per stage: calls, total time, mean and percentiles of a call,
+  and the Python objects allocated and not freed per call (the garbage collector is disabled).
+"""
+import os
+import sys
+import gc
+import time
+import argparse
+import resource
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import jsoncodec
+from chunked import ChunkDecoder
+from capture import CaptureReader, CONNECT, INBOUND, OUTBOUND
+from autonomialib import parse_rpc_msg, dispatch_rpc
+
+MSG_HEARTBEAT = '\x06'
+MSG_DATA = '\x07'
+
+class EchoMethods(dict):
+  """
+  RPC methods registry where every method returns its params.
+  """
+
+  def get(self, name, default=None):
+    return lambda params: params
+
+class Stage(object):
+  """
+  Timings and allocations of a stage of the pipeline.
+  """
+
+  def __init__(self, name):
+    self.name = name
+    self.times = []
+    self.objects = 0
+
+  def run(self, func, *args):
+    objects = gc.get_count()[0]
+    start = time.time()
+    result = func(*args)
+    self.times.append(time.time() - start)
+    self.objects += gc.get_count()[0] - objects
+    return result
+
+  def report(self):
+    n = len(self.times)
+    if not n:
+      print "%-9s %8d" % (self.name, 0)
+      return
+    times = sorted(self.times)
+    print "%-9s %8d %10.2f %9.2f %9.2f %9.2f %9.2f %9.1f" % (self.name, n, sum(times) * 1e3, sum(times) / n * 1e6,
+          times[n // 2] * 1e6, times[min(n - 1, int(n * 0.99))] * 1e6, times[-1] * 1e6, float(self.objects) / n)
+
+def outbound_messages(records):
+  """
+  Count the messages sent in the capture: heartbeats, data messages and RPC replies.
+  """
+  counts = {'heartbeats': 0, 'data': 0, 'replies': 0}
+  decoder = None
+  for kind, t, data in records:
+    if kind == CONNECT:
+      decoder = None
+    elif kind == OUTBOUND:
+      if decoder is None:
+        # the attach request, the chunks follow
+        decoder = ChunkDecoder(headers=False)
+        continue
+      decoder.feed(data)
+      for msg in decoder.messages():
+        if msg == MSG_HEARTBEAT:
+          counts['heartbeats'] += 1
+        elif msg[:1] == MSG_DATA:
+          counts['data'] += 1
+        else:
+          counts['replies'] += 1
+  return counts
+
+def replay(records, rpc_methods, speed):
+  """
+  Feed the inbound records through the pipeline. Returns the stages and the number of replies.
+  """
+  decode = Stage('decode')
+  parse = Stage('parse')
+  dispatch = Stage('dispatch')
+  replies = 0
+  decoder = None
+  attached = False
+  start = time.time()
+  for kind, t, data in records:
+    if kind == CONNECT:
+      decoder = ChunkDecoder()
+      attached = False
+      continue
+    if kind != INBOUND or decoder is None:
+      continue
+    if speed:
+      delay = start + t / speed - time.time()
+      if delay > 0:
+        time.sleep(delay)
+    decoder.feed(data)
+    try:
+      messages = decode.run(lambda: list(decoder.messages()))
+    except ValueError, e:
+      print "capture at %.3f s: %s" % (t, e)
+      decoder = None
+      continue
+    for msg in messages:
+      if not attached:
+        # the attach reply
+        attached = True
+        continue
+      req, error = parse.run(parse_rpc_msg, msg)
+      if not error:
+        dispatch.run(dispatch_rpc, req, rpc_methods)
+      replies += 1
+  return [decode, parse, dispatch], replies
+
+def main():
+  parser = argparse.ArgumentParser(description='Replay a traffic capture through the receive pipeline.')
+  parser.add_argument('capture')
+  parser.add_argument('--speed', type=float, default=0, help='replay speed, 1 for the times of the capture, 0 as fast as possible')
+  parser.add_argument('--methods', help='module with the rpc_methods tuple of the device')
+  parser.add_argument('--codec', help='JSON codec: ujson or json')
+  parser.add_argument('--repeat', type=int, default=1, help='replay the capture more times')
+  args = parser.parse_args()
+
+  if args.codec:
+    jsoncodec.use(args.codec)
+  rpc_methods = EchoMethods()
+  if args.methods:
+    module = __import__(args.methods)
+    rpc_methods = dict((m['name'], m['function']) for m in module.rpc_methods)
+
+  reader = CaptureReader(args.capture)
+  records = list(reader.records())
+  reader.close()
+  inbound = [r for r in records if r[0] == INBOUND]
+  duration = records[-1][1] if records else 0
+  print "%s: %d records over %.1f s, %d reads of %d bytes, started %s" % (args.capture, len(records), duration,
+        len(inbound), sum(len(r[2]) for r in inbound), time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(reader.started)))
+  print "sent in the capture: %s" % outbound_messages(records)
+  print "JSON codec: %s" % jsoncodec.name
+
+  gc.disable()
+  for i in range(args.repeat):
+    start = time.time()
+    stages, replies = replay(records, rpc_methods, args.speed)
+    elapsed = time.time() - start
+    print
+    print "replay %d: %d requests in %.3f s" % (i + 1, replies, elapsed)
+    print "%-9s %8s %10s %9s %9s %9s %9s %9s" % ('stage', 'calls', 'total ms', 'mean us', 'p50 us', 'p99 us', 'max us', 'objects')
+    for stage in stages:
+      stage.report()
+  gc.enable()
+  print
+  print "peak RSS %.1f MB" % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,157 @@
+"""
+  Capture of the raw traffic of a device connection, to replay it offline through the receive pipeline.
+
+  Copyright 2016 Visible Energy Inc. All Rights Reserved.
+"""
+__license__ = """
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+__all__ = ["CaptureWriter", "CaptureReader", "monotonic"]
+
+import os
+import time
+import struct
+import threading
+
+# file header: magic, version, wall clock time of the start of the capture
+HEADER = struct.Struct('<4sBd')
+MAGIC = 'ACAP'
+VERSION = 1
+# record header: type, microseconds since the start of the capture, length of the data
+RECORD = struct.Struct('<cQI')
+
+# record types
+CONNECT = 'C'    # a new connection: the inbound data starts with the HTTP response headers
+INBOUND = 'I'    # data received from the server, as read from the socket
+OUTBOUND = 'O'   # data written to the server
+
+def _monotonic_clock():
+  """
+  Return a function returning the seconds of CLOCK_MONOTONIC, time.time on the platforms without it.
+  """
+  try:
+    import ctypes
+    import ctypes.util
+
+    class timespec(ctypes.Structure):
+      _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1', use_errno=True)
+    clock_gettime = librt.clock_gettime
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    ts = timespec()
+    ref = ctypes.byref(ts)
+    def monotonic():
+      clock_gettime(1, ref)   # CLOCK_MONOTONIC
+      return ts.tv_sec + ts.tv_nsec * 1e-9
+    monotonic()
+    return monotonic
+  except Exception, e:
+    return time.time
+
+monotonic = _monotonic_clock()
+
+class CaptureWriter(object):
+  """
+  Append the traffic of a connection to a capture file: one record per socket read and per write,
+  with the time from a monotonic clock. The capture stops when the file reaches max_bytes.
+  Methods exported:
+    CaptureWriter(path, max_bytes=67108864) -- Object constructor, creates the file
+    connect() -- Record the start of a connection
+    inbound(data) -- Record data received from the server
+    outbound(data) -- Record data written to the server
+    close() -- Close the file
+    stats() -- Records and bytes written and dropped
+  """
+
+  def __init__(self, path, max_bytes=67108864):
+    """
+    path: capture file name, overwritten
+    max_bytes: maximum size of the file, the records past the limit are dropped
+    """
+    self.path = path
+    self.max_bytes = max_bytes
+    self._file = open(path, 'wb')
+    self._file.write(HEADER.pack(MAGIC, VERSION, time.time()))
+    self._start = monotonic()
+    self._size = HEADER.size
+    self._lock = threading.Lock()
+    self._records = 0
+    self._dropped = 0
+
+  def connect(self):
+    self._record(CONNECT, '')
+
+  def inbound(self, data):
+    self._record(INBOUND, data)
+
+  def outbound(self, data):
+    self._record(OUTBOUND, data)
+
+  def close(self):
+    with self._lock:
+      if self._file:
+        self._file.close()
+        self._file = None
+
+  def stats(self):
+    """
+    Return a dictionary with the records written and dropped and the size of the file.
+    """
+    with self._lock:
+      return {'records': self._records, 'dropped': self._dropped, 'bytes': self._size, 'max_bytes': self.max_bytes}
+
+  def _record(self, kind, data):
+    t = int((monotonic() - self._start) * 1e6)
+    with self._lock:
+      if not self._file or self._size + RECORD.size + len(data) > self.max_bytes:
+        self._dropped += 1
+        return
+      self._file.write(RECORD.pack(kind, t, len(data)))
+      self._file.write(data)
+      self._size += RECORD.size + len(data)
+      self._records += 1
+
+class CaptureReader(object):
+  """
+  Read the records of a capture file.
+  Methods exported:
+    CaptureReader(path) -- Object constructor, opens the file
+    records() -- Iterate over the records: (type, seconds since the start, data)
+    close() -- Close the file
+  """
+
+  def __init__(self, path):
+    """
+    path: capture file of a CaptureWriter
+    """
+    self._file = open(path, 'rb')
+    magic, version, self.started = HEADER.unpack(self._file.read(HEADER.size))
+    if magic != MAGIC or version != VERSION:
+      raise ValueError("%s is not a capture file" % path)
+
+  def records(self):
+    """
+    Iterate over the records as (type, seconds since the start of the capture, data).
+    A record truncated by the end of the file ends the iteration.
+    """
+    while True:
+      head = self._file.read(RECORD.size)
+      if len(head) < RECORD.size:
+        return
+      kind, t, n = RECORD.unpack(head)
+      data = self._file.read(n)
+      if len(data) < n:
+        return
+      yield kind, t / 1e6, data
+
+  def close(self):
+    self._file.close()
@@ -0,0 +1,167 @@
+"""
+  Incremental decoder for the Autonomia server HTTP response with chunked transfer encoding.
+
+  Copyright 2016 Visible Energy Inc. All Rights Reserved.
+"""
+__license__ = """
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+__all__ = ["ChunkDecoder"]
+
+# maximum length of the header block or of a chunk size line
+MAX_LINE = 8192
+# the digits of a chunk size: int(..., 16) also takes a sign, a 0x prefix and spaces
+HEX_DIGITS = '0123456789abcdefABCDEF'
+
+class ChunkDecoder(object):
+  """
+  Decode a HTTP response with chunked transfer encoding as the data arrives.
+  Each chunk is one Autonomia message. The data is received in a reusable buffer
+  and every complete message is returned, whatever the number of chunks in a read.
+  Methods exported:
+    ChunkDecoder(bufsize=65536, headers=True, max_message=None) -- Object constructor
+    recv_into(sock, size) -- Receive from a socket directly into the buffer
+    feed(data) -- Append received data to the buffer
+    tail(n) -- The last n bytes received
+    next_message() -- Return the next complete message or None
+    messages() -- Iterate over the complete messages in the buffer
+  """
+
+  def __init__(self, bufsize=65536, headers=True, max_message=None):
+    """
+    bufsize: initial size of the receive buffer, it grows to hold the largest chunk
+    headers: the data starts with the HTTP response status line and headers -- False for a bare chunk stream
+    max_message: maximum size of a chunk, to bound the buffer -- None for no limit
+    """
+    self.max_message = max_message
+    self.status = None
+    self.headers = None if headers else {}
+    self.complete = False
+    self._buf = bytearray(bufsize)
+    self._start = 0   # first byte not yet decoded
+    self._end = 0     # end of the received data
+
+  def recv_into(self, sock, size=16384):
+    """
+    Receive at most size bytes from the socket into the buffer.
+    Returns the number of bytes received, 0 if the connection has been closed.
+    """
+    self._reserve(size)
+    n = sock.recv_into(memoryview(self._buf)[self._end:], size)
+    self._end += n
+    return n
+
+  def feed(self, data):
+    """
+    Append received data to the buffer.
+    """
+    n = len(data)
+    self._reserve(n)
+    self._buf[self._end:self._end + n] = data
+    self._end += n
+    return
+
+  def tail(self, n):
+    """
+    Return a copy of the last n bytes received, before they are decoded.
+    """
+    return str(self._buf[self._end - n:self._end])
+
+  def buffered(self):
+    """
+    Return the number of received bytes not yet decoded.
+    """
+    return self._end - self._start
+
+  def messages(self):
+    """
+    Iterate over the complete messages in the buffer.
+    """
+    while True:
+      msg = self.next_message()
+      if msg is None:
+        return
+      yield msg
+
+  def next_message(self):
+    """
+    Return the payload of the next complete chunk or None if more data is needed.
+    Raises ValueError if the data is not a chunked HTTP response.
+    """
+    if self.headers is None and not self._parse_headers():
+      return None
+    if self.complete:
+      return None
+
+    buf = self._buf
+    eol = buf.find('\r\n', self._start, self._end)
+    if eol < 0:
+      if self._end - self._start > MAX_LINE:
+        raise ValueError("chunk size line too long")
+      return None
+    # chunk extensions after ';' are ignored
+    field = str(buf[self._start:eol]).split(';')[0].rstrip(' \t')
+    if not field or field.strip(HEX_DIGITS):
+      raise ValueError("invalid chunk size")
+    size = int(field, 16)
+    if self.max_message is not None and size > self.max_message:
+      raise ValueError("chunk of %d bytes larger than %d" % (size, self.max_message))
+
+    data = eol + 2
+    if self._end < data + size + 2:
+      # the chunk is not complete
+      return None
+    msg = memoryview(buf)[data:data + size].tobytes()
+    self._start = data + size + 2
+    if self._start == self._end:
+      self._start = self._end = 0
+    if size == 0:
+      # last chunk, the response is complete
+      self.complete = True
+      return None
+    return msg
+
+  def _parse_headers(self):
+    """
+    Parse the status line and headers. Returns False if the header block is not complete.
+    """
+    eoh = self._buf.find('\r\n\r\n', self._start, self._end)
+    if eoh < 0:
+      if self._end - self._start > MAX_LINE:
+        raise ValueError("headers too long")
+      return False
+
+    lines = str(self._buf[self._start:eoh]).split('\r\n')
+    try:
+      self.status = int(lines[0].split()[1])
+    except (IndexError, ValueError):
+      raise ValueError("invalid status line: %s" % lines[0])
+    self.headers = {}
+    for line in lines[1:]:
+      name, _, value = line.partition(':')
+      self.headers[name.strip().lower()] = value.strip()
+    self._start = eoh + 4
+    return True
+
+  def _reserve(self, size):
+    """
+    Make room for size bytes at the end of the buffer, moving the undecoded data to the front.
+    """
+    if len(self._buf) - self._end >= size:
+      return
+    pending = self._end - self._start
+    if self._start > 0:
+      self._buf[0:pending] = self._buf[self._start:self._end]
+      self._start = 0
+      self._end = pending
+    if len(self._buf) - self._end < size:
+      self._buf.extend(bytearray(size - (len(self._buf) - self._end)))
+    return
@@ -0,0 +1,123 @@
+"""
+  Per-message deflate compression of the upstream messages with a shared preset dictionary.
+
+  Copyright 2016 Visible Energy Inc. All Rights Reserved.
+"""
+__license__ = """
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+__all__ = ["MessageCompressor", "MessageDecompressor", "sample_dictionary"]
+
+import zlib
+import threading
+
+# first byte of a compressed message, followed by the raw deflate data of the original message
+MSG_COMPRESSED = '\x08'
+# deflate window of 8 KB: the dictionary and the matches are within the last 8 KB,
+# and the compressor state copied for every message stays small
+WINDOW_BITS = 13
+MEM_LEVEL = 5
+# end of a deflate sync flush, removed from the messages and added back by the receiver
+SYNC_TRAILER = '\x00\x00\xff\xff'
+
+def sample_dictionary(samples, size=1 << WINDOW_BITS):
+  """
+  Build a preset dictionary from sample messages: the last size bytes of the samples.
+  The most frequent content should be at the end, where the matches are the shortest to encode.
+  """
+  return ''.join(samples)[-size:]
+
+class MessageCompressor(object):
+  """
+  Compress every message on its own with raw deflate, starting from a compressor primed with a preset
+  dictionary. The messages do not depend on each other: they can be buffered, spooled, sent by different
+  threads or after a reconnection, and decompressed in any order by a MessageDecompressor with the same dictionary.
+  Python 2 zlib has no preset dictionary, the dictionary is compressed once and the compressor state is copied.
+  Methods exported:
+    MessageCompressor(dictionary='', level=6, threshold=64) -- Object constructor
+    compress(data, marker='') -- The compressed message, or None if it is not worth compressing
+    stats() -- Message and byte counters
+  """
+
+  def __init__(self, dictionary='', level=6, threshold=64):
+    """
+    dictionary: content frequent in the messages, i.e. sample_dictionary(messages) -- up to 8 KB are used
+    level: zlib compression level, 1 (fastest) to 9 (smallest)
+    threshold: messages shorter than threshold bytes are sent raw
+    """
+    self.threshold = threshold
+    self._primed = zlib.compressobj(level, zlib.DEFLATED, -WINDOW_BITS, MEM_LEVEL)
+    if dictionary:
+      self._primed.compress(dictionary)
+      self._primed.flush(zlib.Z_SYNC_FLUSH)
+    self._lock = threading.Lock()
+    self._messages = 0
+    self._compressed = 0
+    self._raw_bytes = 0
+    self._compressed_bytes = 0
+
+  def compress(self, data, marker=''):
+    """
+    Return the compressed message of marker and data, starting with MSG_COMPRESSED,
+    or None if the message is shorter than the threshold or does not get shorter.
+    """
+    size = len(marker) + len(data)
+    if size < self.threshold:
+      return None
+    c = self._primed.copy()
+    out = c.compress(marker) + c.compress(data) + c.flush(zlib.Z_SYNC_FLUSH)
+    out = MSG_COMPRESSED + out[:-len(SYNC_TRAILER)]
+    with self._lock:
+      self._messages += 1
+      self._raw_bytes += size
+      if len(out) >= size:
+        self._compressed_bytes += size
+        return None
+      self._compressed += 1
+      self._compressed_bytes += len(out)
+    return out
+
+  def stats(self):
+    """
+    Return a dictionary with the messages over the threshold, the messages sent compressed,
+    the bytes before and after compression and their ratio.
+    """
+    with self._lock:
+      return {'messages': self._messages, 'compressed': self._compressed, 'raw_bytes': self._raw_bytes,
+              'compressed_bytes': self._compressed_bytes,
+              'ratio': float(self._raw_bytes) / self._compressed_bytes if self._compressed_bytes else None}
+
+class MessageDecompressor(object):
+  """
+  Decompress the messages of a MessageCompressor, on the receiving side.
+  Methods exported:
+    MessageDecompressor(dictionary='') -- Object constructor
+    decode(msg) -- The original message of a compressed or raw message
+  """
+
+  def __init__(self, dictionary=''):
+    """
+    dictionary: the dictionary of the MessageCompressor
+    """
+    self._primed = zlib.decompressobj(-WINDOW_BITS)
+    if dictionary:
+      c = zlib.compressobj(6, zlib.DEFLATED, -WINDOW_BITS, MEM_LEVEL)
+      self._primed.decompress(c.compress(dictionary) + c.flush(zlib.Z_SYNC_FLUSH))
+
+  def decode(self, msg):
+    """
+    Return the original message: decompressed if it starts with MSG_COMPRESSED, else unchanged.
+    Raises zlib.error if the compressed data is invalid.
+    """
+    if msg[:1] != MSG_COMPRESSED:
+      return msg
+    d = self._primed.copy()
+    return d.decompress(msg[1:] + SYNC_TRAILER)
@@ -0,0 +1,328 @@
+"""
+  Shared-memory tap of the camera frames, to read the frames on the device while they are streamed.
+
+  Copyright 2016 Visible Energy Inc. All Rights Reserved.
+"""
+__license__ = """
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+__all__ = ["FrameTap", "FrameReader", "Frame"]
+
+import os
+import time
+import mmap
+import errno
+import fcntl
+import struct
+import threading
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+# file header: magic, version, slots, width, height, channels, last sequence number
+HEADER = struct.Struct('<4sIIIIIQ')
+MAGIC = 'AFRM'
+VERSION = 1
+# slot header: sequence number, timestamp -- the sequence number is 0 while the slot is written
+SLOT = struct.Struct('<Qd')
+
+# bytes per pixel of the raw video formats
+PIXEL_FORMATS = {'gray': 1, 'rgb24': 3, 'bgr24': 3}
+
+# Linux fcntl commands of the pipe buffer size
+F_SETPIPE_SZ = 1031
+F_GETPIPE_SZ = 1032
+# maximum pipe buffer size of the unprivileged processes
+PIPE_MAX_SIZE = '/proc/sys/fs/pipe-max-size'
+
+class Frame(object):
+  """
+  A frame in the ring buffer. data is a read-only buffer over the shared memory, not a copy:
+  the frame is valid until the writer reuses its slot, see FrameReader.valid().
+  """
+
+  def __init__(self, seq, timestamp, width, height, channels, data, offset):
+    self.seq = seq
+    self.timestamp = timestamp
+    self.width = width
+    self.height = height
+    self.channels = channels
+    self.data = data
+    self._offset = offset
+
+  def array(self):
+    """
+    Return the frame as a height x width x channels NumPy array over the shared memory.
+    """
+    if numpy is None:
+      raise ImportError("numpy is not installed")
+    return numpy.frombuffer(self.data, numpy.uint8).reshape(self.height, self.width, self.channels)
+
+class FrameRing(object):
+  """
+  A ring of frame slots in a memory-mapped file.
+  """
+
+  def __init__(self, path, width, height, channels, slots, write):
+    self.path = path
+    self.width = width
+    self.height = height
+    self.channels = channels
+    self.slots = slots
+    self.frame_size = width * height * channels
+    self.slot_size = SLOT.size + self.frame_size
+    size = HEADER.size + slots * self.slot_size
+    if write:
+      self._fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0644)
+      os.ftruncate(self._fd, size)
+      self._map = mmap.mmap(self._fd, size)
+      HEADER.pack_into(self._map, 0, MAGIC, VERSION, slots, width, height, channels, 0)
+    else:
+      self._fd = os.open(path, os.O_RDONLY)
+      self._map = mmap.mmap(self._fd, size, prot=mmap.PROT_READ)
+
+  def last_seq(self):
+    return HEADER.unpack_from(self._map, 0)[6]
+
+  def offset(self, seq):
+    return HEADER.size + (seq % self.slots) * self.slot_size
+
+  def close(self):
+    self._map.close()
+    os.close(self._fd)
+
+class FrameTap(object):
+  """
+  Publish the frames of the streamer in a shared-memory ring buffer.
+  ffmpeg writes a second, raw video output to a named pipe and a thread copies every frame
+  into the next slot of the ring. The readers never block the streamer: a slow reader misses frames.
+  The pipe buffer is enlarged to hold slots frames, so that a stall of the copy thread, i.e. waiting for the GIL,
+  does not block the ffmpeg output. The size is capped by /proc/sys/fs/pipe-max-size, 1 MB by default, for
+  the processes without CAP_SYS_RESOURCE: past that a stall longer than the buffered frames blocks ffmpeg.
+  Methods exported:
+    FrameTap(path, width=320, height=240, fps=10, pix_fmt='rgb24', keyframes=False, slots=4) -- Object constructor
+    ffmpeg_output() -- ffmpeg options of the tap output
+    start() -- Start copying the frames into the ring buffer
+    stop() -- Stop the tap and remove the named pipe
+    stats() -- Frame counters
+  """
+
+  def __init__(self, path, width=320, height=240, fps=10, pix_fmt='rgb24', keyframes=False, slots=4):
+    """
+    path: ring buffer file name, i.e. /dev/shm/autonomia-frames
+    width, height, fps: size and rate of the frames, scaled by ffmpeg
+    pix_fmt: gray, rgb24 or bgr24
+    keyframes: publish the keyframes only, each once as the encoder produces them: fps does not apply
+    slots: number of frames in the ring buffer
+    """
+    if pix_fmt not in PIXEL_FORMATS:
+      raise ValueError("unsupported pixel format %s" % pix_fmt)
+    self.path = path
+    self.fifo = path + '.fifo'
+    self.fps = fps
+    self.pix_fmt = pix_fmt
+    self.keyframes = keyframes
+    self.frames = 0
+    self.partial = 0
+    self.pipe_size = None   # bytes of the named pipe buffer, set when ffmpeg opens the pipe
+    self._ring = FrameRing(path, width, height, PIXEL_FORMATS[pix_fmt], slots, True)
+    self._seq = 0
+    self._thread = None
+    self._stopped = False
+
+  def ffmpeg_output(self):
+    """
+    Return the ffmpeg options of the tap output, to append after the stream output.
+    """
+    vf = 'scale=%d:%d' % (self._ring.width, self._ring.height)
+    if self.keyframes:
+      # every selected keyframe once: a constant output rate would repeat it to fill the rate
+      rate = ['-vsync', 'vfr']
+      vf = "select='eq(pict_type\\,I)'," + vf
+    else:
+      rate = ['-r', str(self.fps)]
+    return ['-map', '0:v', '-an', '-vf', vf] + rate + ['-pix_fmt', self.pix_fmt, '-f', 'rawvideo', '-y', self.fifo]
+
+  def start(self):
+    """
+    Create the named pipe and start the thread copying the frames into the ring buffer.
+    """
+    if self._thread:
+      return
+    try:
+      os.mkfifo(self.fifo)
+    except OSError, e:
+      if e.errno != errno.EEXIST:
+        raise
+    self._stopped = False
+    self._thread = threading.Thread(target=self._run)
+    self._thread.daemon = True
+    self._thread.start()
+    return
+
+  def stop(self):
+    """
+    Stop the tap thread and remove the named pipe. The ring buffer file is left to the readers.
+    """
+    self._stopped = True
+    try:
+      # unblock the thread waiting for ffmpeg to open the pipe
+      fd = os.open(self.fifo, os.O_WRONLY | os.O_NONBLOCK)
+      os.close(fd)
+    except OSError:
+      pass
+    if self._thread:
+      self._thread.join(1)
+      self._thread = None
+    try:
+      os.unlink(self.fifo)
+    except OSError:
+      pass
+    return
+
+  def stats(self):
+    """
+    Return a dictionary with the number of frames published and of the incomplete frames discarded,
+    and the size of the pipe buffer.
+    """
+    return {'frames': self.frames, 'partial': self.partial, 'last_seq': self._seq, 'pipe_size': self.pipe_size}
+
+  def _grow_pipe(self, fd):
+    """
+    Enlarge the buffer of the pipe to slots frames, or to the maximum size allowed.
+    Returns the size of the buffer.
+    """
+    size = self._ring.slots * self._ring.frame_size
+    try:
+      with open(PIPE_MAX_SIZE) as f:
+        limit = int(f.read())
+    except (IOError, ValueError):
+      limit = size
+    for n in (size, min(size, limit)):
+      try:
+        fcntl.fcntl(fd, F_SETPIPE_SZ, n)
+        break
+      except IOError:
+        # EPERM over the limit, EBUSY smaller than the data buffered, EINVAL not Linux
+        pass
+    try:
+      return fcntl.fcntl(fd, F_GETPIPE_SZ)
+    except IOError:
+      return None
+
+  def _run(self):
+    """
+    Read the frames from the named pipe, reopening it when the streamer restarts.
+    """
+    ring = self._ring
+    while not self._stopped:
+      with open(self.fifo, 'rb', 0) as fifo:
+        self.pipe_size = self._grow_pipe(fifo.fileno())
+        if self.pipe_size is not None and self.pipe_size < self._ring.frame_size:
+          print "FrameTap: the pipe buffer of %d bytes is smaller than a frame, ffmpeg blocks on every frame" % self.pipe_size
+        while not self._stopped:
+          seq = self._seq + 1
+          offset = ring.offset(seq)
+          start = offset + SLOT.size
+          # invalidate the slot while it is written
+          SLOT.pack_into(ring._map, offset, 0, 0)
+          n = 0
+          while n < ring.frame_size:
+            data = fifo.read(ring.frame_size - n)
+            if not data:
+              break
+            ring._map[start + n:start + n + len(data)] = data
+            n += len(data)
+          if n < ring.frame_size:
+            if n:
+              self.partial += 1
+            break
+          SLOT.pack_into(ring._map, offset, seq, time.time())
+          struct.pack_into('<Q', ring._map, HEADER.size - 8, seq)
+          self._seq = seq
+          self.frames += 1
+    return
+
+class FrameReader(object):
+  """
+  Read the frames published by a FrameTap, in this or in another process.
+  Methods exported:
+    FrameReader(path) -- Object constructor, maps the ring buffer file
+    latest() -- The newest frame or None
+    next(seq, timeout=None) -- The first frame after seq, waiting for it up to timeout seconds
+    valid(frame) -- True if the frame has not been overwritten
+    close() -- Unmap the ring buffer
+  """
+
+  def __init__(self, path):
+    """
+    path: ring buffer file name of the FrameTap
+    """
+    with open(path, 'rb') as f:
+      magic, version, slots, width, height, channels, seq = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC or version != VERSION:
+      raise ValueError("%s is not a frame ring buffer" % path)
+    self._ring = FrameRing(path, width, height, channels, slots, False)
+
+  def latest(self):
+    """
+    Return the newest frame, None if there are no frames yet.
+    """
+    ring = self._ring
+    while True:
+      seq = ring.last_seq()
+      if not seq:
+        return None
+      frame = self._frame(seq)
+      if frame:
+        return frame
+
+  def next(self, seq, timeout=None):
+    """
+    Return the first available frame newer than seq, the newest if the reader has fallen behind.
+    Waits up to timeout seconds, forever if None. Returns None on timeout.
+    """
+    end = time.time() + timeout if timeout is not None else None
+    ring = self._ring
+    while True:
+      last = ring.last_seq()
+      if last > seq:
+        # the frames older than the ring size have been overwritten
+        frame = self._frame(max(seq + 1, last - ring.slots + 2))
+        if frame:
+          return frame
+        continue
+      if end is not None and time.time() >= end:
+        return None
+      time.sleep(0.002)
+
+  def valid(self, frame):
+    """
+    Return True if the frame has not been overwritten by the writer, to check after using frame.data.
+    """
+    return SLOT.unpack_from(self._ring._map, frame._offset)[0] == frame.seq
+
+  def close(self):
+    self._ring.close()
+
+  def _frame(self, seq):
+    """
+    Return the frame seq, None if its slot is being written or has been reused.
+    """
+    ring = self._ring
+    offset = ring.offset(seq)
+    slot_seq, timestamp = SLOT.unpack_from(ring._map, offset)
+    if slot_seq != seq:
+      return None
+    data = buffer(ring._map, offset + SLOT.size, ring.frame_size)
+    return Frame(seq, timestamp, ring.width, ring.height, ring.channels, data, offset)
@@ -0,0 +1,55 @@
+"""
+  JSON codec of the RPC messages: ujson when installed, or the standard json module.
+
+  Copyright 2016 Visible Energy Inc. All Rights Reserved.
+"""
+__license__ = """
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+__all__ = ["loads", "dumps", "use", "name"]
+
+import json
+
+# the codecs in order of preference
+CODECS = ('ujson', 'json')
+
+# the codec in use, loads() and dumps() are rebound by use(): call them as jsoncodec.loads()
+name = 'json'
+loads = json.loads
+dumps = json.dumps
+
+def use(codec=None):
+  """
+  Select the JSON codec: 'ujson' or 'json', the first one installed if codec is None.
+  Returns the name of the codec. Raises ImportError if the codec is not installed, ValueError if unknown.
+  loads(s) raises ValueError on invalid JSON and dumps(obj) returns a str with every codec.
+  """
+  global name, loads, dumps
+  if codec and codec not in CODECS:
+    raise ValueError("unknown JSON codec %s" % codec)
+  for candidate in (codec,) if codec else CODECS:
+    try:
+      module = __import__(candidate)
+    except ImportError:
+      if codec:
+        raise
+      continue
+    if candidate == 'ujson':
+      loads = module.loads
+      # the standard json output: "/" is not escaped
+      dumps = lambda obj: module.dumps(obj, escape_forward_slashes=False)
+    else:
+      loads = json.loads
+      dumps = json.dumps
+    name = candidate
+    return name
+
+use()
@@ -0,0 +1,224 @@
+"""
+  Instrumentation of the Autonomia device SDK: RPC latency histograms, traffic counters and connection health.
+
+  Copyright 2016 Visible Energy Inc. All Rights Reserved.
+"""
+__license__ = """
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+__all__ = ["Metrics", "Histogram"]
+
+import time
+import bisect
+import threading
+
+# upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# traffic and connection counters
+COUNTERS = ('bytes_sent', 'bytes_received', 'messages_received', 'data_sent', 'replies_sent', 'heartbeats_sent',
+            'send_data_failures', 'rpc_not_found', 'reconnects', 'dead_peers', 'rpc_cache_hits', 'rpc_cache_misses')
+
+class Histogram(object):
+  """
+  A histogram with fixed bucket bounds.
+  """
+
+  def __init__(self, bounds=LATENCY_BUCKETS):
+    self.bounds = bounds
+    self.buckets = [0] * (len(bounds) + 1)
+    self.count = 0
+    self.sum = 0.0
+
+  def observe(self, value):
+    self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+    self.count += 1
+    self.sum += value
+
+  def snapshot(self):
+    """
+    Return the histogram as a dictionary with the cumulative count of every bucket bound.
+    """
+    cumulative = []
+    total = 0
+    for bound, n in zip(self.bounds + (float('inf'),), self.buckets):
+      total += n
+      cumulative.append((bound, total))
+    return {'count': self.count, 'sum': self.sum, 'buckets': cumulative}
+
+class Metrics(object):
+  """
+  Counters and histograms updated by AutonomiaClient.
+  Methods exported:
+    Metrics() -- Object constructor
+    snapshot() -- Dictionary with the current values
+    prometheus() -- The current values in the Prometheus text format
+    serve(port, host='127.0.0.1') -- Serve the Prometheus text format over HTTP
+    report(interval, callback) -- Call callback(snapshot) every interval seconds
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._counters = dict((name, 0) for name in COUNTERS)
+    self._gauges = {}
+    self._rpc = {}   # method name -> [calls, errors, Histogram]
+    self._reconnect_time = Histogram((0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0))
+    self._last_received = None
+    self._started = time.time()
+
+  def count(self, name, n=1):
+    """
+    Increment a counter.
+    """
+    with self._lock:
+      self._counters[name] += n
+
+  def gauge(self, name, value):
+    """
+    Set a gauge to the current value.
+    """
+    with self._lock:
+      self._gauges[name] = value
+
+  def received(self, nbytes):
+    """
+    Record data received from the server.
+    """
+    with self._lock:
+      self._counters['bytes_received'] += nbytes
+      self._last_received = time.time()
+
+  def rpc_call(self, method, seconds, error=False):
+    """
+    Record an RPC method call and its duration.
+    """
+    with self._lock:
+      rpc = self._rpc.get(method)
+      if rpc is None:
+        rpc = self._rpc[method] = [0, 0, Histogram()]
+      rpc[0] += 1
+      if error:
+        rpc[1] += 1
+      rpc[2].observe(seconds)
+
+  def reconnected(self, seconds):
+    """
+    Record a reconnection and its duration.
+    """
+    with self._lock:
+      self._counters['reconnects'] += 1
+      self._reconnect_time.observe(seconds)
+
+  def snapshot(self):
+    """
+    Return a dictionary with the current counters, the RPC statistics per method,
+    the reconnection times and the seconds since the last data received from the server.
+    """
+    with self._lock:
+      snap = dict(self._counters)
+      snap.update(self._gauges)
+      snap['uptime'] = time.time() - self._started
+      snap['since_last_received'] = time.time() - self._last_received if self._last_received else None
+      snap['reconnect_time'] = self._reconnect_time.snapshot()
+      snap['rpc'] = dict((method, {'calls': rpc[0], 'errors': rpc[1], 'latency': rpc[2].snapshot()})
+                         for method, rpc in self._rpc.items())
+    return snap
+
+  def prometheus(self):
+    """
+    Return the current values in the Prometheus text exposition format.
+    """
+    snap = self.snapshot()
+    lines = []
+    for name in COUNTERS:
+      lines.append('# TYPE autonomia_%s_total counter' % name)
+      lines.append('autonomia_%s_total %d' % (name, snap[name]))
+    if snap['since_last_received'] is not None:
+      lines.append('# TYPE autonomia_seconds_since_last_received gauge')
+      lines.append('autonomia_seconds_since_last_received %.3f' % snap['since_last_received'])
+    for name in sorted(self._gauges):
+      lines.append('# TYPE autonomia_%s gauge' % name)
+      lines.append('autonomia_%s %r' % (name, snap[name]))
+    lines += histogram_lines('autonomia_reconnect_seconds', '', snap['reconnect_time'])
+
+    rpcs = sorted((label_value(m), r) for m, r in snap['rpc'].items())
+    lines.append('# TYPE autonomia_rpc_calls_total counter')
+    lines += ['autonomia_rpc_calls_total{method="%s"} %d' % (m, r['calls']) for m, r in rpcs]
+    lines.append('# TYPE autonomia_rpc_errors_total counter')
+    lines += ['autonomia_rpc_errors_total{method="%s"} %d' % (m, r['errors']) for m, r in rpcs]
+    for i, (method, rpc) in enumerate(rpcs):
+      lines += histogram_lines('autonomia_rpc_latency_seconds', 'method="%s"' % method, rpc['latency'], i == 0)
+    return '\n'.join(lines) + '\n'
+
+  def serve(self, port, host='127.0.0.1'):
+    """
+    Serve the Prometheus text format at http://host:port/metrics in a background thread.
+    The metrics are served on the loopback interface only, unless another host address is given.
+    Returns the HTTP server.
+    """
+    import BaseHTTPServer
+    metrics = self
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+      def do_GET(self):
+        if self.path != '/metrics':
+          self.send_error(404)
+          return
+        body = metrics.prometheus()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+      def log_message(self, format, *args):
+        pass
+
+    server = BaseHTTPServer.HTTPServer((host, port), Handler)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return server
+
+  def report(self, interval, callback):
+    """
+    Call callback with the snapshot every interval seconds in a background thread.
+    """
+    def run():
+      while True:
+        time.sleep(interval)
+        try:
+          callback(self.snapshot())
+        except Exception, e:
+          print e
+    t = threading.Thread(target=run)
+    t.daemon = True
+    t.start()
+    return
+
+def label_value(value):
+  """
+  Escape a Prometheus label value.
+  """
+  return unicode(value).encode('utf-8').replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def histogram_lines(name, labels, hist, header=True):
+  """
+  Return the Prometheus text lines of a histogram snapshot.
+  """
+  sep = ',' if labels else ''
+  lines = ['# TYPE %s histogram' % name] if header else []
+  for bound, count in hist['buckets']:
+    le = '+Inf' if bound == float('inf') else repr(bound)
+    lines.append('%s_bucket{%s%sle="%s"} %d' % (name, labels, sep, le, count))
+  lines.append('%s_sum%s %r' % (name, '{%s}' % labels if labels else '', hist['sum']))
+  lines.append('%s_count%s %d' % (name, '{%s}' % labels if labels else '', hist['count']))
+  return lines
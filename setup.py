@@ -15,8 +15,5 @@ setup(name='autonomia',
       url='https://github.com/Autonomia/Autonomia-SDK-Python',
       version='1.0.0',
       license='Apache 2.0',
-      py_modules=['autonomialib','streamer'],
-      install_requires=[
-          'http-parser',
-      ], 
+      py_modules=['autonomialib','streamer','chunked','spool','metrics','frametap','compression','jsoncodec','capture'],
 )
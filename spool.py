@@ -0,0 +1,187 @@
+"""
+  Persistent store-and-forward queue for the messages that cannot be sent upstream.
+
+  Copyright 2016 Visible Energy Inc. All Rights Reserved.
+"""
+__license__ = """
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+__all__ = ["MessageSpool"]
+
+import os
+import mmap
+import struct
+import threading
+
+# file header: magic, version, capacity, head, tail, count, dropped
+HEADER = struct.Struct('<4sIIIIII')
+MAGIC = 'ASPL'
+VERSION = 1
+# record header: message length
+RECORD = struct.Struct('<I')
+
+class MessageSpool(object):
+  """
+  A fixed size ring buffer of messages in a memory-mapped file.
+  When the buffer is full the oldest messages are evicted. The content survives a restart of the process.
+  Methods exported:
+    MessageSpool(path, size=1048576) -- Object constructor, opens or creates the spool file
+    put(msg) -- Append a message, evicting the oldest messages if needed
+    peek() -- Return the oldest message or None
+    head() -- Return the position and the oldest message, or None
+    pop(position=None) -- Remove the oldest message, if still at position
+    stats() -- Queued and dropped message counts
+    close() -- Write the buffer to disk and close the file
+  """
+
+  def __init__(self, path, size=1048576):
+    """
+    path: spool file name
+    size: size of the ring buffer in bytes
+    """
+    self.path = path
+    self._lock = threading.Lock()
+    self._capacity = size
+    new = not os.path.exists(path) or os.path.getsize(path) != HEADER.size + size
+    self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0600)
+    if new:
+      os.ftruncate(self._fd, HEADER.size + size)
+    self._map = mmap.mmap(self._fd, HEADER.size + size)
+
+    magic, version, capacity, head, tail, count, dropped = HEADER.unpack_from(self._map, 0)
+    if new or magic != MAGIC or version != VERSION or capacity != size:
+      head, tail, count, dropped = 0, 0, 0, 0
+    self._head = head         # offset of the oldest record
+    self._tail = tail         # offset of the next record
+    self._count = count
+    self._used = (tail - head) % size if count else 0
+    if count and self._used == 0:
+      self._used = size
+    self._dropped = dropped
+    self._removed = 0         # records removed since the file was opened: the position of the oldest record
+    self._save()
+    return
+
+  def __len__(self):
+    return self._count
+
+  def put(self, msg):
+    """
+    Append a message. The oldest messages are evicted to make room.
+    Returns False if the message is larger than the buffer and has been dropped.
+    """
+    need = RECORD.size + len(msg)
+    with self._lock:
+      if need > self._capacity:
+        self._dropped += 1
+        self._save()
+        return False
+      while self._capacity - self._used < need:
+        self._remove()
+        self._dropped += 1
+      self._write(self._tail, RECORD.pack(len(msg)) + msg)
+      self._tail = (self._tail + need) % self._capacity
+      self._used += need
+      self._count += 1
+      self._save()
+    return True
+
+  def peek(self):
+    """
+    Return the oldest message without removing it, or None if the spool is empty.
+    """
+    with self._lock:
+      if not self._count:
+        return None
+      length, = RECORD.unpack(self._read(self._head, RECORD.size))
+      return self._read((self._head + RECORD.size) % self._capacity, length)
+
+  def head(self):
+    """
+    Return (position, message) of the oldest message, or None if the spool is empty.
+    The position identifies the message for pop(): a message evicted meanwhile by put() is not removed twice.
+    """
+    with self._lock:
+      if not self._count:
+        return None
+      length, = RECORD.unpack(self._read(self._head, RECORD.size))
+      return self._removed, self._read((self._head + RECORD.size) % self._capacity, length)
+
+  def pop(self, position=None):
+    """
+    Remove the oldest message. With a position returned by head(), only if it is still the oldest message.
+    Returns True if a message has been removed.
+    """
+    with self._lock:
+      if not self._count or (position is not None and position != self._removed):
+        return False
+      self._remove()
+      self._save()
+    return True
+
+  def stats(self):
+    """
+    Return a dictionary with the number of queued messages, the bytes used and the number of dropped messages.
+    """
+    with self._lock:
+      return {'queued': self._count, 'queued_bytes': self._used, 'capacity': self._capacity, 'dropped': self._dropped}
+
+  def close(self):
+    """
+    Write the buffer to disk and close the spool file.
+    """
+    with self._lock:
+      self._map.flush()
+      self._map.close()
+      os.close(self._fd)
+    return
+
+  def _remove(self):
+    """
+    Remove the oldest record.
+    """
+    length, = RECORD.unpack(self._read(self._head, RECORD.size))
+    self._head = (self._head + RECORD.size + length) % self._capacity
+    self._used -= RECORD.size + length
+    self._count -= 1
+    self._removed += 1
+    if not self._count:
+      self._head = self._tail = self._used = 0
+    return
+
+  def _write(self, offset, data):
+    """
+    Write data in the ring buffer at offset, wrapping around the end.
+    """
+    base = HEADER.size
+    first = min(len(data), self._capacity - offset)
+    self._map[base + offset:base + offset + first] = data[:first]
+    if first < len(data):
+      self._map[base:base + len(data) - first] = data[first:]
+    return
+
+  def _read(self, offset, length):
+    """
+    Read length bytes from the ring buffer at offset, wrapping around the end.
+    """
+    base = HEADER.size
+    first = min(length, self._capacity - offset)
+    data = self._map[base + offset:base + offset + first]
+    if first < length:
+      data += self._map[base:base + length - first]
+    return data
+
+  def _save(self):
+    """
+    Update the file header.
+    """
+    HEADER.pack_into(self._map, 0, MAGIC, VERSION, self._capacity, self._head, self._tail, self._count, self._dropped)
+    return
@@ -16,8 +16,13 @@ limitations under the License.
 """
 
 import os
+import re
 import time
+import json
+import signal
 import subprocess
+import threading
+import collections
 import hashlib
 import hmac
 
@@ -30,115 +35,633 @@ def buildKey(mac, secret):
     h = hmac.new(secret, mac, digestmod=hashlib.sha256).hexdigest()
     return mac + ':' + h[0:32]
 
+# ffmpeg v4l2 input formats of the camera pixel formats, in order of preference
+INPUT_FORMATS = [('H264', 'h264'), ('MJPG', 'mjpeg'), ('YUYV', 'yuyv422')]
+
+# platform and camera capabilities, probed once
+_capabilities = None
+
 def isRPIcamera():
-  ret = False
+  return probe_capabilities()['rpi_camera']
+
+def probe_capabilities(cache_file=None, refresh=False):
+  """
+  Return the platform and camera capabilities, probed once and cached:
+    {'platform': 'rpi' or 'linux', 'rpi_camera': True or False, 'video_devices': ['/dev/video0'],
+     'devices': {'/dev/video0': [{'format': 'MJPG', 'width': 1280, 'height': 720, 'fps': [30.0, 15.0]}, ...]}}
+  The result is saved in cache_file, if given, and read from it at the next start
+  when the same video devices are connected.
+  """
+  global _capabilities
+  videodevs = sorted(["/dev/" + x for x in os.listdir("/dev/") if x.startswith("video")])
+  if not refresh and _capabilities and _capabilities['video_devices'] == videodevs:
+    return _capabilities
+
+  if not refresh and cache_file and os.path.exists(cache_file):
+    try:
+      with open(cache_file) as f:
+        caps = json.load(f)
+      if caps['video_devices'] == videodevs:
+        _capabilities = caps
+        return caps
+    except (IOError, ValueError, KeyError), e:
+      pass
+
+  caps = {'platform': 'linux', 'rpi_camera': False, 'video_devices': videodevs, 'devices': {}}
   # Detect if running on RPI
-  platform = 'rpi' if 'raspberrypi' in os.uname() else 'linux'
-  print 'Platform: ' + platform
+  if 'raspberrypi' in os.uname():
+    caps['platform'] = 'rpi'
+    caps['rpi_camera'] = rpi_camera_detected()
+  print 'Platform: ' + caps['platform']
+
+  for dev in videodevs:
+    formats = v4l2_formats(dev)
+    if formats:
+      caps['devices'][dev] = formats
+  print 'Detected RPI camera.' if caps['rpi_camera'] else 'Using USB camera.'
 
-  # import the RPI streamer
-  if platform == 'rpi':
+  if cache_file:
     try:
-      import picamera
-      camera = picamera.PiCamera()
-      resolution = camera.resolution
-      camera.close()
-      print 'Detected RPI camera. Resolution: ' + str(resolution)
-      ret = True
-    except Exception, e:
-      # import the Linux streamer
-      print 'Using USB camera.'
-  else:
-    # import the Linux streamer
-    import streamer
-    print 'Using USB camera.'      
-  return ret
+      with open(cache_file, 'w') as f:
+        json.dump(caps, f)
+    except IOError, e:
+      print 'Cannot write capabilities cache: ' + str(e)
+  _capabilities = caps
+  return caps
 
-def video_stop():
-  """ Stop running video capture streamer """
-  pname = 'ffmpeg' 
-  s = 'killall ' + pname
-  FNULL = open(os.devnull, 'w')
+def rpi_camera_detected():
+  """
+  Return True if the RPI camera is connected, without opening the camera.
+  """
+  try:
+    # i.e. supported=1 detected=1
+    out = subprocess.check_output(['vcgencmd', 'get_camera'])
+    return 'detected=1' in out
+  except (OSError, subprocess.CalledProcessError), e:
+    pass
   try:
-    # execute and wait for completion
-    subprocess.check_call(s, shell=True, stderr=FNULL) 
+    import picamera
+    camera = picamera.PiCamera()
+    camera.close()
+    return True
   except Exception, e:
-      pass
-  return
+    return False
 
-def rpi_cam_start(device_id, application_key, timestamp):
+def v4l2_formats(device):
+  """
+  Return the capture formats of a video device from v4l2-ctl: a list of pixel format, frame size and frame rates.
+  """
   FNULL = open(os.devnull, 'w')
+  try:
+    out = subprocess.check_output(['v4l2-ctl', '--device=' + device, '--list-formats-ext'], stderr=FNULL)
+  except (OSError, subprocess.CalledProcessError), e:
+    return []
+  finally:
+    FNULL.close()
+
+  formats = []
+  fourcc = None
+  for line in out.splitlines():
+    m = re.search(r"Pixel Format\s*:\s*'(\w+)'", line)
+    if m:
+      fourcc = m.group(1)
+      continue
+    m = re.search(r'Size: Discrete (\d+)x(\d+)', line)
+    if m and fourcc:
+      formats.append({'format': fourcc, 'width': int(m.group(1)), 'height': int(m.group(2)), 'fps': []})
+      continue
+    m = re.search(r'\(([\d.]+) fps\)', line)
+    if m and formats:
+      formats[-1]['fps'].append(float(m.group(1)))
+  return formats
+
+def select_format(formats, width=1280, height=720, fps=30):
+  """
+  Select the native capture format closest to width x height at fps, to stream without scaling.
+  Sizes larger than requested and slower frame rates rank lower, compressed formats rank higher.
+  Returns the format dictionary and the frame rate, or None and None.
+  """
+  preference = [f for f, _ in INPUT_FORMATS]
+  best, best_rank = None, None
+  for f in formats:
+    if f['format'] not in preference:
+      continue
+    rate = max([r for r in f['fps'] if r <= fps] or f['fps'] or [fps])
+    area = f['width'] * f['height']
+    rank = (area > width * height, rate < fps, abs(width * height - area), preference.index(f['format']), -rate)
+    if best_rank is None or rank < best_rank:
+      best, best_rank = (f, rate), rank
+  return best or (None, None)
+
+class StreamSupervisor(object):
+  """
+  Run a streamer pipeline, i.e. raspivid | ffmpeg, and restart it when a process fails.
+  Only the processes started by the supervisor are stopped.
+  Methods exported:
+    StreamSupervisor(stop_timeout=2, restart=True, max_backoff=30) -- Object constructor
+    start(pipeline, progress_cb=None) -- Start the pipeline processes, stopping the running ones
+    stop() -- Stop the pipeline processes
+    running() -- True if the pipeline is running
+    status() -- Process ids, restarts and last exit codes
+  """
+
+  def __init__(self, stop_timeout=2, restart=True, max_backoff=30):
+    """
+    stop_timeout: seconds to wait for a process to exit after SIGTERM before killing it
+    restart: restart the pipeline when a process exits with an error
+    max_backoff: maximum delay in seconds between restarts
+    """
+    self.stop_timeout = stop_timeout
+    self.restart = restart
+    self.max_backoff = max_backoff
+    self.restarts = 0
+    self.exit_codes = []
+    self._lock = threading.RLock()
+    self._pipeline = None
+    self._progress_cb = None
+    self._procs = []
+    self._started = 0
+    self._backoff = 1
+    self._restart_at = None
+    self._monitor = None
+
+  def start(self, pipeline, progress_cb=None):
+    """
+    Start a pipeline: a list of commands, each an argument list, where the output
+    of a command is the input of the next. Returns the list of Popen objects.
+    If progress_cb is given, the last command is ffmpeg with '-progress pipe:1' and
+    progress_cb is called with every progress sample (see parse_progress).
+    """
+    with self._lock:
+      self._stop_procs()
+      self._pipeline = pipeline
+      self._progress_cb = progress_cb
+      self._backoff = 1
+      self._restart_at = None
+      try:
+        self._spawn()
+      except OSError:
+        self._pipeline = None
+        raise
+      if self._monitor is None:
+        self._monitor = threading.Thread(target=self._run)
+        self._monitor.daemon = True
+        self._monitor.start()
+      return list(self._procs)
+
+  def stop(self):
+    """
+    Stop the pipeline: SIGTERM to every process, SIGKILL to the ones still running after stop_timeout.
+    """
+    with self._lock:
+      self._pipeline = None
+      self._restart_at = None
+      self._stop_procs()
+    return
+
+  def running(self):
+    """
+    Return True if all the pipeline processes are running.
+    """
+    with self._lock:
+      return bool(self._procs) and all(p.poll() is None for p in self._procs)
+
+  def status(self):
+    """
+    Return a dictionary with the process ids, the number of restarts and the last exit codes.
+    """
+    with self._lock:
+      return {'pids': [p.pid for p in self._procs], 'running': self.running(),
+              'restarts': self.restarts, 'exit_codes': list(self.exit_codes)}
+
+  def _spawn(self):
+    """
+    Start the pipeline processes connected by pipes.
+    Raises OSError if a process cannot be started, after stopping the ones already started.
+    """
+    FNULL = open(os.devnull, 'w')
+    self._procs = []
+    stdin = None
+    try:
+      for i, params in enumerate(self._pipeline):
+        last = i == len(self._pipeline) - 1
+        p = subprocess.Popen(params, stdin=stdin, stdout=None if last and not self._progress_cb else subprocess.PIPE, stderr=FNULL)
+        if stdin is not None:
+          # the next process owns the pipe
+          stdin.close()
+        stdin = p.stdout
+        self._procs.append(p)
+    except OSError:
+      if stdin is not None:
+        stdin.close()
+      self._stop_procs()
+      raise
+    finally:
+      FNULL.close()
+    if self._progress_cb:
+      t = threading.Thread(target=self._read_progress, args=(self._procs[-1], self._progress_cb))
+      t.daemon = True
+      t.start()
+    self._started = time.time()
+    return
+
+  def _read_progress(self, proc, callback):
+    """
+    Read the ffmpeg progress output of a process and pass every sample to the callback,
+    while the process belongs to the running pipeline: the samples of a stopped or replaced process are dropped.
+    """
+    sample = {}
+    for line in iter(proc.stdout.readline, ''):
+      key, _, value = line.strip().partition('=')
+      sample[key] = value
+      # progress=continue or progress=end closes a sample
+      if key == 'progress':
+        # the lock keeps stop() and start() from replacing the process during the callback
+        with self._lock:
+          if self._pipeline is not None and proc in self._procs:
+            try:
+              callback(parse_progress(sample))
+            except Exception, e:
+              print e
+        sample = {}
+    proc.stdout.close()
+    return
+
+  def _stop_procs(self):
+    """
+    Terminate the running processes and wait for them to exit.
+    """
+    for p in self._procs:
+      if p.poll() is None:
+        try:
+          p.send_signal(signal.SIGTERM)
+        except OSError:
+          pass
+    end = time.time() + self.stop_timeout
+    for p in self._procs:
+      while p.poll() is None and time.time() < end:
+        time.sleep(0.01)
+      if p.poll() is None:
+        try:
+          p.kill()
+        except OSError:
+          pass
+        p.wait()
+    self._procs = []
+    return
+
+  def _run(self):
+    """
+    The monitor thread: detects the failed processes and restarts the pipeline with an exponential backoff.
+    """
+    while True:
+      time.sleep(0.2)
+      with self._lock:
+        if self._pipeline is None:
+          continue
+        now = time.time()
+        if self._restart_at is not None:
+          if now >= self._restart_at:
+            self._restart_at = None
+            self.restarts += 1
+            print 'Restarting streamer: ' + ' | '.join(params[0] for params in self._pipeline)
+            try:
+              self._spawn()
+            except OSError, e:
+              # i.e. fork failing with ENOMEM or EAGAIN, or a missing binary: try again later
+              print 'Error restarting streamer: ' + str(e)
+              self._schedule_restart(now)
+          continue
+
+        codes = [p.poll() for p in self._procs]
+        failed = [c for c in codes if c is not None and c != 0]
+        if not failed:
+          if all(c == 0 for c in codes):
+            # the pipeline completed
+            self._pipeline = None
+            self._procs = []
+          continue
+
+        self.exit_codes = codes
+        print 'Streamer process exited with error: ' + str(codes)
+        self._stop_procs()
+        if not self.restart:
+          self._pipeline = None
+          continue
+        # reset the backoff after a stable run
+        if now - self._started > self.max_backoff:
+          self._backoff = 1
+        self._schedule_restart(now)
+
+  def _schedule_restart(self, now):
+    """
+    Restart the pipeline after the backoff delay and double the delay, up to max_backoff.
+    """
+    self._restart_at = now + self._backoff
+    self._backoff = min(self._backoff * 2, self.max_backoff)
+
+def parse_progress(sample):
+  """
+  Convert an ffmpeg progress sample to numbers:
+    {'frame': 1200, 'fps': 29.9, 'bitrate': 745.2 (kbit/s), 'drop_frames': 0, 'dup_frames': 2, 'speed': 1.0}
+  The values not reported yet are None.
+  """
+  def number(key, convert=float, suffix=''):
+    value = sample.get(key, 'N/A').strip()
+    if value.endswith(suffix):
+      value = value[:len(value) - len(suffix)]
+    try:
+      return convert(value)
+    except ValueError:
+      return None
+  return {'frame': number('frame', int), 'fps': number('fps'), 'bitrate': number('bitrate', float, 'kbits/s'),
+          'drop_frames': number('drop_frames', int), 'dup_frames': number('dup_frames', int),
+          'speed': number('speed', float, 'x'), 'end': sample.get('progress') == 'end'}
+
+# the ladder of streaming qualities of the bitrate controller, from the lowest to the highest
+# bitrate in kbit/s, gop in frames
+DEFAULT_LADDER = [
+  {'width': 426, 'height': 240, 'fps': 15, 'bitrate': 250, 'gop': 30},
+  {'width': 640, 'height': 360, 'fps': 30, 'bitrate': 500, 'gop': 60},
+  {'width': 854, 'height': 480, 'fps': 30, 'bitrate': 768, 'gop': 60},
+  {'width': 1280, 'height': 720, 'fps': 30, 'bitrate': 1200, 'gop': 60},
+  {'width': 1280, 'height': 720, 'fps': 30, 'bitrate': 2000, 'gop': 60},
+]
+
+class BitrateController(object):
+  """
+  Step the streamer bitrate, resolution and GOP up or down a ladder, driven by the ffmpeg progress reports.
+  The stream steps down when the encoder falls behind real time or drops frames, and steps up
+  after running without problems for up_after seconds. Two changes are at least min_interval seconds apart.
+  Methods exported:
+    BitrateController(build, ladder=None, rung=None, min_interval=10, up_after=30, slow_samples=3, warmup=5, max_fps=None) -- Object constructor
+    start() -- Start the streamer
+    progress(sample) -- Process an ffmpeg progress sample
+    status() -- Current quality, last sample and decisions
+  """
+
+  def __init__(self, build, ladder=None, rung=None, min_interval=10, up_after=30, slow_samples=3, warmup=5, max_fps=None):
+    """
+    build: function returning the streamer pipeline for a ladder rung
+    ladder: list of qualities from the lowest to the highest -- default DEFAULT_LADDER
+    rung: index of the initial quality -- default the middle of the ladder
+    min_interval: minimum seconds between two quality changes
+    up_after: seconds without problems before stepping up
+    slow_samples: consecutive bad progress samples before stepping down
+    warmup: seconds after a start when the samples are ignored
+    max_fps: capture rate of the camera, the stream is never faster than it
+    """
+    self.ladder = ladder or DEFAULT_LADDER
+    self.rung = rung if rung is not None else len(self.ladder) / 2
+    self.min_interval = min_interval
+    self.up_after = up_after
+    self.slow_samples = slow_samples
+    self.warmup = warmup
+    self.max_fps = max_fps
+    self.switches = 0
+    self.decisions = collections.deque(maxlen=20)
+    self.last_sample = None
+    self._build = build
+    self._lock = threading.Lock()
+    self._slow = 0
+    self._drops = 0
+    self._switched = 0
+    self._good_since = 0
 
+  def start(self):
+    """
+    Start the streamer at the current quality. Returns the list of Popen objects.
+    """
+    with self._lock:
+      return self._start()
+
+  def progress(self, sample):
+    """
+    Process an ffmpeg progress sample, changing the quality when needed.
+    """
+    with self._lock:
+      now = time.time()
+      self.last_sample = sample
+      if sample['end'] or now - self._switched < self.warmup:
+        return
+      fps = self.ladder[self.rung]['fps']
+      if self.max_fps:
+        fps = min(fps, self.max_fps)
+      drops = (sample['drop_frames'] or 0) - self._drops
+      self._drops = sample['drop_frames'] or 0
+      slow = (sample['speed'] is not None and sample['speed'] < 0.95) or drops > 0 or \
+             (sample['fps'] is not None and sample['fps'] < 0.8 * fps)
+      if slow:
+        self._slow += 1
+        self._good_since = now
+      else:
+        self._slow = 0
+
+      if now - self._switched < self.min_interval:
+        return
+      if self._slow >= self.slow_samples and self.rung > 0:
+        self._switch(self.rung - 1, 'speed %s fps %s dropped %d' % (sample['speed'], sample['fps'], drops))
+      elif not slow and now - self._good_since >= self.up_after and self.rung < len(self.ladder) - 1:
+        self._switch(self.rung + 1, 'stable for %d s' % (now - self._good_since))
+    return
+
+  def status(self):
+    """
+    Return a dictionary with the current quality, the last progress sample and the last decisions.
+    """
+    with self._lock:
+      return {'rung': self.rung, 'quality': dict(self.ladder[self.rung]), 'switches': self.switches,
+              'last_sample': self.last_sample, 'decisions': list(self.decisions)}
+
+  def _switch(self, rung, reason):
+    """
+    Restart the streamer at another quality.
+    """
+    self.decisions.append({'time': time.time(), 'from': self.rung, 'to': rung, 'reason': reason})
+    print 'Streamer quality %d -> %d: %s' % (self.rung, rung, reason)
+    self.rung = rung
+    self.switches += 1
+    self._start()
+    return
+
+  def _start(self):
+    now = time.time()
+    self._switched = now
+    self._good_since = now
+    self._slow = 0
+    self._drops = 0
+    return supervisor.start(self._build(self.ladder[self.rung]), self.progress)
+
+# the supervisor of the streamer started by video_start()
+supervisor = StreamSupervisor()
+# the bitrate controller of the adaptive streamer
+bitrate_controller = None
+# the FrameTap of the streamer
+frame_tap = None
+
+def video_status():
+  """
+  Return the status of the streamer processes and of the bitrate controller.
+  """
+  return {'supervisor': supervisor.status(), 'bitrate': bitrate_controller.status() if bitrate_controller else None}
+
+def video_stop():
+  """ Stop running video capture streamer """
+  global frame_tap, bitrate_controller
+  # a late progress sample must not restart the streamer
+  bitrate_controller = None
+  supervisor.stop()
+  if frame_tap:
+    frame_tap.stop()
+    frame_tap = None
+  return
+
+def rpi_cam_pipeline(url, timestamp, quality=None):
+  """
+  Return the raspivid | ffmpeg pipeline. With a quality of the bitrate ladder ffmpeg reports its progress.
+  """
   if not timestamp:
     # raspivid 
     params = ['raspivid', '-o', '-', '-t', '0',  '-vf', '-w', '1280', '-h', '720', '-fps', '30', '-b', '1000000', '-t', '5000']
     # params = ['raspivid', '-o', '-', '-t', '0', '-vf', '-hf', '-w', '1920', '-h', '1080', '-fps', '30', '-b', '2000000', '-t', '5000']
-    raspivid_pid = subprocess.Popen(params, stdout=subprocess.PIPE)
+    raspivid = params
     params = ['ffmpeg', '-r','30', '-use_wallclock_as_timestamps', '1', '-thread_queue_size', '512', '-f', 'h264', '-i', '-', '-vcodec', 'copy', '-g', '30', '-strict', 'experimental']
-    server = 'stream.autonomia.io:12345'
-    key = buildKey(device_id, application_key)
-    url = 'rtmp://' + server + '/src/' + key + ':1'
     params = params + ['-threads', '4', '-f', 'flv', url]
-
-    process = subprocess.Popen(params, stdin=raspivid_pid.stdout, stderr=FNULL)
-    raspivid_pid.stdout.close()  
   else:
     # raspivid 
     #params = ['raspivid', '-o', '-', '-t', '0', '-vf', '-hf', '-w', '1280', '-h', '720', '-fps', '30', '-b', '2000000', '-t', '5000']
     params = ['raspivid', '-o', '-', '-t', '0', '-vf', '-w', '1280', '-h', '720', '-fps', '30', '-b', '2000000', '-t', '5000']
-    raspivid_pid = subprocess.Popen(params, stdout=subprocess.PIPE)
+    raspivid = params
     params = ['ffmpeg', '-r','30', '-use_wallclock_as_timestamps', '1', '-thread_queue_size', '512', '-f', 'h264', '-i', '-', '-vcodec', 'h264', '-g', '30', '-strict', 'experimental']
-    server = 'stream.autonomia.io:12345'
-    key = buildKey(device_id, application_key)
-    url = 'rtmp://' + server + '/src/' + key + ':1'
     format = "drawtext=fontfile=/usr/share/fonts/truetype/freefont/FreeSans.ttf: text='%{localtime}':x=0:y=(h-th-2): fontsize=24: fontcolor=white: box=1: boxcolor=black@0.9"
     params = params + ['-vf', format, '-threads', '4', '-f', 'flv', url]
 
-    process = subprocess.Popen(params, stdin=raspivid_pid.stdout, stderr=FNULL)
-    raspivid_pid.stdout.close()
+  if quality:
+    # the camera encodes at the quality of the ladder, ffmpeg copies or re-encodes at the same bitrate
+    raspivid = ['raspivid', '-o', '-', '-t', '0', '-vf', '-w', str(quality['width']), '-h', str(quality['height']),
+                '-fps', str(quality['fps']), '-b', str(quality['bitrate'] * 1000), '-g', str(quality['gop'])]
+    params[params.index('-r') + 1] = str(quality['fps'])
+    params[params.index('-g') + 1] = str(quality['gop'])
+    if timestamp:
+      params[-3:-3] = bitrate_params(quality)
+    params[1:1] = ['-progress', 'pipe:1', '-nostats']
+  return [raspivid, params]
+
+def bitrate_params(quality):
+  """
+  Return the ffmpeg encoder bitrate options of a quality of the bitrate ladder.
+  """
+  return ['-b:v', '%dk' % quality['bitrate'], '-maxrate', '%dk' % quality['bitrate'], '-bufsize', '%dk' % (quality['bitrate'] * 5 / 4)]
+
+def with_tap(pipeline, tap):
+  """
+  Add the output of a FrameTap to the ffmpeg command of a pipeline.
+  """
+  if tap:
+    pipeline[-1] = pipeline[-1] + tap.ffmpeg_output()
+  return pipeline
+
+def start_tap(tap):
+  """
+  Start publishing the frames in the ring buffer of a FrameTap.
+  """
+  global frame_tap
+  if tap:
+    tap.start()
+    frame_tap = tap
+  return
+
+def rpi_cam_start(device_id, application_key, timestamp, adaptive=False, ladder=None, tap=None):
+  server = 'stream.autonomia.io:12345'
+  key = buildKey(device_id, application_key)
+  url = 'rtmp://' + server + '/src/' + key + ':1'
+
+  # raspivid | ffmpeg
+  if adaptive:
+    raspivid_pid, process = start_adaptive(lambda quality: with_tap(rpi_cam_pipeline(url, timestamp, quality), tap), ladder)
+  else:
+    raspivid_pid, process = supervisor.start(with_tap(rpi_cam_pipeline(url, timestamp), tap))
   return raspivid_pid, url     
   #raspivid -o - -t 0 -vf -hf -fps 30 -w 1280 -h 720 -b 2000000 | ffmpeg -r 30 -use_wallclock_as_timestamps 1 -f h264 -i - -vcodec copy -g 30 -strict experimental -f flv rtmp://stream.autonomia.io:12345/src/7777
 
-def video_start(serial, app_key, timestamp=True):
-  """ Start a video streamer """ 
+def start_adaptive(build, ladder=None, max_fps=None):
+  """
+  Start the streamer with a bitrate controller. Returns the list of Popen objects.
+  """
+  global bitrate_controller
+  bitrate_controller = BitrateController(build, ladder, max_fps=max_fps)
+  return bitrate_controller.start()
+
+def usb_cam_pipeline(camera, url, input_params, rate, timestamp, quality=None):
+  """
+  Return the ffmpeg pipeline of a USB camera, streamed at the capture rate.
+  With a quality of the bitrate ladder ffmpeg reports its progress.
+  """
+  pname = 'ffmpeg'
+  if timestamp:
+    # streaming video with timestamp -- to increase actual fps increase or remove maxrate and bufsize
+    params = [pname, '-r', str(rate), '-use_wallclock_as_timestamps', '1', '-thread_queue_size', '512', '-f', 'v4l2'] + input_params + ['-i', camera,'-maxrate', '768k', '-bufsize', '960k']
+    format = "drawtext=fontfile=/usr/share/fonts/truetype/freefont/FreeSans.ttf: text='%{localtime}':x=0:y=(h-th-2): fontsize=24: fontcolor=white: box=1: boxcolor=black@0.9"
+    params = params + ['-vf', format, '-threads', '4', '-r', str(rate), '-g', '60', '-f', 'flv', url]
+  else:
+    # streaming video 
+    params = [pname, '-r', str(rate), '-use_wallclock_as_timestamps', '1', '-thread_queue_size', '512', '-f', 'v4l2'] + input_params + ['-i', camera, '-maxrate', '768k', '-bufsize', '960k']
+    params = params + ['-threads', '4', '-r', str(rate), '-g', '60', '-f', 'flv', url]
+
+  if quality:
+    i = params.index('-maxrate')
+    params[i:i + 4] = bitrate_params(quality) + ['-s', '%dx%d' % (quality['width'], quality['height'])]
+    # never above the capture rate: ffmpeg would duplicate the frames
+    params[params.index('-g') - 1] = str(min(quality['fps'], rate))
+    params[params.index('-g') + 1] = str(quality['gop'])
+    params[1:1] = ['-progress', 'pipe:1', '-nostats']
+  return [params]
+
+def video_start(serial, app_key, timestamp=True, adaptive=False, ladder=None, tap=None, caps_file=None):
+  """
+  Start a video streamer.
+  With adaptive the bitrate, resolution and GOP follow the uplink capacity within the ladder of qualities.
+  With a FrameTap the frames are also published in its shared-memory ring buffer.
+  With caps_file the camera capabilities are saved in the file and read from it at the next start of the
+  process, instead of probing the cameras again, while the same video devices are connected.
+  """
 
   # insure streamer is not already running
   video_stop()
-  time.sleep(0.5)
 
-  if isRPIcamera():
-    return rpi_cam_start(serial, app_key, timestamp)
+  caps = probe_capabilities(caps_file)
+  if caps['rpi_camera']:
+    start_tap(tap)
+    return rpi_cam_start(serial, app_key, timestamp, adaptive, ladder, tap)
 
-  videodevs = ["/dev/" + x for x in os.listdir("/dev/") if x.startswith("video") ]
+  videodevs = caps['video_devices']
   if len(videodevs) == 0:
     print "Fatal error. Cannot proceed without cameras connected."
     return None, None
 
-  # use the first camera
-  camera=videodevs[0]
+  # use the first camera with known capture formats, or the first device
+  cameras = [dev for dev in videodevs if dev in caps['devices']] or videodevs
+  camera = cameras[0]
   print 'start video from: ' + camera
 
-  pname = 'ffmpeg'
-  vcodec = 'h264'
+  # capture in the best native format
+  rate = 30
+  input_params = []
+  fmt, fps = select_format(caps['devices'].get(camera, []))
+  if fmt:
+    rate = int(fps)
+    input_params = ['-input_format', dict(INPUT_FORMATS)[fmt['format']], '-video_size', '%dx%d' % (fmt['width'], fmt['height'])]
+    print 'capture format: %s %dx%d %d fps' % (fmt['format'], fmt['width'], fmt['height'], rate)
+
   server = 'stream.autonomia.io:12345'
   key = buildKey(serial, app_key)
-  # to suppress output when running the streamer
-  FNULL = open(os.devnull, 'w')
+  url = 'rtmp://' + server + '/src/' + key + ':1'
 
-  if timestamp:
-    # streaming video with timestamp -- to increase actual fps increase or remove maxrate and bufsize
-    params = [pname, '-r','30', '-use_wallclock_as_timestamps', '1', '-thread_queue_size', '512', '-f', 'v4l2', '-i', camera,'-maxrate', '768k', '-bufsize', '960k']
-    format = "drawtext=fontfile=/usr/share/fonts/truetype/freefont/FreeSans.ttf: text='%{localtime}':x=0:y=(h-th-2): fontsize=24: fontcolor=white: box=1: boxcolor=black@0.9"
-    url = 'rtmp://' + server + '/src/' + key + ':1'
-    params = params + ['-vf', format, '-threads', '4', '-r', '30', '-g', '60', '-f', 'flv', url]
-    # spawn a process and do not wait
-    pid = subprocess.Popen(params, stderr=FNULL)
+  # spawn a process and do not wait
+  start_tap(tap)
+  if adaptive:
+    pid, = start_adaptive(lambda quality: with_tap(usb_cam_pipeline(camera, url, input_params, rate, timestamp, quality), tap), ladder, rate)
   else:
-    # streaming video 
-    params = [pname, '-r','30', '-use_wallclock_as_timestamps', '1', '-thread_queue_size', '512', '-f', 'v4l2', '-i', camera, '-maxrate', '768k', '-bufsize', '960k']
-    url = 'rtmp://' + server + '/src/' + key + ':1'
-    params = params + ['-threads', '4', '-r', '30', '-g', '60', '-f', 'flv', url]
-    # spawn a process and do not wait
-    pid = subprocess.Popen(params, stderr=FNULL)
+    pid, = supervisor.start(with_tap(usb_cam_pipeline(camera, url, input_params, rate, timestamp), tap))
   return pid, url
   # ffmpeg -r 30 -use_wallclock_as_timestamps 1 -thread_queue_size 512 -f v4l2 -i  /dev/video0 -vb 2000k -vf "drawtext=fontfile=/usr/share/fonts/truetype/freefont/FreeSans.ttf:text='%{localtime}': x=0: y=(h-th-2): fontsize=24: fontcolor=white: box=1: boxcolor=black"  -threads 4 -r 30 -g 30 -f flv rtmp://stream.autonomia.io:12345/src/B8AEED7340ED-6e0d2b1002b502ca1cac3c7862a9040f^C